@@ -151,8 +151,25 @@ from telegram.ext import Application, CommandHandler, MessageHandler, filters, C
 import asyncio
 import json
 import random
+import itertools
+from collections import OrderedDict
 import aiohttp
-from typing import Dict, List, Optional, Tuple
+from time import perf_counter
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from src.router import provider_router
+from src.ratelimit import rate_limiter, request_coalescer, RateLimitExceeded
+from src.history import history_store
+from src.profile_store import profile_store
+from src.universe import sp500_universe
+from src.replay import replay
+from src.stream import quote_stream
+from src.indicators import indicator_engine
+from src.indicators_batch import compute_universe
+from src.admission import analysis_admission, AdmissionRejected, MAX_CONCURRENCY, MAX_WAITING, TIER_WEIGHTS
+from src.broadcast import broadcaster
+from src.user_store import user_store
+from src.quota import query_quota
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -163,6 +180,9 @@ logger = logging.getLogger(__name__)
 # Configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN', '8320641094:AAG1JVdI6BaPLgoUIAYmI3QgymnDG6x3hZE')
 PORT = int(os.getenv('PORT', 8080))
+# Analyses and rendered reports are reused within the same time bucket
+ANALYSIS_BUCKET_SECONDS = int(os.getenv('ANALYSIS_BUCKET_SECONDS', 60))
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 2048))
 
 class VIPStockBot:
     def __init__(self):
@@ -183,8 +203,13 @@ class VIPStockBot:
         self.est = pytz.timezone('America/New_York')
         self.taipei = pytz.timezone('Asia/Taipei')
         
+        # Lookups stay in memory; the persistent store only rebuilds them here and takes writes
+        self._load_users()
+        
         # Stock symbols
         self.sp500_symbols = None
+        self.all_symbols = None
+        self._universe_version = None
         self.mag7 = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA', 'META', 'NVDA']
         
         # Multilingual support
@@ -192,6 +217,25 @@ class VIPStockBot:
         
         # Daily reset management
         self.daily_reset_time = self._get_next_reset_time()
+        
+        # Quote sources, tried in the order chosen by the provider router
+        self.data_sources = {
+            'finnhub': self._get_finnhub_data,
+            'polygon': self._get_polygon_data,
+            'yahoo': self._get_yahoo_data,
+            'alpha_vantage': self._get_alpha_vantage_data
+        }
+        provider_router.register(*self.data_sources)
+        
+        # In-flight analyses shared by concurrent /stock requests: (symbol, feature set) -> task
+        self._inflight_analyses: Dict[Tuple[str, FrozenSet[str]], asyncio.Task] = {}
+        self.analysis_stats = {'runs': 0, 'coalesced': 0, 'reused': 0}
+        # Latest analysis per (symbol, feature set), reused while its time bucket is current
+        self._recent_analyses: Dict[Tuple[str, FrozenSet[str]], Dict] = {}
+        self._analysis_versions = itertools.count(1)
+        # Finished report text: (analysis version, tier, language, time bucket) -> text
+        self._render_cache: 'OrderedDict[Tuple[int, str, str, int], str]' = OrderedDict()
+        self.render_stats = {'hits': 0, 'misses': 0}
     
     def _init_multilingual_texts(self) -> Dict:
         return {
@@ -269,6 +313,32 @@ class VIPStockBot:
             }
         }
     
+    def _load_users(self):
+        """Rebuild in-memory user state from the persistent user store"""
+        today = datetime.now(self.taipei)
+        snapshot = user_store.load(today.strftime('%Y-%m-%d'),
+                                   oldest_day=(today - timedelta(days=1)).strftime('%Y-%m-%d'))
+        self._apply_users(snapshot)
+        self.user_queries = dict(snapshot['queries'])
+        query_quota.seed(today.strftime('%Y-%m-%d'), snapshot['queries'])
+    
+    def _apply_users(self, snapshot: Dict[str, Dict]):
+        """Replace tiers, languages and VIC emails with a store snapshot"""
+        self.vip_users = {user_id for user_id, tier in snapshot['tier'].items() if tier == 'vip'}
+        self.vic_users = {user_id for user_id, tier in snapshot['tier'].items() if tier == 'vic'}
+        self.user_languages = dict(snapshot['language'])
+        self.vic_emails = dict(snapshot['email'])
+    
+    def _sync_users(self):
+        """Pick up tiers granted on other workers (shared store only, checked every few seconds)"""
+        snapshot = user_store.changes()
+        if snapshot:
+            self._apply_users(snapshot)
+    
+    def _query_day(self) -> str:
+        """Taipei date the daily query counts belong to"""
+        return datetime.now(self.taipei).strftime('%Y-%m-%d')
+    
     def _get_next_reset_time(self) -> datetime:
         """Get next daily reset time"""
         now = datetime.now(self.taipei)
@@ -279,6 +349,11 @@ class VIPStockBot:
         """Get user language setting, default to Traditional Chinese"""
         return self.user_languages.get(user_id, 'zh-TW')
     
+    def set_user_language(self, user_id: int, language: str):
+        """Set user language setting"""
+        self.user_languages[user_id] = language
+        user_store.set_language(user_id, language)
+    
     def get_text(self, user_id: int, key: str) -> str:
         """Get text based on user language"""
         lang = self.get_user_language(user_id)
@@ -286,6 +361,7 @@ class VIPStockBot:
     
     def check_user_tier(self, user_id: int) -> str:
         """Check user tier - Free, VIP, or VIC"""
+        self._sync_users()
         if user_id in self.vic_users:
             return "vic"
         elif user_id in self.vip_users:
@@ -299,13 +375,16 @@ class VIPStockBot:
             if tier == "vip":
                 self.vip_users.add(user_id)
                 self.vic_users.discard(user_id)  # Remove from higher tier
+                user_store.set_tier(user_id, tier)
                 logger.info(f"Added user {user_id} to VIP")
                 return True
             elif tier == "vic":
                 self.vic_users.add(user_id)
                 self.vip_users.discard(user_id)  # Remove from lower tier
+                user_store.set_tier(user_id, tier)
                 if email:
                     self.vic_emails[user_id] = email
+                    user_store.set_email(user_id, email)
                     logger.info(f"Added user {user_id} to VIC with email {email}")
                 else:
                     logger.info(f"Added user {user_id} to VIC without email")
@@ -321,6 +400,8 @@ class VIPStockBot:
             self.vip_users.discard(user_id)
             self.vic_users.discard(user_id)
             self.vic_emails.pop(user_id, None)
+            user_store.set_tier(user_id, None)
+            user_store.set_email(user_id, None)
             logger.info(f"Removed user {user_id} from all tiers")
             return True
         except Exception as e:
@@ -332,21 +413,42 @@ class VIPStockBot:
         user_tier = self.check_user_tier(user_id)
         
         # VIP users have no limit
-        if user_tier in ["basic", "vic"]:
+        if user_tier in ["vip", "vic"]:
             return True, 0
         
         # Reset if needed
         if datetime.now(self.taipei) >= self.daily_reset_time:
             self.reset_daily_queries()
         
-        current_count = self.user_queries.get(user_id, 0)
-        return current_count < 3, current_count
+        current_count = query_quota.used(user_id)
+        return current_count < query_quota.limit, current_count
     
-    def increment_user_query(self, user_id: int):
-        """Increment user query count"""
+    def increment_user_query(self, user_id: int) -> bool:
+        """Atomically take one daily query; False when the free quota is already used up
+        
+        The counter is shared by every worker (Redis INCR + EXPIREAT at the Taipei reset),
+        so a check in one worker can't be raced by another.
+        """
         user_tier = self.check_user_tier(user_id)
         if user_tier == "free":
-            self.user_queries[user_id] = self.user_queries.get(user_id, 0) + 1
+            allowed, count = query_quota.try_consume(user_id)
+            self.user_queries[user_id] = count
+            if not query_quota.shared:
+                user_store.set_query_count(self._query_day(), user_id, count)
+            return allowed
+        return True
+    
+    def refund_user_query(self, user_id: int):
+        """Give back a query taken by increment_user_query when the analysis never ran"""
+        if self.check_user_tier(user_id) == "free":
+            count = query_quota.refund(user_id)
+            self.user_queries[user_id] = count
+            if not query_quota.shared:
+                user_store.set_query_count(self._query_day(), user_id, count)
+    
+    def get_broadcast_recipients(self) -> List[int]:
+        """Every user the bot knows about: paid tiers plus anyone who queried or picked a language"""
+        return sorted(self.vic_users | self.vip_users | set(self.user_languages) | set(self.user_queries))
     
     def reset_daily_queries(self):
         """Reset daily query counts"""
@@ -359,7 +461,7 @@ class VIPStockBot:
         user_tier = self.check_user_tier(user_id)
         
         # VIP users can query anytime
-        if user_tier in ["basic", "vic"]:
+        if user_tier in ["vip", "vic"]:
             return True, "vip_access"
         
         # Free users need to check time window
@@ -377,12 +479,12 @@ class VIPStockBot:
         else:
             return False, "too_late"
     
-    def get_sp500_symbols(self) -> List[str]:
+    def get_sp500_symbols(self) -> FrozenSet[str]:
         """Get S&P 500 + popular stocks for free users"""
-        if self.sp500_symbols:
+        if self.sp500_symbols is not None and self._universe_version == sp500_universe.version:
             return self.sp500_symbols
         
-        # S&P 500 major stocks + popular IPOs
+        # Popular names outside (or on top of) the S&P 500 snapshot
         symbols = [
             # Tech giants
             'AAPL', 'MSFT', 'GOOGL', 'GOOG', 'AMZN', 'TSLA', 'META', 'NVDA', 'ORCL', 'CRM',
@@ -404,14 +506,19 @@ class VIPStockBot:
             'SPY', 'QQQ', 'ARKK', 'VTI', 'VOO'
         ]
         
-        self.sp500_symbols = sorted(list(set(symbols)))
+        self.sp500_symbols = sp500_universe.symbols | frozenset(symbols)
+        self.all_symbols = None
+        self._universe_version = sp500_universe.version
         logger.info(f"Loaded {len(self.sp500_symbols)} symbols for free users")
         return self.sp500_symbols
     
-    def get_all_symbols(self) -> List[str]:
+    def get_all_symbols(self) -> FrozenSet[str]:
         """Get all symbols for VIP users (simplified for demo)"""
         # In production, this would be a much larger list
         basic_symbols = self.get_sp500_symbols()
+        if self.all_symbols is not None:
+            return self.all_symbols
+        
         additional_symbols = [
             # Small cap growth
             'ROKU', 'TWLO', 'OKTA', 'DDOG', 'NET', 'FSLY', 'ESTC', 'MDB', 'TEAM',
@@ -422,51 +529,75 @@ class VIPStockBot:
             # Additional ETFs
             'IWM', 'VXX', 'SQQQ', 'ARKQ', 'ARKG', 'ARKW'
         ]
-        return basic_symbols + additional_symbols
+        self.all_symbols = basic_symbols | frozenset(additional_symbols)
+        return self.all_symbols
     
     async def get_stock_data_multi_source(self, symbol: str) -> Optional[Dict]:
-        """Get stock data with multiple API fallbacks"""
-        data_sources = [
-            self._get_finnhub_data,
-            self._get_polygon_data,
-            self._get_yahoo_data,
-            self._get_alpha_vantage_data
-        ]
-        
-        for i, source_func in enumerate(data_sources):
+        """Get stock data with multiple API fallbacks, ordered by the provider router"""
+        # Subscribed symbols are served from the push feed without any REST call
+        streamed = quote_stream.get_quote(symbol)
+        if streamed:
+            return streamed
+        quote_stream.subscribe([symbol])
+        
+        for name in provider_router.order(list(self.data_sources)):
+            source_func = self.data_sources[name]
+            start = perf_counter()
             try:
-                logger.info(f"Trying data source {i+1} for {symbol}")
+                logger.info(f"Trying data source {name} for {symbol}")
                 data = await source_func(symbol)
                 if data:
-                    logger.info(f"Successfully got data from source {i+1}")
+                    provider_router.record_success(name, perf_counter() - start)
+                    logger.info(f"Successfully got data from {name}")
                     return data
+                provider_router.record_failure(name, perf_counter() - start, "empty response")
+            except RateLimitExceeded as e:
+                # Out of quota: fall through without counting it against the source
+                logger.info(f"Skipping data source {name} for {symbol}: {e}")
+                continue
             except Exception as e:
-                logger.warning(f"Data source {i+1} failed for {symbol}: {e}")
+                provider_router.record_failure(name, perf_counter() - start, e)
+                logger.warning(f"Data source {name} failed for {symbol}: {e}")
                 continue
         
         logger.error(f"All data sources failed for {symbol}")
         return None
     
+    async def _fetch_json(self, provider: str, url: str) -> Optional[Dict]:
+        """Rate-limited GET returning JSON; identical concurrent URLs share one upstream call"""
+        async def fetch():
+            await rate_limiter.acquire_async(provider)
+            async with aiohttp.ClientSession() as session:
+                async with session.get(replay.url(url), timeout=10) as response:
+                    body = await response.text()
+                    replay.record(url, response.status, body)
+                    if response.status == 429:
+                        rate_limiter.drain(provider)
+                    elif response.status == 200:
+                        return json.loads(body)
+            return None
+        
+        return await request_coalescer.run(url, fetch)
+    
     async def _get_finnhub_data(self, symbol: str) -> Optional[Dict]:
         """Get data from Finnhub API"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"https://finnhub.io/api/v1/quote?symbol={symbol}&token={self.finnhub_key}"
-                async with session.get(url, timeout=10) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get('c'):  # Current price exists
-                            return {
-                                'source': 'Finnhub',
-                                'current_price': float(data['c']),
-                                'change': float(data['d']),
-                                'change_percent': float(data['dp']),
-                                'high': float(data['h']),
-                                'low': float(data['l']),
-                                'open': float(data['o']),
-                                'previous_close': float(data['pc']),
-                                'timestamp': datetime.now()
-                            }
+            url = f"https://finnhub.io/api/v1/quote?symbol={symbol}&token={self.finnhub_key}"
+            data = await self._fetch_json('finnhub', url)
+            if data and data.get('c'):  # Current price exists
+                return {
+                    'source': 'Finnhub',
+                    'current_price': float(data['c']),
+                    'change': float(data['d']),
+                    'change_percent': float(data['dp']),
+                    'high': float(data['h']),
+                    'low': float(data['l']),
+                    'open': float(data['o']),
+                    'previous_close': float(data['pc']),
+                    'timestamp': datetime.now()
+                }
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Finnhub API error: {e}")
         return None
@@ -474,26 +605,25 @@ class VIPStockBot:
     async def _get_polygon_data(self, symbol: str) -> Optional[Dict]:
         """Get data from Polygon API"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"https://api.polygon.io/v2/aggs/ticker/{symbol}/prev?adjusted=true&apikey={self.polygon_key}"
-                async with session.get(url, timeout=10) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get('results') and len(data['results']) > 0:
-                            result = data['results'][0]
-                            current_price = float(result['c'])
-                            open_price = float(result['o'])
-                            return {
-                                'source': 'Polygon',
-                                'current_price': current_price,
-                                'change': current_price - open_price,
-                                'change_percent': ((current_price - open_price) / open_price) * 100,
-                                'high': float(result['h']),
-                                'low': float(result['l']),
-                                'open': open_price,
-                                'volume': int(result['v']),
-                                'timestamp': datetime.now()
-                            }
+            url = f"https://api.polygon.io/v2/aggs/ticker/{symbol}/prev?adjusted=true&apikey={self.polygon_key}"
+            data = await self._fetch_json('polygon', url)
+            if data and data.get('results') and len(data['results']) > 0:
+                result = data['results'][0]
+                current_price = float(result['c'])
+                open_price = float(result['o'])
+                return {
+                    'source': 'Polygon',
+                    'current_price': current_price,
+                    'change': current_price - open_price,
+                    'change_percent': ((current_price - open_price) / open_price) * 100,
+                    'high': float(result['h']),
+                    'low': float(result['l']),
+                    'open': open_price,
+                    'volume': int(result['v']),
+                    'timestamp': datetime.now()
+                }
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Polygon API error: {e}")
         return None
@@ -501,8 +631,8 @@ class VIPStockBot:
     async def _get_yahoo_data(self, symbol: str) -> Optional[Dict]:
         """Get data from Yahoo Finance (fallback)"""
         try:
-            ticker = yf.Ticker(symbol)
-            hist = ticker.history(period="2d")
+            # Only the bars after the last stored date are fetched
+            hist = history_store.get_history(symbol, days=2, max_age=60)
             if not hist.empty:
                 current_price = float(hist['Close'].iloc[-1])
                 previous_close = float(hist['Close'].iloc[-2]) if len(hist) > 1 else current_price
@@ -518,6 +648,8 @@ class VIPStockBot:
                     'volume': int(hist['Volume'].iloc[-1]),
                     'timestamp': datetime.now()
                 }
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Yahoo Finance error: {e}")
         return None
@@ -525,106 +657,54 @@ class VIPStockBot:
     async def _get_alpha_vantage_data(self, symbol: str) -> Optional[Dict]:
         """Get data from Alpha Vantage API"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={symbol}&apikey={self.alpha_vantage_key}"
-                async with session.get(url, timeout=10) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        quote = data.get('Global Quote', {})
-                        if quote:
-                            current_price = float(quote.get('05. price', 0))
-                            change = float(quote.get('09. change', 0))
-                            if current_price > 0:
-                                return {
-                                    'source': 'Alpha Vantage',
-                                    'current_price': current_price,
-                                    'change': change,
-                                    'change_percent': float(quote.get('10. change percent', '0%').replace('%', '')),
-                                    'high': float(quote.get('03. high', 0)),
-                                    'low': float(quote.get('04. low', 0)),
-                                    'open': float(quote.get('02. open', 0)),
-                                    'volume': int(quote.get('06. volume', 0)),
-                                    'timestamp': datetime.now()
-                                }
+            url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={symbol}&apikey={self.alpha_vantage_key}"
+            data = await self._fetch_json('alpha_vantage', url)
+            quote = (data or {}).get('Global Quote', {})
+            if quote:
+                current_price = float(quote.get('05. price', 0))
+                change = float(quote.get('09. change', 0))
+                if current_price > 0:
+                    return {
+                        'source': 'Alpha Vantage',
+                        'current_price': current_price,
+                        'change': change,
+                        'change_percent': float(quote.get('10. change percent', '0%').replace('%', '')),
+                        'high': float(quote.get('03. high', 0)),
+                        'low': float(quote.get('04. low', 0)),
+                        'open': float(quote.get('02. open', 0)),
+                        'volume': int(quote.get('06. volume', 0)),
+                        'timestamp': datetime.now()
+                    }
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             logger.error(f"Alpha Vantage API error: {e}")
         return None
     
-    def calculate_technical_indicators(self, symbol: str, user_tier: str) -> Dict:
-        """Calculate ALL technical indicators for ALL tiers - same analysis quality"""
+    def calculate_technical_indicators(self, symbol: str, user_tier: str, stock_data: Optional[Dict] = None) -> Dict:
+        """Calculate ALL technical indicators for ALL tiers - same analysis quality
+        
+        Results are memoized per (symbol, last closed bar, indicator set version); a live
+        quote only re-evaluates the price-dependent fields.
+        """
         try:
-            ticker = yf.Ticker(symbol)
-            hist = ticker.history(period="50d")
+            hist = history_store.get_history(symbol, days=50)
             
             if hist.empty:
                 return {}
             
-            # All indicators for all users - no differentiation in analysis quality
-            close_prices = hist['Close']
-            volume = hist['Volume']
-            high_prices = hist['High']
-            low_prices = hist['Low']
-            
-            # RSI calculation
-            delta = close_prices.diff()
-            gain = delta.where(delta > 0, 0).rolling(window=14).mean()
-            loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
-            rs = gain / loss
-            rsi = 100 - (100 / (1 + rs))
-            
-            # Moving averages
-            ma20 = close_prices.rolling(window=20).mean()
-            ma50 = close_prices.rolling(window=50).mean()
-            
-            # MACD calculation
-            ema12 = close_prices.ewm(span=12).mean()
-            ema26 = close_prices.ewm(span=26).mean()
-            macd = ema12 - ema26
-            macd_signal = macd.ewm(span=9).mean()
-            
-            # Bollinger Bands
-            bb_period = 20
-            bb_std = 2
-            bb_middle = close_prices.rolling(window=bb_period).mean()
-            bb_std_dev = close_prices.rolling(window=bb_period).std()
-            bb_upper = bb_middle + (bb_std_dev * bb_std)
-            bb_lower = bb_middle - (bb_std_dev * bb_std)
-            
-            # Volume analysis
-            volume_ma = volume.rolling(window=20).mean()
-            volume_ratio = volume.iloc[-1] / volume_ma.iloc[-1] if not volume_ma.empty else 1
-            
-            # Support and Resistance levels
-            recent_high = high_prices.rolling(window=20).max()
-            recent_low = low_prices.rolling(window=20).min()
-            
-            indicators = {
-                'rsi': float(rsi.iloc[-1]) if not rsi.empty else 50,
-                'ma20': float(ma20.iloc[-1]) if not ma20.empty else 0,
-                'ma50': float(ma50.iloc[-1]) if not ma50.empty else 0,
-                'high_52w': float(hist['High'].max()),
-                'low_52w': float(hist['Low'].min()),
-                
-                # MACD indicators
-                'macd': float(macd.iloc[-1]) if not macd.empty else 0,
-                'macd_signal': float(macd_signal.iloc[-1]) if not macd_signal.empty else 0,
-                'macd_histogram': float((macd - macd_signal).iloc[-1]) if not macd.empty else 0,
-                
-                # Bollinger Bands
-                'bb_upper': float(bb_upper.iloc[-1]) if not bb_upper.empty else 0,
-                'bb_lower': float(bb_lower.iloc[-1]) if not bb_lower.empty else 0,
-                'bb_middle': float(bb_middle.iloc[-1]) if not bb_middle.empty else 0,
-                'bb_squeeze': float(bb_upper.iloc[-1] - bb_lower.iloc[-1]) if not bb_upper.empty else 0,
-                
-                # Volume indicators
-                'volume_ma': float(volume_ma.iloc[-1]) if not volume_ma.empty else 0,
-                'volume_ratio': float(volume_ratio) if volume_ratio else 1,
-                'volume_trend': 'High' if volume_ratio > 1.5 else 'Normal' if volume_ratio > 0.5 else 'Low',
-                
-                # Support/Resistance
-                'resistance_level': float(recent_high.iloc[-1]) if not recent_high.empty else 0,
-                'support_level': float(recent_low.iloc[-1]) if not recent_low.empty else 0
-            }
+            # All indicators for all users - no differentiation in analysis quality.
+            # Per-symbol streaming state: only bars after the last call are applied.
+            live = None
+            # Polygon's /prev aggregate is the previous session, not a live price
+            if stock_data and stock_data.get('current_price') and stock_data.get('source') != 'Polygon':
+                live = {
+                    'price': stock_data['current_price'],
+                    'high': stock_data.get('high'),
+                    'low': stock_data.get('low'),
+                    'volume': stock_data.get('volume'),
+                }
+            indicators = indicator_engine.compute(symbol, hist, live)
             
             return indicators
             
@@ -743,9 +823,48 @@ class VIPStockBot:
             'analyst': f'Maggie AI {user_tier.upper()}'
         }
     
+    def analysis_features(self, user_tier: str) -> FrozenSet[str]:
+        """Data sets an analysis fetches for a tier; tiers with the same set share one run"""
+        return frozenset({'fundamentals'}) if user_tier in ["vip", "vic"] else frozenset()
+    
     async def analyze_stock(self, symbol: str, user_id: int) -> Optional[Dict]:
-        """Main stock analysis function"""
+        """Main stock analysis function
+        
+        Concurrent requests for the same symbol and feature set attach to the running
+        analysis, and later ones in the same time bucket reuse its result; only the
+        tier labels are stamped per user.
+        """
         user_tier = self.check_user_tier(user_id)
+        key = (symbol, self.analysis_features(user_tier))
+        bucket = int(datetime.now().timestamp() // ANALYSIS_BUCKET_SECONDS)
+        
+        task = self._inflight_analyses.get(key)
+        recent = self._recent_analyses.get(key)
+        if task is None and recent is not None and recent['bucket'] == bucket:
+            self.analysis_stats['reused'] += 1
+            analysis = recent
+        else:
+            if task is None:
+                self.analysis_stats['runs'] += 1
+                # A separate task, so a cancelled leader doesn't cancel everyone attached to it
+                task = asyncio.create_task(self._run_analysis(symbol, user_tier, key[1], bucket))
+                self._inflight_analyses[key] = task
+                task.add_done_callback(lambda _: self._inflight_analyses.pop(key, None))
+            else:
+                self.analysis_stats['coalesced'] += 1
+            analysis = await asyncio.shield(task)
+        
+        if not analysis:
+            return None
+        return {
+            **analysis,
+            'user_tier': user_tier,
+            'ai_analysis': {**analysis['ai_analysis'], 'analyst': f'Maggie AI {user_tier.upper()}'},
+        }
+    
+    async def _run_analysis(self, symbol: str, user_tier: str, features: FrozenSet[str],
+                            bucket: int) -> Optional[Dict]:
+        """One analysis run, shared by every request attached to it"""
         start_time = datetime.now()
         
         try:
@@ -755,21 +874,21 @@ class VIPStockBot:
                 return None
             
             # Calculate technical indicators
-            indicators = self.calculate_technical_indicators(symbol, user_tier)
+            indicators = self.calculate_technical_indicators(symbol, user_tier, stock_data)
             
             # Get company info for VIP users
             company_info = {}
-            if user_tier in ["basic", "vic"]:
+            if 'fundamentals' in features:
                 try:
-                    ticker = yf.Ticker(symbol)
-                    info = ticker.info
+                    # Fundamentals come from the daily-refreshed profile store, not ticker.info
+                    profile = profile_store.get_profile(symbol) or {}
                     company_info = {
-                        'name': info.get('shortName', symbol),
-                        'sector': info.get('sector', 'Unknown'),
-                        'industry': info.get('industry', 'Unknown'),
-                        'market_cap': info.get('marketCap'),
-                        'pe_ratio': info.get('trailingPE'),
-                        'beta': info.get('beta')
+                        'name': profile.get('name') or symbol,
+                        'sector': profile.get('sector') or 'Unknown',
+                        'industry': profile.get('industry') or 'Unknown',
+                        'market_cap': profile.get('market_cap'),
+                        'pe_ratio': profile.get('pe_ratio'),
+                        'beta': profile.get('beta')
                     }
                 except Exception as e:
                     logger.warning(f"Failed to get company info for {symbol}: {e}")
@@ -783,7 +902,7 @@ class VIPStockBot:
             # Calculate analysis time
             analysis_time = (datetime.now() - start_time).total_seconds()
             
-            return {
+            analysis = {
                 'symbol': symbol,
                 'user_tier': user_tier,
                 'stock_data': stock_data,
@@ -792,8 +911,12 @@ class VIPStockBot:
                 'ai_analysis': ai_analysis,
                 'mm_analysis': mm_analysis,
                 'analysis_time': analysis_time,
-                'timestamp': datetime.now(self.taipei).strftime('%Y-%m-%d %H:%M:%S') + ' 台北時間'
+                'timestamp': datetime.now(self.taipei).strftime('%Y-%m-%d %H:%M:%S') + ' 台北時間',
+                'version': next(self._analysis_versions),
+                'bucket': bucket
             }
+            self._recent_analyses[(symbol, features)] = analysis
+            return analysis
             
         except Exception as e:
             logger.error(f"Stock analysis failed for {symbol}: {e}")
@@ -814,6 +937,26 @@ class VIPStockBot:
             return f"${market_cap:,}"
     
     def format_analysis_report(self, analysis: Dict, user_id: int) -> str:
+        """Format the analysis report, reusing the text rendered for the same
+        analysis version, tier, language and time bucket"""
+        if not analysis or 'version' not in analysis:
+            return self._format_analysis_report(analysis, user_id)
+        
+        key = (analysis['version'], analysis['user_tier'], self.get_user_language(user_id), analysis['bucket'])
+        report = self._render_cache.get(key)
+        if report is not None:
+            self.render_stats['hits'] += 1
+            self._render_cache.move_to_end(key)
+            return report
+        
+        self.render_stats['misses'] += 1
+        report = self._format_analysis_report(analysis, user_id)
+        self._render_cache[key] = report
+        while len(self._render_cache) > RENDER_CACHE_SIZE:
+            self._render_cache.popitem(last=False)
+        return report
+    
+    def _format_analysis_report(self, analysis: Dict, user_id: int) -> str:
         """Format the analysis report based on user tier"""
         if not analysis:
             return self.get_text(user_id, 'analysis_failed')
@@ -992,7 +1135,7 @@ VIP版讓你隨時掌握全市場投資機會。
 🤖 分析師: {ai_analysis['analyst']}
 🔥 VIC專業版用戶專享！感謝您的支持！"""
 
-        elif user_tier == "basic":
+        elif user_tier == "vip":
             # VIP Basic version with Market Maker analysis
             report = f"""💎 {symbol} Market Maker 專業分析 (VIP基礎版)
 📅 {analysis['timestamp']}
@@ -1314,7 +1457,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 感謝您選擇Maggie Stock AI VIC專業版！"""
     
-    elif user_tier == "basic":
+    elif user_tier == "vip":
         welcome_message = f"""💎 **歡迎回來，VIP基礎版用戶！**
 
 您正在享受專業級股票分析服務。
@@ -1383,7 +1526,7 @@ async def language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     selected_lang = language_codes.get(query.data)
     if selected_lang:
-        bot.user_languages[user_id] = selected_lang
+        bot.set_user_language(user_id, selected_lang)
         
         # Send confirmation in selected language
         if selected_lang == 'zh-TW':
@@ -1448,7 +1591,7 @@ async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 status_msg += f"📊 **股票覆蓋:** {len(supported_symbols)}支股票\n"
                 status_msg += f"🔍 **每日查詢:** {current_count}/3 次已使用\n"
                 status_msg += f"⏰ **分析時間:** 10分鐘深度報告\n"
-            elif user_tier == "basic":
+            elif user_tier == "vip":
                 status_msg += f"💎 **VIP基礎版** - 全美股{len(supported_symbols)}+支股票\n"
                 status_msg += f"🔍 **查詢限制:** 無限制\n"
                 status_msg += f"⏰ **分析時間:** 5分鐘快速分析\n"
@@ -1491,33 +1634,37 @@ async def stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(f"股票 {symbol} 暫時不支援，請稍後再試")
             return
         
-        # Increment query count
-        bot.increment_user_query(user_id)
+        # Take the query atomically; another worker may have used the last one since the check above
+        if not bot.increment_user_query(user_id):
+            upgrade_prompt = bot.get_upgrade_prompt("query_limit")
+            await update.message.reply_text(upgrade_prompt)
+            return
         
         # Send processing message with tier-specific timing
         tier_info = {
             "free": {"time": "10分鐘深度分析", "badge": "🎯"},
-            "basic": {"time": "5分鐘快速分析", "badge": "💎"}, 
+            "vip": {"time": "5分鐘快速分析", "badge": "💎"}, 
             "vic": {"time": "30秒極速分析", "badge": "🔥"}
         }
         
         info = tier_info[user_tier]
+        queued = analysis_admission.position(user_tier)
         processing_msg = await update.message.reply_text(
             f"{info['badge']} **正在分析 {symbol}...**\n"
             f"⏰ **預計時間:** {info['time']}\n"
-            f"🤖 **Maggie AI {user_tier.upper()}:** 準備專業建議"
+            + (f"👥 **排隊中:** 前方 {queued} 位\n" if queued else "")
+            + f"🤖 **Maggie AI {user_tier.upper()}:** 準備專業建議"
         )
         
-        # Simulate analysis time based on tier
-        if user_tier == "free":
-            await asyncio.sleep(2)  # 2 seconds for demo
-        elif user_tier == "basic":
-            await asyncio.sleep(1)  # 1 second for demo
-        else:  # vic
-            await asyncio.sleep(0.5)  # 0.5 seconds for demo
-        
-        # Perform analysis with REAL data only
-        analysis = await bot.analyze_stock(symbol, user_id)
+        # Perform analysis with REAL data only; admission is weighted by tier
+        try:
+            async with analysis_admission.admit(user_tier):
+                analysis = await bot.analyze_stock(symbol, user_id)
+        except AdmissionRejected:
+            # The query never ran, so it doesn't count against the daily quota
+            bot.refund_user_query(user_id)
+            await processing_msg.edit_text("⏳ **目前查詢人數過多**\n\n請稍後再試（本次不計入查詢次數）")
+            return
         
         if analysis:
             # Verify we have real data before proceeding
@@ -1586,7 +1733,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 感謝您選擇VIC專業版服務！"""
         
-    elif user_tier == "basic":
+    elif user_tier == "vip":
         status_msg = f"""💎 **VIP基礎版用戶狀態**
 
 👤 **用戶等級:** VIP基礎版
@@ -1650,7 +1797,7 @@ async def upgrade_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "您正在享受最高等級的服務。\n"
             "感謝您的支持！如有任何問題請聯繫客服。"
         )
-    elif user_tier == "basic":
+    elif user_tier == "vip":
         upgrade_message = """💎 **升級到VIC專業版**
 
 您目前是VIP基礎版用戶，考慮升級到專業版嗎？
@@ -1740,7 +1887,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 **🆘 VIC專業版客服**
 @maggie_investment"""
         
-    elif user_tier == "basic":
+    elif user_tier == "vip":
         help_message = """📚 **VIP基礎版使用指南**
 
 **🔧 VIP基礎版命令**
@@ -1800,8 +1947,8 @@ async def admin_add_vip_command(update: Update, context: ContextTypes.DEFAULT_TY
     
     if len(context.args) < 2:
         await update.message.reply_text(
-            "**用法:** /admin_add_vip [用戶ID] [basic/vic]\n"
-            "**例如:** /admin_add_vip 123456789 basic"
+            "**用法:** /admin_add_vip [用戶ID] [vip/vic]\n"
+            "**例如:** /admin_add_vip 123456789 vip"
         )
         return
     
@@ -1809,8 +1956,8 @@ async def admin_add_vip_command(update: Update, context: ContextTypes.DEFAULT_TY
         target_user_id = int(context.args[0])
         tier = context.args[1].lower()
         
-        if tier not in ["basic", "vic"]:
-            await update.message.reply_text("❌ 等級必須是 basic 或 vic")
+        if tier not in ["vip", "vic"]:
+            await update.message.reply_text("❌ 等級必須是 vip 或 vic")
             return
         
         if bot.add_vip_user(target_user_id, tier):
@@ -1858,6 +2005,72 @@ async def admin_remove_vip_command(update: Update, context: ContextTypes.DEFAULT
     except Exception as e:
         await update.message.reply_text(f"❌ 移除失敗: {e}")
 
+def format_router_status() -> str:
+    """Format provider router state for /admin_status"""
+    state_emoji = {'closed': '🟢', 'half_open': '🟡', 'open': '🔴'}
+    quotas = rate_limiter.get_stats()
+    lines = []
+    for row in provider_router.snapshot():
+        latency = f"{row['ewma_latency_ms']}ms" if row['ewma_latency_ms'] is not None else "—"
+        line = f"• {state_emoji.get(row['state'], '⚪')} {row['name']}: 延遲 {latency} | 錯誤率 {row['error_rate']:.0%} | 呼叫 {row['calls']}次"
+        quota = quotas.get(row['name'])
+        if quota and quota['available'] is not None:
+            line += f" | 配額 {quota['available']:.0f}/{quota['per_minute']}每分"
+        if row['cooldown_remaining']:
+            line += f" | 熔斷剩餘 {row['cooldown_remaining']}秒"
+        lines.append(line)
+    return "\n".join(lines) or "• 尚無數據"
+
+def format_render_status() -> str:
+    """Format rendered-report cache hit rate for /admin_status"""
+    stats = bot.render_stats
+    served = stats['hits'] + stats['misses']
+    hit_rate = f"{stats['hits'] / served:.0%}" if served else "—"
+    return f"命中率 {hit_rate} ({stats['hits']}/{served}) | 快取 {len(bot._render_cache)}份"
+
+def format_admission_status() -> str:
+    """Format per-tier analysis queue and SLO state for /admin_status"""
+    lines = []
+    for tier, row in analysis_admission.get_stats()['tiers'].items():
+        wait = f"{row['wait_p95_ms']}ms" if row['wait_p95_ms'] is not None else "—"
+        slo = f"{row['slo_met']:.0%}" if row['slo_met'] is not None else "—"
+        lines.append(f"• {tier.upper()}: 執行 {row['running']}/{row['cap']} | 排隊 {row['waiting']} | "
+                     f"等待P95 {wait} | SLO({row['slo_seconds']}秒)達成 {slo} | 拒絕 {row['rejected']}")
+    return "\n".join(lines)
+
+def format_broadcast_status() -> str:
+    """Format the last broadcast's throughput for /admin_status"""
+    report = broadcaster.last_report
+    if not report:
+        return "• 尚無推播"
+    return (f"• {report['id']}: 送出 {report['sent']} | 失敗 {report['failed']} | 未確認 {report.get('unconfirmed', 0)} | 續傳跳過 {report['skipped']} | "
+            f"{report['elapsed_seconds']}秒 ({report['per_second'] or '—'} 則/秒)")
+
+def format_user_store_status() -> str:
+    """Format write-behind user store state for /admin_status"""
+    stats = user_store.get_stats()
+    last = f"{stats['last_flush_ms']}ms" if stats['last_flush_ms'] is not None else "—"
+    return (f"{stats['backend']} | 待寫入 {stats['pending']}筆 | 已寫回 {stats['flushed_rows']}筆"
+            f"/{stats['flushes']}批 | 上次 {last} | 錯誤 {stats['errors']}")
+
+def format_quota_status() -> str:
+    """Format daily quota counter state for /admin_status"""
+    stats = query_quota.get_stats()
+    return (f"{stats['backend']} | 每日 {stats['limit']}次 | 允許 {stats['allowed']} | "
+            f"拒絕 {stats['denied']} | 錯誤 {stats['errors']}")
+
+def format_stream_status() -> str:
+    """Format push quote feed state for /admin_status"""
+    stats = quote_stream.get_stats()
+    served = stats['hits'] + stats['misses']
+    hit_rate = f"{stats['hits'] / served:.0%}" if served else "—"
+    return (f"• {'🟢 已連線' if stats['connected'] else '🔴 未連線'} | 訂閱 {stats['subscribed']}支 | "
+            f"成交 {stats['trades']}筆 | 命中率 {hit_rate} | 重連 {stats['reconnects']}次")
+
+async def start_quote_stream(application: Application):
+    """Start the push quote feed once the bot's event loop is running"""
+    quote_stream.start()
+
 async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to check system status"""
     admin_ids = [981883005]  # Maggie.L's admin ID
@@ -1870,9 +2083,11 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
         status_msg = f"""🔧 **系統狀態報告**
 
 📊 **用戶統計**
-• VIC專業版用戶: {len(bot.vic_pro_users)}人
-• VIP基礎版用戶: {len(bot.vip_basic_users)}人
+• VIC專業版用戶: {len(bot.vic_users)}人
+• VIP基礎版用戶: {len(bot.vip_users)}人
 • 今日查詢記錄: {len(bot.user_queries)}筆
+• 用戶儲存: {format_user_store_status()}
+• 查詢配額: {format_quota_status()}
 
 🕐 **系統時間**
 • 台北時間: {datetime.now(bot.taipei).strftime('%Y-%m-%d %H:%M:%S')}
@@ -1883,6 +2098,22 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
 • 免費版股票: {len(bot.get_sp500_symbols())}支
 • VIP版股票: {len(bot.get_all_symbols())}支
 
+📡 **數據源路由** (依預期成本排序)
+{format_router_status()}
+
+📶 **報價串流**
+{format_stream_status()}
+
+🧮 **分析合併**
+• 實際分析 {bot.analysis_stats['runs']}次 | 合併請求 {bot.analysis_stats['coalesced']}次 | 時段內重用 {bot.analysis_stats['reused']}次
+• 報告渲染快取: {format_render_status()}
+
+🚦 **分析佇列** (加權公平排程)
+{format_admission_status()}
+
+📣 **最近推播**
+{format_broadcast_status()}
+
 🤖 **系統狀態:** 🟢 正常運行"""
         
         await update.message.reply_text(status_msg)
@@ -1892,28 +2123,37 @@ async def admin_status_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # Scheduled tasks
 async def send_mag7_report_to_all(context: ContextTypes.DEFAULT_TYPE):
-    """Send MAG7 report to all users (placeholder for actual implementation)"""
+    """Send MAG7 report to all users
+    
+    The broadcast id is the Taipei slot (e.g. mag7-20250101-08), so a restart inside
+    the same window resumes from the checkpoint instead of messaging everyone twice.
+    """
     try:
         report = await bot.generate_mag7_report()
         logger.info("MAG7 report generated successfully for scheduled broadcast")
         
-        # In a real implementation, you would:
-        # 1. Fetch all subscribed user IDs from database
-        # 2. Send report to each user
-        # 3. Handle rate limits and failures
-        
-        # For now, just log the report generation
-        # all_users = get_all_users_from_database()
-        # for user_id in all_users:
-        #     try:
-        #         await context.bot.send_message(chat_id=user_id, text=report)
-        #         await asyncio.sleep(0.05)  # Rate limiting
-        #     except Exception as e:
-        #         logger.error(f"Failed to send MAG7 report to {user_id}: {e}")
+        broadcast_id = f"mag7-{datetime.now(bot.taipei).strftime('%Y%m%d-%H')}"
+        await broadcaster.broadcast(
+            broadcast_id, report, bot.get_broadcast_recipients(),
+            lambda chat_id, text: context.bot.send_message(chat_id=chat_id, text=text)
+        )
         
     except Exception as e:
         logger.error(f"Failed to generate/send MAG7 report: {e}")
 
+async def refresh_history_store(context: ContextTypes.DEFAULT_TYPE):
+    """Append the latest daily bar for every supported symbol, then recompute batch indicators"""
+    try:
+        await asyncio.to_thread(sp500_universe.refresh)
+        result = await asyncio.to_thread(history_store.refresh, bot.get_all_symbols())
+        refreshed = sorted(symbol for symbol, bars in result.items() if bars)
+        logger.info(f"History store refreshed: {len(refreshed)}/{len(result)} symbols")
+        # Cross-sectional RSI/MACD/Bollinger in one vectorized pass, only over symbols synced today;
+        # a stale row would be misaligned with the latest date column
+        await asyncio.to_thread(compute_universe, refreshed)
+    except Exception as e:
+        logger.error(f"Failed to refresh history store: {e}")
+
 def setup_webhook():
     """Setup webhook for production deployment"""
     try:
@@ -1952,7 +2192,8 @@ def main():
     """Main function to run the bot"""
     logger.info("Starting Maggie Stock AI VIP-Enabled Bot...")
     
-    # Initialize stock lists
+    # Initialize stock lists (local snapshot now, conditional refresh in the background)
+    sp500_universe.refresh_in_background()
     free_symbols = bot.get_sp500_symbols()
     vip_symbols = bot.get_all_symbols()
     logger.info(f"Loaded {len(free_symbols)} free stocks, {len(vip_symbols)} VIP stocks")
@@ -1963,8 +2204,15 @@ def main():
     # Clear existing webhook
     clear_webhook()
     
-    # Build application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Build application. Updates must be handled concurrently, otherwise PTB serializes them
+    # and the admission queue (tier weights, caps, SLO) never sees more than one job.
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(MAX_CONCURRENCY + MAX_WAITING * len(TIER_WEIGHTS))
+        .post_init(start_quote_stream)
+        .build()
+    )
     
     # Register command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -1996,6 +2244,13 @@ def main():
                 timezone=taipei_tz
             )
         
+        # Daily OHLCV delta sync after the US close
+        job_queue.run_daily(
+            refresh_history_store,
+            time(5, 30),
+            timezone=taipei_tz
+        )
+        
         # Daily reset
         job_queue.run_daily(
             lambda context: bot.reset_daily_queries(), 
@@ -1,17 +1,21 @@
 cat > server.py << 'EOF'
 # server.py  — FastAPI Webhook server for Telegram (Render/Railway ready)
-import os, asyncio, logging
+import os, asyncio, logging, time
+from collections import OrderedDict, deque
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, PlainTextResponse
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 
-from src.provider_yahoo import YahooProvider
+from src.provider_yahoo import AsyncYahooProvider
 from src.provider_ipo import IPOProvider
-from src.provider_search import yf_search
-from src.service import maxpain_handler, gex_handler
+from src.provider_search import yf_search, aclose_client
+from src.symbol_index import symbol_index
+# 行程池只跑 options_math 的純計算，子行程不必載入 provider / yfinance
+from src.options_math import max_pain_summary, gex_summary
 from src.analyzers import magnet_strength
 from src.strategy import gen_strategy
+from src.scheduler import scheduler, TaskRejected
 
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger("server")
@@ -19,10 +23,24 @@ logger = logging.getLogger("server")
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BRAND_NAME = os.getenv("BRAND_NAME", "Maggie's Stock AI")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # ex: https://你的域名/webhook
+QUOTE_DEADLINE = float(os.getenv("QUOTE_DEADLINE", "5"))      # 報價 / 到期日
+OPTIONS_DEADLINE = float(os.getenv("OPTIONS_DEADLINE", "8"))  # 期權鏈 Max Pain / GEX
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # set_webhook 的 secret_token，Telegram 會放在標頭回傳
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_CONSUMERS = int(os.getenv("UPDATE_CONSUMERS", "8"))
+SEEN_UPDATES = 10000  # 記住最近多少個 update_id 以去重
 
 app = FastAPI()
 tg_app = None
 
+# webhook 只驗證、去重、入列就回 200；實際處理交給背景 consumer，避免 Telegram 逾時重送
+update_queue: asyncio.Queue = None
+consumers = []
+seen_updates: "OrderedDict[int, None]" = OrderedDict()
+update_stats = {"received": 0, "duplicates": 0, "invalid": 0, "rejected": 0,
+                "processed": 0, "failed": 0, "busy": 0}
+update_lags = deque(maxlen=200)  # 入列到處理完成的秒數
+
 def _m(v): return "—" if v is None else f"${v:,.2f}"
 def _p(v): return "—" if v is None else f"{v:.2f}%"
 
@@ -41,13 +59,23 @@ async def find_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("用法：/find <關鍵字>")
     query = " ".join(context.args)
-    hits = await yf_search(query, limit=10, us_only=True)
+    # 先查本地索引，沒有可信結果才走網路搜尋，並把結果併回索引
+    hits, confident = symbol_index.lookup(query, limit=10)
+    if not confident:
+        try:
+            remote = await yf_search(query, limit=10, us_only=True)
+            symbol_index.learn(remote)
+            seen = {h['symbol'] for h in remote}
+            hits = (remote + [h for h in hits if h['symbol'] not in seen])[:10]
+        except Exception as e:
+            logger.warning(f"網路搜尋失敗，改用本地結果: {e}")
     if not hits:
         return await update.message.reply_text("找不到相符的美股代號，換個關鍵字試試？")
     lines = ["🔎 搜尋結果（美股）："]
     for h in hits:
         nm = f" — {h['name']}" if h['name'] else ""
-        lines.append(f"• {h['symbol']}{nm} 〔{h['exchDisp']}/{h['type']}〕")
+        tag = f"{h['exchDisp']}/{h['type']}" if h['exchDisp'] else h['type']
+        lines.append(f"• {h['symbol']}{nm} 〔{tag}〕")
     lines.append("\n👉 接著可輸入：/stock 代號 例：/stock TSLA")
     await update.message.reply_text("\n".join(lines))
 
@@ -55,17 +83,52 @@ async def stock_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("用法：/stock <TICKER>")
     symbol = context.args[0].upper()
-    yp = YahooProvider()
-    q = yp.get_quote(symbol)
-    spot = q.get("price")
+    yp = AsyncYahooProvider()
+    try:
+        q = await asyncio.wait_for(yp.get_stock_data(symbol), QUOTE_DEADLINE)
+    except asyncio.TimeoutError:
+        return await update.message.reply_text(f"⏱️ {symbol} 報價逾時，請稍後再試")
+    except Exception as e:
+        # 代號格式錯誤（ValueError）或所有報價來源都失敗
+        logger.warning(f"/stock {symbol} 報價失敗: {e}")
+        return await update.message.reply_text(f"❌ 無法取得 {symbol} 報價：{e}")
+    if "error" in q:
+        return await update.message.reply_text(f"❌ 無法取得 {symbol} 報價：{q['error']}")
+    spot = q.get("current_price")
     prev_close = q.get("previous_close")
     chg = q.get("change")
-    chg_pct = q.get("change_pct")
+    chg_pct = q.get("change_percent")
 
-    expiry = yp.nearest_expiry(symbol)
-    mp = maxpain_handler(symbol, expiry)
-    gex, support, resistance = gex_handler(symbol, expiry, spot=spot or 0.0)
-    magnet = magnet_strength(spot or mp['max_pain'], mp['max_pain'])
+    try:
+        expiry = await asyncio.wait_for(yp.nearest_expiry(symbol), QUOTE_DEADLINE)
+    except Exception as e:
+        # 逾時或上游錯誤：沒有到期日就只顯示報價部分
+        logger.warning(f"/stock {symbol} 取得到期日失敗: {type(e).__name__} {e}")
+        expiry = None
+    # 期權鏈在 I/O 池抓一次，Max Pain / GEX 的逐履約價計算交給 CPU 行程池並行；
+    # 逾時或被拒時用上次結果，沒有就顯示部分報告。沒有到期日時不計算也不沿用舊結果
+    mp = g = None
+    mp_fresh = g_fresh = False
+    if expiry:
+        started = time.monotonic()
+        chain, chain_fresh = await scheduler.run_cached("io", yp.get_options_chain, symbol, expiry, deadline=OPTIONS_DEADLINE,
+                                              key=symbol, cache_key=f"chain:{symbol}:{expiry}")
+        if chain is not None:
+            remaining = max(1.0, OPTIONS_DEADLINE - (time.monotonic() - started))
+            mp_job = scheduler.run_cached("cpu", max_pain_summary, symbol, expiry, chain, deadline=remaining,
+                                          key=symbol, cache_key=f"maxpain:{symbol}:{expiry}")
+            if spot is not None:
+                (mp, mp_fresh), (g, g_fresh) = await asyncio.gather(
+                    mp_job,
+                    scheduler.run_cached("cpu", gex_summary, symbol, expiry, spot, chain, deadline=remaining,
+                                         key=symbol, cache_key=f"gex:{symbol}:{expiry}"),
+                )
+            else:
+                # 報價沒有現價時 GEX 無從計算
+                mp, mp_fresh = await mp_job
+            mp_fresh, g_fresh = mp_fresh and chain_fresh, g_fresh and chain_fresh
+    max_pain = mp['max_pain'] if mp else None
+    gex, support, resistance = g if g else (None, None, None)
 
     mood = "📊 震盪整理"
     if chg_pct is not None:
@@ -73,11 +136,6 @@ async def stock_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif chg_pct >= 0.3:   mood = "📈 上行偏多"
         else:                  mood = "📉 下行偏空"
 
-    strategy_text = gen_strategy(
-        symbol=symbol, spot=spot or mp['max_pain'],
-        max_pain=mp['max_pain'], support=support, resistance=resistance
-    )
-
     lines = []
     lines.append(f"🆓 免費版美股查詢 @{context.bot.username}")
     lines.append("")
@@ -86,22 +144,37 @@ async def stock_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lines.append(f"💰 {_m(prev_close)} ({_m(chg)} | {_p(chg_pct)})")
     lines.append(mood)
     lines.append("")
-    lines.append(f"📍 {symbol}: {_m(spot)} {magnet} (距離: {_m(abs((spot or 0) - mp['max_pain']))})")
+    if max_pain is not None:
+        magnet = magnet_strength(spot or max_pain, max_pain)
+        lines.append(f"📍 {symbol}: {_m(spot)} {magnet} (距離: {_m(abs((spot or 0) - max_pain))})")
+    else:
+        lines.append(f"📍 {symbol}: {_m(spot)} (Max Pain: —)")
     lines.append("")
     lines.append("⚡ Gamma 支撐阻力位")
     lines.append(f"🛡️ {symbol}: 支撐 {_m(support)} | 阻力 {_m(resistance)}")
-    lines.append(f"💵 Dollar Gamma (1%): {gex.dollar_gamma_1pct:,.0f}")
-    lines.append("")
-    lines.append(strategy_text)
+    lines.append(f"💵 Dollar Gamma (1%): {'—' if gex is None else format(gex['dollar_gamma_1pct'], ',.0f')}")
     lines.append("")
+    if max_pain is not None and support is not None and resistance is not None:
+        lines.append(gen_strategy(
+            symbol=symbol, spot=spot or max_pain,
+            max_pain=max_pain, support=support, resistance=resistance
+        ))
+        lines.append("")
     lines.append("🆕 本週IPO關注")
     lines.append("📅 YYYY公司 (YYYY): 8/20上市")
     lines.append("💰 發行價: $15-18")
     lines.append("📊 AI評估: 中性，建議觀察首日表現")
     lines.append("")
     lines.append("🤖 MM 行為預測")
-    lines.append(f"預計今日主力將在 Max Pain（{mp['max_pain']}）附近進行操控，注意{symbol}的量價配合表現。")
+    lines.append(f"預計今日主力將在 Max Pain（{_m(max_pain)}）附近進行操控，注意{symbol}的量價配合表現。")
     lines.append("")
+    if not expiry:
+        lines.append("⏱️ 暫時取不到期權到期日，Max Pain / Gamma 略過")
+        lines.append("")
+    elif not (mp_fresh and g_fresh):
+        stale = mp is not None or g is not None
+        lines.append("⏱️ 部分期權數據逾時，" + ("以上為最近一次結果" if stale else "暫無資料，請稍後再試"))
+        lines.append("")
     lines.append(f"— {BRAND_NAME}")
     await update.message.reply_text("\n".join(lines))
 
@@ -109,9 +182,17 @@ async def maxpain_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("用法：/maxpain <TICKER> [YYYY-MM-DD]")
     symbol = context.args[0].upper()
-    yp = YahooProvider()
-    expiry = context.args[1] if len(context.args) > 1 else yp.nearest_expiry(symbol)
-    res = maxpain_handler(symbol, expiry)
+    yp = AsyncYahooProvider()
+    try:
+        expiry = context.args[1] if len(context.args) > 1 else await yp.nearest_expiry(symbol)
+        chain = await scheduler.run("io", yp.get_options_chain, symbol, expiry, deadline=OPTIONS_DEADLINE, key=symbol)
+        res = await scheduler.run("cpu", max_pain_summary, symbol, expiry, chain, deadline=OPTIONS_DEADLINE, key=symbol)
+    except (asyncio.TimeoutError, TaskRejected):
+        return await update.message.reply_text(f"⏱️ {symbol} 期權數據忙碌中，請稍後再試")
+    except Exception as e:
+        # 沒有到期日、期權鏈取不到或沒有未平倉量
+        logger.warning(f"/maxpain {symbol} 失敗: {type(e).__name__} {e}")
+        return await update.message.reply_text(f"❌ 無法取得 {symbol} 期權數據：{e}")
     await update.message.reply_text(
         f"🔎 {res['symbol']} {res['expiry']}\n"
         f"📍 Max Pain：{res['max_pain']}\n"
@@ -122,14 +203,22 @@ async def gex_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         return await update.message.reply_text("用法：/gex <TICKER> [YYYY-MM-DD]")
     symbol = context.args[0].upper()
-    yp = YahooProvider()
-    expiry = context.args[1] if len(context.args) > 1 else yp.nearest_expiry(symbol)
-    spot = yp.get_spot(symbol)['price']
-    g, s, r = gex_handler(symbol, expiry, spot=spot)
+    yp = AsyncYahooProvider()
+    try:
+        expiry = context.args[1] if len(context.args) > 1 else await yp.nearest_expiry(symbol)
+        spot = (await yp.get_stock_data(symbol))['current_price']
+        chain = await scheduler.run("io", yp.get_options_chain, symbol, expiry, deadline=OPTIONS_DEADLINE, key=symbol)
+        g, s, r = await scheduler.run("cpu", gex_summary, symbol, expiry, spot, chain, deadline=OPTIONS_DEADLINE, key=symbol)
+    except (asyncio.TimeoutError, TaskRejected):
+        return await update.message.reply_text(f"⏱️ {symbol} 期權數據忙碌中，請稍後再試")
+    except Exception as e:
+        # 報價 / 到期日 / 期權鏈任一取不到
+        logger.warning(f"/gex {symbol} 失敗: {type(e).__name__} {e}")
+        return await update.message.reply_text(f"❌ 無法取得 {symbol} 期權數據：{e}")
     await update.message.reply_text(
         f"🔎 {symbol} {expiry}\n"
-        f"📈 Share Gamma：{g.share_gamma:.2f}\n"
-        f"💵 Dollar Gamma (1%)：{g.dollar_gamma_1pct:,.0f}\n"
+        f"📈 Share Gamma：{g['share_gamma']:.2f}\n"
+        f"💵 Dollar Gamma (1%)：{g['dollar_gamma_1pct']:,.0f}\n"
         f"支撐 {s} | 阻力 {r}"
     )
 
@@ -158,9 +247,31 @@ async def ipo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(msg)
 
+async def consume_updates(n: int):
+    while True:
+        data, enqueued = await update_queue.get()
+        update_stats["busy"] += 1
+        try:
+            await tg_app.process_update(Update.de_json(data, tg_app.bot))
+            update_stats["processed"] += 1
+        except Exception as e:
+            update_stats["failed"] += 1
+            logger.error(f"consumer {n} 處理 update {data.get('update_id')} 失敗: {e}")
+        finally:
+            update_stats["busy"] -= 1
+            update_lags.append(time.monotonic() - enqueued)
+            update_queue.task_done()
+
+def webhook_stats() -> dict:
+    lags = sorted(update_lags)
+    p = lambda q: round(lags[min(len(lags) - 1, int(len(lags) * q))] * 1000) if lags else None
+    return dict(update_stats, queue_depth=update_queue.qsize() if update_queue else 0,
+                queue_max=UPDATE_QUEUE_SIZE, consumers=len(consumers),
+                lag_p50_ms=p(0.5), lag_p95_ms=p(0.95))
+
 @app.on_event("startup")
 async def on_startup():
-    global tg_app
+    global tg_app, update_queue
     if not TOKEN:
         raise RuntimeError("TELEGRAM_BOT_TOKEN 未設定")
     tg_app = ApplicationBuilder().token(TOKEN).updater(None).build()
@@ -173,32 +284,71 @@ async def on_startup():
     tg_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND,
                                       lambda u,c: u.message.reply_text("請輸入 /find 關鍵字 或 /stock TSLA")))
     await tg_app.initialize()
+    update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+    consumers.extend(asyncio.create_task(consume_updates(i)) for i in range(UPDATE_CONSUMERS))
     try:
         await tg_app.bot.delete_webhook(drop_pending_updates=True)
     except Exception:
         pass
     if WEBHOOK_URL:
-        await tg_app.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
+        await tg_app.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True, secret_token=WEBHOOK_SECRET)
         logger.info(f"Webhook set to {WEBHOOK_URL}")
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    if update_queue is not None:
+        # 給已入列的更新一點時間處理完
+        try:
+            await asyncio.wait_for(update_queue.join(), 10)
+        except asyncio.TimeoutError:
+            logger.warning(f"關閉時仍有 {update_queue.qsize()} 個更新未處理")
+    for task in consumers:
+        task.cancel()
     if tg_app:
         await tg_app.shutdown()
+    await aclose_client()
+    await AsyncYahooProvider.aclose()
+    scheduler.shutdown()
 
 @app.get("/health")
 async def health():
     return PlainTextResponse("ok")
 
+@app.get("/stats")
+async def stats():
+    return JSONResponse({**scheduler.get_stats(), "webhook": webhook_stats()})
+
 @app.get("/set-webhook")
 async def set_webhook(url: str):
-    await tg_app.bot.set_webhook(url=url, drop_pending_updates=True)
+    await tg_app.bot.set_webhook(url=url, drop_pending_updates=True, secret_token=WEBHOOK_SECRET)
     return JSONResponse({"ok": True, "url": url})
 
 @app.post("/webhook")
 async def telegram_webhook(req: Request):
-    data = await req.json()
-    update = Update.de_json(data, tg_app.bot)
-    await tg_app.process_update(update)
+    if WEBHOOK_SECRET and req.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        update_stats["invalid"] += 1
+        return JSONResponse({"ok": False}, status_code=403)
+    try:
+        data = await req.json()
+    except Exception:
+        data = None
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    if not isinstance(update_id, int):
+        update_stats["invalid"] += 1
+        return JSONResponse({"ok": False}, status_code=400)
+    update_stats["received"] += 1
+    if update_id in seen_updates:
+        # Telegram 重送的同一個更新
+        update_stats["duplicates"] += 1
+        return JSONResponse({"ok": True})
+    try:
+        update_queue.put_nowait((data, time.monotonic()))
+    except asyncio.QueueFull:
+        # 回非 2xx 讓 Telegram 稍後重送，而不是在這裡等
+        update_stats["rejected"] += 1
+        return JSONResponse({"ok": False}, status_code=503)
+    seen_updates[update_id] = None
+    if len(seen_updates) > SEEN_UPDATES:
+        seen_updates.popitem(last=False)
     return JSONResponse({"ok": True})
 EOF
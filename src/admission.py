@@ -0,0 +1,162 @@
+# src/admission.py
+"""
+分析工作的准入與優先佇列：依會員等級加權公平排程（stride scheduling），
+每個等級有並發上限與排隊上限，並追蹤各等級的延遲 SLO
+"""
+
+import os
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Any, Deque, Dict
+
+logger = logging.getLogger(__name__)
+
+# 等級權重：同時有人排隊時，VIC 每輪分到的名額是免費版的 6 倍
+TIER_WEIGHTS = {'vic': 6, 'vip': 3, 'free': 1}
+# 各等級同時執行的分析數上限（免費版不會佔滿所有名額）
+TIER_CAPS = {
+    'vic': int(os.getenv('ADMISSION_VIC_CAP', '8')),
+    'vip': int(os.getenv('ADMISSION_VIP_CAP', '6')),
+    'free': int(os.getenv('ADMISSION_FREE_CAP', '3')),
+}
+# 對外承諾的分析時間（秒）：VIC 30秒、VIP 5分鐘、免費 10分鐘
+TIER_SLO = {'vic': 30, 'vip': 300, 'free': 600}
+MAX_CONCURRENCY = int(os.getenv('ADMISSION_MAX_CONCURRENCY', '10'))
+MAX_WAITING = int(os.getenv('ADMISSION_MAX_WAITING', '100'))  # 每個等級
+
+class AdmissionRejected(Exception):
+    """該等級排隊已滿"""
+
+class _TierState:
+    def __init__(self, weight: int, cap: int, slo: float):
+        self.weight = weight
+        self.cap = cap
+        self.slo = slo
+        self.waiting: Deque[asyncio.Future] = deque()
+        self.running = 0
+        self.pass_value = 0.0       # stride 排程的虛擬時間，越小越先
+        self.admitted = 0
+        self.rejected = 0
+        self.slo_missed = 0
+        self.waits: deque = deque(maxlen=200)
+        self.latencies: deque = deque(maxlen=200)
+
+    def snapshot(self) -> Dict[str, Any]:
+        def pct(samples, q):
+            ordered = sorted(samples)
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000) if ordered else None
+        done = len(self.latencies)
+        met = sum(1 for x in self.latencies if x <= self.slo)
+        return {
+            'waiting': len(self.waiting),
+            'running': self.running,
+            'cap': self.cap,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'wait_p50_ms': pct(self.waits, 0.5),
+            'wait_p95_ms': pct(self.waits, 0.95),
+            'latency_p95_ms': pct(self.latencies, 0.95),
+            'slo_seconds': self.slo,
+            'slo_met': met / done if done else None,
+            'slo_missed': self.slo_missed,
+        }
+
+class AdmissionQueue:
+    """等級感知的分析准入佇列（單一事件迴圈內使用）"""
+
+    def __init__(self, weights: Dict[str, int] = TIER_WEIGHTS, caps: Dict[str, int] = TIER_CAPS,
+                 slo: Dict[str, float] = TIER_SLO, max_concurrency: int = MAX_CONCURRENCY,
+                 max_waiting: int = MAX_WAITING):
+        self.tiers = {t: _TierState(weights[t], caps[t], slo[t]) for t in weights}
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.running = 0
+        self._vtime = 0.0
+
+    def _state(self, tier: str) -> _TierState:
+        return self.tiers.get(tier) or self.tiers['free']
+
+    def position(self, tier: str) -> int:
+        """新請求進來時前面還有幾個同等級的人在排隊"""
+        return len(self._state(tier).waiting)
+
+    @asynccontextmanager
+    async def admit(self, tier: str):
+        """
+        取得執行名額後才進入區塊
+
+        Raises:
+            AdmissionRejected: 該等級排隊已滿
+        """
+        state = self._state(tier)
+        if len(state.waiting) >= self.max_waiting:
+            state.rejected += 1
+            raise AdmissionRejected(f"{tier} 排隊已滿 ({len(state.waiting)})")
+
+        enqueued = perf_counter()
+        if not state.waiting and not state.running:
+            # 閒置後重新加入的等級不能拿累積的舊額度插隊
+            state.pass_value = max(state.pass_value, self._vtime)
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiting.append(waiter)
+        self._dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                try:
+                    state.waiting.remove(waiter)
+                except ValueError:
+                    pass
+            else:
+                # 名額已發出但等待者在恢復前被取消
+                self._release(state)
+            raise
+
+        started = perf_counter()
+        state.waits.append(started - enqueued)
+        try:
+            yield
+        finally:
+            latency = perf_counter() - enqueued
+            state.latencies.append(latency)
+            if latency > state.slo:
+                state.slo_missed += 1
+                logger.warning(f"{tier} 分析超過 SLO: {latency:.1f}s > {state.slo}s")
+            self._release(state)
+
+    def _release(self, state: _TierState):
+        state.running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """有空的名額就發給 pass 值最小、且未達等級上限的等級"""
+        while self.running < self.max_concurrency:
+            eligible = [s for s in self.tiers.values() if s.waiting and s.running < s.cap]
+            if not eligible:
+                return
+            state = min(eligible, key=lambda s: s.pass_value)
+            waiter = state.waiting.popleft()
+            if waiter.done():
+                continue
+            self._vtime = state.pass_value
+            state.pass_value += 1 / state.weight
+            state.running += 1
+            state.admitted += 1
+            self.running += 1
+            waiter.set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'max_concurrency': self.max_concurrency,
+            'tiers': {name: state.snapshot() for name, state in self.tiers.items()},
+        }
+
+# 全局分析准入實例
+analysis_admission = AdmissionQueue()
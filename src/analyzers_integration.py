@@ -4,14 +4,17 @@
 這個文件讓 server.py 能正確導入 StockAnalyzer
 """
 
+import time
+import asyncio
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Awaitable, Callable, Dict, Any, Optional, List, Tuple
 from datetime import datetime
 import pandas as pd
 
 # 導入分析模組
 from . import analyzers  # 你原有的分析模組
-from .provider_yahoo import YahooProvider
+from .provider_yahoo import YahooProvider, run_blocking
+from .profile_store import profile_store
 
 logger = logging.getLogger(__name__)
 
@@ -23,12 +26,21 @@ class StockAnalyzer:
         self.risk_free_rate = 0.045  # 4.5% 無風險利率
         self.dividend_yield = 0.0    # 預設無股息
         
-    async def analyze_stock(self, stock_data: Dict[str, Any]) -> Dict[str, Any]:
+    # 各階段的時間上限（秒），逾時改用該階段的備用結果
+    STAGE_TIMEOUTS = {
+        'technical': 5,
+        'options': 8,
+        'fundamentals': 4,
+    }
+    
+    async def analyze_stock(self, stock_data: Dict[str, Any],
+                            on_stage: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
         """
         完整股票分析，包含技術面和期權分析
         
         Args:
             stock_data: 從 YahooProvider.get_stock_data() 獲得的股票數據
+            on_stage: 每完成一個階段呼叫一次 on_stage(階段名稱, 目前為止的分析結果)，供逐段顯示
             
         Returns:
             完整的分析結果字典
@@ -50,13 +62,27 @@ class StockAnalyzer:
                 'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             }
             
-            # 技術分析
-            technical_analysis = self._perform_technical_analysis(stock_data)
-            analysis_result.update(technical_analysis)
-            
-            # 期權分析 (如果有期權數據)
-            options_analysis = await self._perform_options_analysis(symbol, current_price)
-            analysis_result.update(options_analysis)
+            # 技術面、期權、基本面三個階段互不相依，同時進行；各自逾時 / 失敗時只有該階段降級
+            stages = [
+                self._run_stage('technical', asyncio.to_thread(self._perform_technical_analysis, stock_data),
+                                lambda: self._get_basic_technical_analysis(stock_data)),
+                self._run_stage('options', self._perform_options_analysis(symbol, current_price),
+                                lambda: self._get_mock_options_analysis(current_price)),
+                self._run_stage('fundamentals', self._perform_fundamental_analysis(symbol),
+                                lambda: {}),
+            ]
+            timings, degraded = {}, []
+            # 先掛上（同一個 list），on_stage 的部分結果也看得到目前為止降級的階段
+            analysis_result['degraded_stages'] = degraded
+            for finished in asyncio.as_completed(stages):
+                name, result, elapsed, ok = await finished
+                analysis_result.update(result)
+                timings[name] = round(elapsed * 1000)
+                if not ok:
+                    degraded.append(name)
+                if on_stage:
+                    on_stage(name, analysis_result)
+            analysis_result['stage_timings_ms'] = timings
             
             # AI 建議生成
             ai_recommendation = self._generate_ai_recommendation(analysis_result)
@@ -69,6 +95,36 @@ class StockAnalyzer:
             logger.error(f"分析 {symbol} 時發生錯誤: {str(e)}")
             return self._get_fallback_analysis(stock_data)
     
+    async def _run_stage(self, name: str, work: Awaitable[Dict[str, Any]],
+                         fallback: Callable[[], Dict[str, Any]]) -> Tuple[str, Dict[str, Any], float, bool]:
+        """執行單一分析階段，回傳 (名稱, 結果, 耗時, 是否成功)"""
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(work, self.STAGE_TIMEOUTS[name])
+            return name, result, time.perf_counter() - start, True
+        except asyncio.TimeoutError:
+            logger.warning(f"{name} 分析逾時 ({self.STAGE_TIMEOUTS[name]}s)，使用備用結果")
+        except Exception as e:
+            logger.warning(f"{name} 分析失敗，使用備用結果: {str(e)}")
+        try:
+            result = fallback()
+        except Exception as e:
+            logger.error(f"{name} 備用結果失敗: {str(e)}")
+            result = {}
+        return name, result, time.perf_counter() - start, False
+    
+    async def _perform_fundamental_analysis(self, symbol: str) -> Dict[str, Any]:
+        """基本面資料（每日更新的公司資料庫）"""
+        # 只讀已有的資料（每日任務預熱），不在分析路徑上呼叫緩慢的 ticker.info
+        profile = profile_store.get_profile(symbol, fetch=False) or {}
+        return {
+            'company_name': profile.get('name'),
+            'sector': profile.get('sector'),
+            'industry': profile.get('industry'),
+            'pe_ratio': profile.get('pe_ratio'),
+            'beta': profile.get('beta'),
+        }
+    
     def _perform_technical_analysis(self, stock_data: Dict[str, Any]) -> Dict[str, Any]:
         """執行技術分析"""
         try:
@@ -109,79 +165,74 @@ class StockAnalyzer:
     
     async def _perform_options_analysis(self, symbol: str, spot_price: float) -> Dict[str, Any]:
         """執行期權分析"""
-        try:
-            # 獲取期權鏈數據
-            expiry = self.yahoo_provider.nearest_expiry(symbol)
-            options_chain = self.yahoo_provider.get_options_chain(symbol, expiry)
-            
-            # 準備期權數據
-            option_rows = []
-            greeks_rows = []
-            
-            for call in options_chain['calls']:
-                option_rows.append(analyzers.OptionRow(
+        # 獲取期權鏈數據（同步的 yfinance 呼叫放進執行緒池，不阻塞其他階段）；
+        # 取不到時直接拋出，由 _run_stage 換成備用結果並記為降級
+        options_chain = await run_blocking(self.yahoo_provider.get_options_chain, symbol)
+        expiry = options_chain['expiry']
+        
+        # 準備期權數據
+        option_rows = []
+        greeks_rows = []
+        
+        for call in options_chain['calls']:
+            option_rows.append(analyzers.OptionRow(
+                strike=call['strike'],
+                type='call',
+                open_interest=call['openInterest']
+            ))
+            
+            if call['impliedVolatility'] is not None:
+                greeks_rows.append(analyzers.OptionGreeksRow(
                     strike=call['strike'],
                     type='call',
-                    open_interest=call['openInterest']
+                    open_interest=call['openInterest'],
+                    iv=call['impliedVolatility'],
+                    T=call['T']
                 ))
-                
-                if call['impliedVolatility'] is not None:
-                    greeks_rows.append(analyzers.OptionGreeksRow(
-                        strike=call['strike'],
-                        type='call',
-                        open_interest=call['openInterest'],
-                        iv=call['impliedVolatility'],
-                        T=call['T']
-                    ))
-            
-            for put in options_chain['puts']:
-                option_rows.append(analyzers.OptionRow(
+        
+        for put in options_chain['puts']:
+            option_rows.append(analyzers.OptionRow(
+                strike=put['strike'],
+                type='put',
+                open_interest=put['openInterest']
+            ))
+            
+            if put['impliedVolatility'] is not None:
+                greeks_rows.append(analyzers.OptionGreeksRow(
                     strike=put['strike'],
                     type='put',
-                    open_interest=put['openInterest']
+                    open_interest=put['openInterest'],
+                    iv=put['impliedVolatility'],
+                    T=put['T']
                 ))
-                
-                if put['impliedVolatility'] is not None:
-                    greeks_rows.append(analyzers.OptionGreeksRow(
-                        strike=put['strike'],
-                        type='put',
-                        open_interest=put['openInterest'],
-                        iv=put['impliedVolatility'],
-                        T=put['T']
-                    ))
-            
-            # 計算 Max Pain
-            max_pain_result = analyzers.compute_max_pain(option_rows)
-            
-            # 計算 GEX
-            gex_result = analyzers.compute_gex(greeks_rows, spot_price, self.risk_free_rate, self.dividend_yield)
-            
-            # 計算 Gamma 支撐/阻力
-            support, resistance = analyzers.compute_gamma_levels(greeks_rows, spot_price, self.risk_free_rate, self.dividend_yield)
-            
-            # 磁吸強度
-            magnet_strength = analyzers.magnet_strength(spot_price, max_pain_result.max_pain)
-            
-            return {
-                'max_pain': max_pain_result.max_pain,
-                'magnet_strength': magnet_strength,
-                'gamma_levels': {
-                    'support': support,
-                    'resistance': resistance
-                },
-                'gex': {
-                    'share_gamma': gex_result.share_gamma,
-                    'dollar_gamma_1pct': gex_result.dollar_gamma_1pct
-                },
-                'options_expiry': expiry,
-                'total_call_oi': sum(row.open_interest for row in option_rows if row.type == 'call'),
-                'total_put_oi': sum(row.open_interest for row in option_rows if row.type == 'put'),
-            }
-            
-        except Exception as e:
-            logger.warning(f"期權分析失敗 ({symbol}): {str(e)}")
-            # 如果期權分析失敗，返回模擬數據
-            return self._get_mock_options_analysis(spot_price)
+        
+        # 計算 Max Pain
+        max_pain_result = analyzers.compute_max_pain(option_rows)
+        
+        # 計算 GEX
+        gex_result = analyzers.compute_gex(greeks_rows, spot_price, self.risk_free_rate, self.dividend_yield)
+        
+        # 計算 Gamma 支撐/阻力
+        support, resistance = analyzers.compute_gamma_levels(greeks_rows, spot_price, self.risk_free_rate, self.dividend_yield)
+        
+        # 磁吸強度
+        magnet = analyzers.magnet_strength(spot_price, max_pain_result.max_pain)
+        
+        return {
+            'max_pain': max_pain_result.max_pain,
+            'magnet_strength': magnet,
+            'gamma_levels': {
+                'support': support,
+                'resistance': resistance
+            },
+            'gex': {
+                'share_gamma': gex_result.share_gamma,
+                'dollar_gamma_1pct': gex_result.dollar_gamma_1pct
+            },
+            'options_expiry': expiry,
+            'total_call_oi': sum(row.open_interest for row in option_rows if row.type == 'call'),
+            'total_put_oi': sum(row.open_interest for row in option_rows if row.type == 'put'),
+        }
     
     def _generate_ai_recommendation(self, analysis_result: Dict[str, Any]) -> Dict[str, Any]:
         """生成 AI 投資建議"""
@@ -345,4 +396,5 @@ class StockAnalyzer:
             'ai_recommendation': '數據獲取中，請稍後再試',
             'confidence': '50',
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'fallback': True,   # 分析沒有完成，呼叫端不可當成正常結果
         }
@@ -1,15 +1,86 @@
-import logging
+import os
 import re
+import time
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import ContextTypes
-from .provider_yahoo import YahooProvider
+from .provider_yahoo import AsyncYahooProvider
 from .analyzers import StockAnalyzer
+from .strategy import gen_strategy
 
 logger = logging.getLogger(__name__)
 
+# 同一則訊息兩次編輯的最短間隔（秒），Telegram 對編輯頻率有限制
+EDIT_INTERVAL = float(os.getenv('EDIT_INTERVAL', '1.0'))
+
+# 逐段顯示的區塊：(區塊, 標題, 所依賴的分析階段)；策略由期權階段的 Max Pain / Gamma 產生
+SECTIONS = [
+    ('technical', '📈 技術分析', 'technical'),
+    ('options', '🧲 Max Pain / Gamma', 'options'),
+    ('strategy', '💡 交易策略', 'options'),
+    ('fundamentals', '🏢 基本面', 'fundamentals'),
+]
+
+class ThrottledEditor:
+    """合併連續的訊息編輯：只送出最新內容，且兩次編輯至少間隔 min_interval 秒"""
+    
+    def __init__(self, message, min_interval: float = EDIT_INTERVAL):
+        self.message = message
+        self.min_interval = min_interval
+        self._last_edit = 0.0
+        self._shown: Optional[str] = None
+        self._pending: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self.edits = 0
+    
+    def update(self, text: str):
+        """排入新內容，不等待送出"""
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+    
+    async def finish(self, text: str):
+        """送出最終內容並等到完成"""
+        self.update(text)
+        await self._task
+    
+    async def discard(self):
+        """丟棄尚未送出的內容，等進行中的編輯結束（之後的 edit_text 不會被舊進度覆蓋）"""
+        self._pending = None
+        if self._task is not None:
+            await self._task
+    
+    async def _drain(self):
+        while self._pending is not None:
+            wait = self._last_edit + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            text, self._pending = self._pending, None
+            if text == self._shown:
+                continue
+            try:
+                await self.message.edit_text(text)
+                self._shown = text
+                self.edits += 1
+            except RetryAfter as e:
+                # 被限流：等待後重送（期間若有更新的內容則送新的）
+                retry_after = e.retry_after
+                await asyncio.sleep(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+                if self._pending is None:
+                    self._pending = text
+            except BadRequest as e:
+                logger.debug(f"編輯訊息失敗: {e}")
+            except TelegramError as e:
+                # 逾時、網路錯誤：略過這次進度，下一次更新（或最終結果）會再送
+                logger.warning(f"編輯訊息失敗: {type(e).__name__} {e}")
+            self._last_edit = time.monotonic()
+
 class StockBot:
     def __init__(self):
-        self.yahoo_provider = YahooProvider()
+        self.yahoo_provider = AsyncYahooProvider()
         self.analyzer = StockAnalyzer()
     
     async def handle_stock_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -50,29 +121,30 @@ class StockBot:
                 f"📊 正在獲取即時數據..."
             )
             
-            # 獲取股票數據
+            # 報價先到先顯示；技術面、期權、基本面同時進行，每完成一段就更新訊息
+            editor = None
             try:
-                stock_data = self.yahoo_provider.get_stock_data(symbol)
-                
-                # 格式化基本資訊
+                stock_data = await self.yahoo_provider.get_stock_data(symbol)
                 basic_info = self._format_basic_info(stock_data)
                 
-                # 更新訊息顯示基本資訊
-                await processing_msg.edit_text(
-                    f"{basic_info}\n\n"
-                    f"🤖 正在進行AI深度分析...\n"
-                    f"📈 技術分析進行中..."
-                )
+                editor = ThrottledEditor(processing_msg)
+                done = set()
+                editor.update(self._format_progress(basic_info, {}, done))
                 
-                # 進行深度分析
-                analysis = await self._perform_analysis(symbol, stock_data)
+                def on_stage(name: str, partial: Dict):
+                    done.add(name)
+                    editor.update(self._format_progress(basic_info, partial, done))
+                
+                analysis = await self._perform_analysis(symbol, stock_data, on_stage)
                 
                 # 發送完整分析報告
                 final_report = self._format_final_report(stock_data, analysis)
-                await processing_msg.edit_text(final_report)
+                await editor.finish(final_report)
                 
             except Exception as e:
                 logger.error(f"獲取股票數據失敗: {e}")
+                if editor is not None:
+                    await editor.discard()
                 await processing_msg.edit_text(
                     f"❌ 找不到股票代碼 {symbol}\n\n"
                     f"💡 請檢查:\n"
@@ -117,11 +189,18 @@ class StockBot:
 📡 數據來源: {stock_data.get('data_source', 'Yahoo Finance')}
         """.strip()
     
-    async def _perform_analysis(self, symbol: str, stock_data: dict) -> dict:
+    async def _perform_analysis(self, symbol: str, stock_data: dict, on_stage=None) -> dict:
         """執行深度分析"""
         try:
-            # 這裡調用你的分析器
-            analysis = await self.analyzer.analyze_stock(symbol, stock_data)
+            analysis = await self.analyzer.analyze_stock(stock_data, on_stage=on_stage)
+            if analysis.get('fallback'):
+                # 分析器內部失敗、回傳的是後備數據
+                return {
+                    'status': 'error',
+                    'message': '分析暫時無法完成，以上為即時報價',
+                    'recommendation': '建議稍後重試'
+                }
+            analysis['status'] = 'success'
             return analysis
         except Exception as e:
             logger.error(f"分析失敗: {e}")
@@ -131,6 +210,40 @@ class StockBot:
                 'recommendation': '建議稍後重試'
             }
     
+    def _format_section(self, name: str, analysis: Dict) -> str:
+        """單一分析階段的內容"""
+        if name == 'technical':
+            rsi = analysis.get('rsi')
+            return (f"趨勢: {analysis.get('trend', 'N/A')}\n"
+                    f"RSI: {'N/A' if rsi is None else f'{rsi:.1f}'}\n"
+                    f"技術評分: {analysis.get('technical_score', 'N/A')}")
+        if name == 'options':
+            levels = analysis.get('gamma_levels') or {}
+            gex = analysis.get('gex') or {}
+            return (f"Max Pain: {analysis.get('max_pain', 'N/A')} {analysis.get('magnet_strength', '')}\n"
+                    f"支撐位: {levels.get('support', 'N/A')} | 阻力位: {levels.get('resistance', 'N/A')}\n"
+                    f"Dollar Gamma (1%): {gex.get('dollar_gamma_1pct', 'N/A')}")
+        if name == 'strategy':
+            levels = analysis.get('gamma_levels') or {}
+            support, resistance = levels.get('support'), levels.get('resistance')
+            # 期權階段降級時的 Max Pain / Gamma 是估計值，不據以產生策略
+            if 'options' in (analysis.get('degraded_stages') or ()) or None in (analysis.get('max_pain'), support, resistance):
+                return "期權數據暫時無法取得，略過策略建議"
+            return gen_strategy(symbol=analysis['symbol'], spot=analysis['current_price'],
+                                max_pain=analysis['max_pain'], support=support, resistance=resistance)
+        return (f"產業: {analysis.get('sector') or 'N/A'} / {analysis.get('industry') or 'N/A'}\n"
+                f"本益比: {analysis.get('pe_ratio') or 'N/A'} | Beta: {analysis.get('beta') or 'N/A'}")
+    
+    def _format_progress(self, basic_info: str, analysis: Dict, done: Iterable[str]) -> str:
+        """分析進行中的訊息：已完成的階段顯示內容，其餘顯示進行中"""
+        parts = [basic_info]
+        for name, title, stage in SECTIONS:
+            if stage in done:
+                parts.append(f"{title}\n{self._format_section(name, analysis)}")
+            else:
+                parts.append(f"{title}\n⏳ 分析中...")
+        return "\n\n".join(parts)
+    
     def _format_final_report(self, stock_data: dict, analysis: dict) -> str:
         """格式化最終報告"""
         change_emoji = "📈" if stock_data['change'] > 0 else "📉" if stock_data['change'] < 0 else "➡️"
@@ -150,15 +263,13 @@ class StockBot:
             report += f"""
 
 🤖 **AI分析結果**
-投資建議: {analysis.get('recommendation', 'N/A')}
+投資建議: {analysis.get('ai_recommendation', 'N/A')}
 信心度: {analysis.get('confidence', 'N/A')}
-風險等級: {analysis.get('risk_level', 'N/A')}
-
-📈 **技術分析**
-趨勢: {analysis.get('trend', 'N/A')}
-支撐位: {analysis.get('support', 'N/A')}
-阻力位: {analysis.get('resistance', 'N/A')}
             """
+            for name, title, _ in SECTIONS:
+                report += f"\n\n{title}\n{self._format_section(name, analysis)}"
+            if analysis.get('degraded_stages'):
+                report += f"\n\n⚠️ 部分數據逾時或暫時無法取得（{', '.join(analysis['degraded_stages'])}），以備用結果顯示"
         else:
             report += f"""
 
@@ -0,0 +1,190 @@
+# src/broadcast.py
+"""
+大量推播：有界並發送出，遵守 Telegram 全域（令牌桶，可經 Redis 跨 worker 共用）
+與單一聊天室的速率限制；429 / 5xx 退避重試，進度寫入檢查點以便重啟後續傳（失敗的收件人續傳時重試），
+並回報吞吐量
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from .ratelimit import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_DIR = os.path.abspath(os.getenv('BROADCAST_DIR', 'data/broadcast'))
+CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '25'))
+MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', '5'))
+PER_CHAT_INTERVAL = 1.0      # 同一聊天室每秒最多一則
+CHECKPOINT_EVERY = 200       # 每完成幾位收件人寫一次檢查點
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+Sender = Callable[[int, str], Awaitable[Any]]
+
+# 單一收件人的結果
+SENT, FAILED, UNCONFIRMED = 'sent', 'failed', 'unconfirmed'
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """可重試時回傳等待秒數；封鎖機器人、聊天室不存在等永久錯誤回傳 None"""
+    if isinstance(error, RetryAfter):
+        retry_after = error.retry_after
+        return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+    if isinstance(error, (Forbidden, BadRequest, TimedOut)):
+        # TimedOut：請求可能已被 Telegram 接受，重送會造成重複
+        return None
+    if isinstance(error, (NetworkError, asyncio.TimeoutError, OSError)):
+        # 5xx、逾時、連線中斷：指數退避加抖動
+        return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random() / 2)
+    return None
+
+class Broadcaster:
+    """推播引擎"""
+
+    def __init__(self, concurrency: int = CONCURRENCY, max_attempts: int = MAX_ATTEMPTS,
+                 checkpoint_dir: str = BROADCAST_DIR):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.checkpoint_dir = checkpoint_dir
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    def _checkpoint_path(self, broadcast_id: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{broadcast_id}.json")
+
+    def _load_checkpoint(self, broadcast_id: str) -> Dict[str, Any]:
+        try:
+            with open(self._checkpoint_path(broadcast_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"讀取推播檢查點失敗 {broadcast_id}: {e}")
+            return {}
+
+    def _save_checkpoint(self, broadcast_id: str, state: Dict[str, Any]):
+        try:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            path = self._checkpoint_path(broadcast_id)
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"寫入推播檢查點失敗 {broadcast_id}: {e}")
+
+    async def _send_one(self, send: Sender, chat_id: int, messages: List[str]) -> str:
+        """
+        依序送出一位收件人的所有訊息
+
+        Returns:
+            SENT；FAILED（確定沒送到，續傳時重試）；UNCONFIRMED（逾時，可能已送到，續傳時不重送）
+        """
+        last_sent = 0.0
+        for text in messages:
+            attempt = 0
+            while True:
+                gap = last_sent + PER_CHAT_INTERVAL - time.monotonic()
+                if gap > 0:
+                    await asyncio.sleep(gap)
+                await rate_limiter.acquire_async('telegram', max_wait=float('inf'))
+                try:
+                    await send(chat_id, text)
+                    last_sent = time.monotonic()
+                    break
+                except Exception as e:
+                    attempt += 1
+                    delay = _retry_delay(e, attempt)
+                    if delay is None or attempt >= self.max_attempts:
+                        logger.warning(f"推播給 {chat_id} 失敗（第 {attempt} 次）: {type(e).__name__} {e}")
+                        return UNCONFIRMED if isinstance(e, TimedOut) else FAILED
+                    if isinstance(e, RetryAfter):
+                        # 429 代表全域配額已滿，其他 worker 也一起暫停
+                        rate_limiter.drain('telegram')
+                    await asyncio.sleep(delay)
+        return SENT
+
+    async def broadcast(self, broadcast_id: str, messages: Union[str, List[str]],
+                        recipients: Iterable[int], send: Sender) -> Dict[str, Any]:
+        """
+        推播給所有收件人
+
+        Args:
+            broadcast_id: 推播識別（例如 mag7-2025-01-01-08），相同 id 重跑時跳過已送出的收件人，
+                上次失敗的收件人會再試一次
+            messages: 一則或多則（依序送出）訊息
+            recipients: 聊天室 ID
+            send: async send(chat_id, text)
+
+        Returns:
+            推播報告（送出 / 失敗 / 未確認 / 跳過數、耗時、每秒則數）
+        """
+        messages = [messages] if isinstance(messages, str) else list(messages)
+        checkpoint = self._load_checkpoint(broadcast_id)
+        # 已送出與逾時未確認的不再送；失敗的另外記錄，續傳時重試
+        results: Dict[int, str] = {chat_id: SENT for chat_id in checkpoint.get('done', [])}
+        results.update((chat_id, UNCONFIRMED) for chat_id in checkpoint.get('unconfirmed', []))
+        failed_before = set(checkpoint.get('failed', []))
+        state = {'id': broadcast_id, 'completed': False}
+        pending = [chat_id for chat_id in dict.fromkeys(recipients) if chat_id not in results]
+        skipped = len(results)
+        if skipped or failed_before:
+            logger.info(f"推播 {broadcast_id} 從檢查點續傳：跳過 {skipped} 位，重試失敗 {len(failed_before)} 位，"
+                        f"剩餘共 {len(pending)} 位")
+
+        start = time.perf_counter()
+        sent_now = 0
+        since_checkpoint = 0
+        queue = iter(pending)
+
+        def checkpoint_now():
+            by_status = {SENT: [], FAILED: [], UNCONFIRMED: []}
+            for chat_id, status in results.items():
+                by_status[status].append(chat_id)
+            self._save_checkpoint(broadcast_id, dict(
+                state, done=sorted(by_status[SENT]), failed=sorted(by_status[FAILED]),
+                unconfirmed=sorted(by_status[UNCONFIRMED])))
+
+        async def worker():
+            nonlocal sent_now, since_checkpoint
+            for chat_id in queue:
+                results[chat_id] = await self._send_one(send, chat_id, messages)
+                if results[chat_id] == SENT:
+                    sent_now += 1
+                since_checkpoint += 1
+                if since_checkpoint >= CHECKPOINT_EVERY:
+                    since_checkpoint = 0
+                    checkpoint_now()
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(pending)) or 1)))
+            state['completed'] = True
+        finally:
+            checkpoint_now()
+
+        elapsed = time.perf_counter() - start
+        counts = {status: sum(1 for r in results.values() if r == status) for status in (SENT, FAILED, UNCONFIRMED)}
+        report = {
+            'id': broadcast_id,
+            'recipients': len(pending) + skipped,
+            'sent': counts[SENT],
+            'failed': counts[FAILED],
+            'unconfirmed': counts[UNCONFIRMED],
+            'skipped': skipped,
+            'elapsed_seconds': round(elapsed, 1),
+            'per_second': round(sent_now * len(messages) / elapsed, 1) if elapsed > 0 else None,
+        }
+        self.last_report = report
+        logger.info(f"推播 {broadcast_id} 完成: 送出 {report['sent']} | 失敗 {report['failed']} | "
+                    f"未確認 {report['unconfirmed']} | 跳過 {skipped} | {report['elapsed_seconds']}秒 | "
+                    f"{report['per_second']} 則/秒")
+        return report
+
+# 全局推播實例
+broadcaster = Broadcaster()
@@ -1,6 +1,6 @@
 # src/cache.py (增強版本)
 import os, json, time, pathlib, contextlib
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import logging
 
 logger = logging.getLogger(__name__)
@@ -63,6 +63,8 @@ class CacheManager:
             'ipo_data': 3600,       # IPO數據 1小時
             'analysis_result': 300,  # 分析結果 5分鐘
             'user_limits': 86400,   # 用戶限制 24小時
+            'company_profile': 86400,  # 公司基本資料 24小時
+            'indicator_state': 86400,  # 技術指標串流狀態 24小時
         }
         
         logger.info(f"快取管理器初始化 - 使用 {'Redis' if _r() else '文件快取'}")
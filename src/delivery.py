@@ -0,0 +1,200 @@
+# src/delivery.py
+"""
+長訊息投遞：依區塊邊界切成不超過 Telegram 4096 字元的段落，
+經共用連線池（有 h2 時 HTTP/2 多工）依序送出；多個聊天室同時進行，
+每段送達後寫入投遞帳本（data/delivery/<id>.json），以同一個 id 重跑只補送未確認的段落
+"""
+
+import os
+import json
+import random
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API = "https://api.telegram.org"
+DELIVERY_DIR = os.path.abspath(os.getenv('DELIVERY_DIR', 'data/delivery'))
+MESSAGE_LIMIT = 4096
+MAX_ATTEMPTS = int(os.getenv('DELIVERY_MAX_ATTEMPTS', '4'))
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+try:
+    import h2  # noqa: F401  有安裝 h2 才啟用 HTTP/2
+    _HTTP2 = True
+except Exception:
+    _HTTP2 = False
+
+# 請求確定沒有送達 Telegram 的錯誤，重送不會重複
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class DeliveryError(Exception):
+    """段落重試後仍無法送出"""
+
+def _split_long(block: str, limit: int) -> List[str]:
+    """單一區塊超過上限時依段落 / 行 / 字元切開"""
+    if len(block) <= limit:
+        return [block]
+    for sep in ("\n\n", "\n"):
+        pieces = block.split(sep)
+        if len(pieces) > 1:
+            return _pack(pieces, sep, limit)
+    return [block[i:i + limit] for i in range(0, len(block), limit)]
+
+def _pack(blocks: Iterable[str], sep: str, limit: int) -> List[str]:
+    chunks: List[str] = []
+    current = ""
+    for block in blocks:
+        for piece in _split_long(block, limit):
+            candidate = f"{current}{sep}{piece}" if current else piece
+            if len(candidate) <= limit:
+                current = candidate
+            else:
+                if current:
+                    chunks.append(current)
+                current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def chunk_text(text: str, separator: str = "\n", limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    依區塊邊界切段，盡量把完整區塊放在同一則訊息
+
+    Args:
+        text: 全文
+        separator: 區塊分隔（例如報告中的分隔線），找不到時退回段落 / 行
+        limit: 每段字元上限
+    """
+    text = text.strip()
+    if len(text) <= limit:
+        return [text] if text else []
+    return [c.strip() for c in _pack(text.split(separator), separator, limit) if c.strip()]
+
+class TelegramDelivery:
+    """以共用連線池向一或多個聊天室投遞長訊息"""
+
+    def __init__(self, token: str, max_attempts: int = MAX_ATTEMPTS, ledger_dir: str = DELIVERY_DIR):
+        self.token = token
+        self.max_attempts = max_attempts
+        self.ledger_dir = ledger_dir
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _ledger_path(self, delivery_id: str) -> str:
+        return os.path.join(self.ledger_dir, f"{delivery_id}.json")
+
+    def _load_ledger(self, delivery_id: str) -> Dict[str, Any]:
+        """投遞帳本：{'chunks': [...], 'sent': {chat_id: {段落序號: message_id}}}"""
+        try:
+            with open(self._ledger_path(delivery_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"讀取投遞帳本失敗 {delivery_id}: {e}")
+            return {}
+
+    def _save_ledger(self, delivery_id: str, ledger: Dict[str, Any]):
+        try:
+            os.makedirs(self.ledger_dir, exist_ok=True)
+            path = self._ledger_path(delivery_id)
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(ledger, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"寫入投遞帳本失敗 {delivery_id}: {e}")
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=f"{TELEGRAM_API}/bot{self.token}",
+                timeout=20,
+                http2=_HTTP2,
+                limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _send_chunk(self, chat_id: str, text: str) -> int:
+        """送出一段；可重試的錯誤（未送達、429、5xx）退避重送，成功回傳 message_id"""
+        for attempt in range(1, self.max_attempts + 1):
+            delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)) * (0.5 + random.random() / 2)
+            try:
+                r = await self._get_client().post("/sendMessage", data={"chat_id": chat_id, "text": text})
+            except _NOT_SENT as e:
+                reason = f"{type(e).__name__}"
+            except httpx.TransportError as e:
+                # 請求可能已被 Telegram 接受，重送可能造成重複，交給呼叫端決定
+                raise DeliveryError(f"{chat_id}: 回應中斷，無法確認是否送達 ({type(e).__name__})") from e
+            else:
+                if r.status_code == 200:
+                    return r.json()["result"]["message_id"]
+                if r.status_code == 429:
+                    delay = float(r.json().get("parameters", {}).get("retry_after", delay))
+                    reason = "429"
+                elif r.status_code >= 500:
+                    reason = str(r.status_code)
+                else:
+                    raise DeliveryError(f"{chat_id}: {r.status_code} {r.text[:200]}")
+            if attempt < self.max_attempts:
+                logger.warning(f"投遞到 {chat_id} 失敗（{reason}），{delay:.1f}s 後重試 {attempt}/{self.max_attempts}")
+                await asyncio.sleep(delay)
+        raise DeliveryError(f"{chat_id}: 重試 {self.max_attempts} 次仍失敗（{reason}）")
+
+    async def _deliver_chat(self, delivery_id: str, chat_id: str, chunks: List[str],
+                            ledger: Dict[str, Any]) -> Dict:
+        """同一聊天室內依序送出，帳本中已確認的段落跳過"""
+        confirmed = ledger['sent'].setdefault(chat_id, {})
+        sent = 0
+        for index, chunk in enumerate(chunks):
+            if str(index) in confirmed:
+                continue
+            try:
+                confirmed[str(index)] = await self._send_chunk(chat_id, chunk)
+                sent += 1
+                self._save_ledger(delivery_id, ledger)
+            except DeliveryError as e:
+                # 後面的段落不送，避免順序錯亂；以同一個 id 重跑會從這一段接著送
+                logger.error(f"投遞 {delivery_id} 第 {index + 1}/{len(chunks)} 段失敗: {e}")
+                return {'sent': sent, 'delivered': index, 'total': len(chunks), 'error': str(e)}
+        return {'sent': sent, 'delivered': len(chunks), 'total': len(chunks), 'error': None}
+
+    async def deliver(self, delivery_id: str, text: str, chat_ids: Iterable[str],
+                      separator: str = "\n") -> Dict[str, Dict]:
+        """
+        把 text 投遞到所有聊天室（各聊天室並行，段落依序）
+
+        Args:
+            delivery_id: 這份內容的識別；帳本已存在時沿用當時切好的段落，只補送未確認的段落
+                （重跑時重新產生的 text 即使內容略有不同，也不會和已送出的段落混在一起）
+
+        Returns:
+            {chat_id: {'sent': 本次送出段數, 'delivered': 已確認段數, 'total': 總段數, 'error': 錯誤或 None}}
+        """
+        ledger = self._load_ledger(delivery_id)
+        if ledger.get('chunks'):
+            chunks = ledger['chunks']
+            logger.info(f"投遞 {delivery_id} 從帳本續傳（{len(chunks)} 段）")
+        else:
+            chunks = chunk_text(text, separator)
+            ledger = {'id': delivery_id, 'chunks': chunks, 'sent': {}}
+            self._save_ledger(delivery_id, ledger)
+        ledger.setdefault('sent', {})
+        chat_ids = [str(c).strip() for c in chat_ids if str(c).strip()]
+        results = await asyncio.gather(*(self._deliver_chat(delivery_id, c, chunks, ledger) for c in chat_ids))
+        report = dict(zip(chat_ids, results))
+        logger.info(f"投遞 {delivery_id}: {len(chunks)} 段 × {len(chat_ids)} 個聊天室，"
+                    f"完成 {sum(1 for r in results if r['error'] is None)}/{len(chat_ids)}")
+        return report
+
+# 全局投遞實例
+telegram_delivery = TelegramDelivery(os.getenv('TELEGRAM_BOT_TOKEN', ''))
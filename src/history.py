@@ -0,0 +1,178 @@
+# src/history.py
+"""
+本地日K線（OHLCV）歷史庫：SQLite 持久化 + 記憶體快取，只向上游抓取最後一根K線之後的增量
+"""
+
+import os
+import time
+import sqlite3
+import pathlib
+import threading
+import logging
+from datetime import date, timedelta
+from typing import Dict, Optional, Iterable
+
+import pandas as pd
+import yfinance as yf
+
+from .ratelimit import rate_limiter, RateLimitExceeded
+from .replay import replay
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DB = os.path.abspath(os.getenv('HISTORY_DB', 'data/history.db'))
+pathlib.Path(HISTORY_DB).parent.mkdir(parents=True, exist_ok=True)
+
+COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# 首次抓取時保留的日曆天數倍數（交易日約為日曆天的 0.7）
+_CALENDAR_FACTOR = 1.6
+
+# 批次同步時每個股票等待 yahoo 配額的上限（秒）；互動查詢仍用限流器預設，配額不足立即降級
+REFRESH_MAX_WAIT = float(os.getenv('HISTORY_REFRESH_MAX_WAIT', '30'))
+
+class HistoryStore:
+    """每個股票一份日K線，增量更新"""
+
+    def __init__(self, db_path: str = HISTORY_DB):
+        self.db_path = db_path
+        self._frames: Dict[str, pd.DataFrame] = {}
+        self._synced_at: Dict[str, float] = {}
+        self._backfilled: Dict[str, int] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.fetches = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bars ("
+                "symbol TEXT, date TEXT, open REAL, high REAL, low REAL, close REAL, volume REAL, "
+                "PRIMARY KEY (symbol, date))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS sync (symbol TEXT PRIMARY KEY, synced_at REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _load(self, symbol: str) -> pd.DataFrame:
+        """從 SQLite 讀入記憶體"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT date, open, high, low, close, volume FROM bars WHERE symbol = ? ORDER BY date",
+                (symbol,)
+            ).fetchall()
+            synced = conn.execute("SELECT synced_at FROM sync WHERE symbol = ?", (symbol,)).fetchone()
+        frame = pd.DataFrame([r[1:] for r in rows], columns=COLUMNS,
+                             index=pd.DatetimeIndex([r[0] for r in rows], name='Date'))
+        self._frames[symbol] = frame
+        self._synced_at[symbol] = synced[0] if synced else 0.0
+        return frame
+
+    def _save(self, symbol: str, bars: pd.DataFrame, synced_at: float):
+        records = [
+            (symbol, idx.strftime('%Y-%m-%d'), float(row['Open']), float(row['High']),
+             float(row['Low']), float(row['Close']), float(row['Volume']))
+            for idx, row in bars.iterrows()
+        ]
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?)", records)
+            conn.execute("INSERT OR REPLACE INTO sync VALUES (?, ?)", (symbol, synced_at))
+
+    def _is_fresh(self, symbol: str, max_age: Optional[float]) -> bool:
+        synced_at = self._synced_at.get(symbol, 0.0)
+        if max_age is None:
+            # 預設：每個交易日只同步一次
+            return date.fromtimestamp(synced_at) >= date.today()
+        return time.time() - synced_at < max_age
+
+    def _fetch(self, symbol: str, frame: pd.DataFrame, days: int, backfill: bool,
+               max_wait: Optional[float] = None) -> pd.DataFrame:
+        """抓取最後一根K線（含當日未收盤K線）之後的增量；backfill 時補齊 days 根"""
+        if backfill or frame.empty:
+            start = date.today() - timedelta(days=int(days * _CALENDAR_FACTOR) + 10)
+            kind = f"backfill{days}"
+        else:
+            start = frame.index[-1].date()
+            kind = "delta"
+        rate_limiter.acquire('yahoo', max_wait)
+        self.fetches += 1
+        # 重播鍵不含日期，錄製後隔天仍能重播
+        bars = replay.call(f"yf:history:{symbol}:{kind}",
+                           lambda: yf.Ticker(symbol).history(start=start.isoformat()))
+        if bars.empty:
+            return bars
+        bars = bars[COLUMNS]
+        bars.index = pd.DatetimeIndex(bars.index.strftime('%Y-%m-%d'), name='Date')
+        return bars
+
+    def get_history(self, symbol: str, days: int = 50, max_age: Optional[float] = None,
+                    max_wait: Optional[float] = None) -> pd.DataFrame:
+        """
+        取得最近 days 根日K線
+
+        Args:
+            symbol: 股票代碼
+            days: 需要的K線數量
+            max_age: 距上次同步超過幾秒才抓增量；None 表示每天只同步一次
+            max_wait: 配額不足時最多等待幾秒；None 使用限流器預設
+        """
+        symbol = symbol.upper().strip()
+        with self._lock:
+            symbol_lock = self._locks.setdefault(symbol, threading.Lock())
+
+        # 每個股票各自一把鎖，同一股票的並發請求只會觸發一次增量抓取
+        with symbol_lock:
+            frame = self._frames.get(symbol)
+            if frame is None:
+                frame = self._load(symbol)
+
+            # 本地K線不足時回補一次（上市不久的股票回補後仍可能不足）
+            backfill = len(frame) < days and self._backfilled.get(symbol, 0) < days
+            if backfill or not self._is_fresh(symbol, max_age):
+                try:
+                    bars = self._fetch(symbol, frame, days, backfill, max_wait)
+                    synced_at = time.time()
+                    if backfill:
+                        self._backfilled[symbol] = days
+                    if not bars.empty:
+                        frame = pd.concat([frame[~frame.index.isin(bars.index)], bars]).sort_index()
+                        self._frames[symbol] = frame
+                    self._save(symbol, bars, synced_at)
+                    self._synced_at[symbol] = synced_at
+                except RateLimitExceeded:
+                    # 配額用完時以本地舊數據應付，沒有數據才往上拋
+                    if frame.empty:
+                        raise
+                    logger.info(f"{symbol} 增量更新被限流，使用本地歷史數據")
+                except Exception as e:
+                    if frame.empty:
+                        raise
+                    logger.warning(f"{symbol} 增量更新失敗，使用本地歷史數據: {e}")
+
+            return frame.tail(days).copy()
+
+    def refresh(self, symbols: Iterable[str], days: int = 50) -> Dict[str, int]:
+        """
+        批次同步整個股票池，每個股票每天最多一次增量抓取；配額用完時排隊等待
+        （限流器本身就是節奏），不會在第一波突發額度用完後整批降級
+
+        Returns:
+            每個股票的K線數；今天沒同步成功、只剩舊數據的記為 0
+        """
+        result = {}
+        for symbol in symbols:
+            symbol = symbol.upper().strip()
+            try:
+                bars = len(self.get_history(symbol, days, max_wait=REFRESH_MAX_WAIT))
+            except Exception as e:
+                logger.warning(f"同步 {symbol} 歷史數據失敗: {e}")
+                bars = 0
+            result[symbol] = bars if self._is_fresh(symbol, None) else 0
+        return result
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._connect() as conn:
+            symbols, bars = conn.execute("SELECT COUNT(DISTINCT symbol), COUNT(*) FROM bars").fetchone()
+        return {'symbols': symbols, 'bars': bars, 'in_memory': len(self._frames), 'fetches': self.fetches}
+
+# 全局歷史庫實例
+history_store = HistoryStore()
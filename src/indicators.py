@@ -0,0 +1,375 @@
+# src/indicators.py
+"""
+串流式技術指標引擎：每個股票保存一份可序列化的狀態，新K線進來 O(1) 更新，不需每次重算整段 pandas 序列
+
+與原本 pandas 寫法的對應：
+- RSI：漲跌幅 14 根簡單移動平均（rolling(14).mean()，非 Wilder 平滑）
+- MA20 / MA50 / 成交量均線：滑動視窗平均
+- MACD：ewm(span, adjust=True) 的遞迴形式 num = x + (1-α)·num、den = 1 + (1-α)·den
+- 布林通道：滑動視窗 Welford 平均 / 變異數（ddof=1）
+- 20 日高低點、區間高低點：單調佇列
+"""
+
+import math
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Dict, Optional, Any, List, Tuple
+from zoneinfo import ZoneInfo
+
+from .cache import cache_manager
+
+logger = logging.getLogger(__name__)
+
+# 與 calculate_technical_indicators 讀取的K線數量相同
+HISTORY_BARS = 50
+
+# 指標公式或欄位有變動時 +1，舊版本的狀態與收盤結果自動失效
+INDICATOR_SET_VERSION = 2
+
+# 盤中隨即時價格變動的欄位；成交量類欄位維持上一個完整交易日的值（盤中累計量會低估量比）
+LIVE_FIELDS = (
+    'rsi', 'ma20', 'ma50', 'high_52w', 'low_52w',
+    'macd', 'macd_signal', 'macd_histogram',
+    'bb_upper', 'bb_lower', 'bb_middle', 'bb_squeeze',
+    'resistance_level', 'support_level',
+)
+
+_NY = ZoneInfo('America/New_York')
+
+NAN = float('nan')
+
+class RollingStats:
+    """固定視窗的平均 / 變異數（Welford，加入與移出皆 O(1)）"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.buf: deque = deque()
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def _next(self, x: float) -> Tuple[int, float, float]:
+        n = len(self.buf)
+        if n < self.window:
+            n += 1
+            d = x - self.mean
+            mean = self.mean + d / n
+            return n, mean, self.m2 + d * (x - mean)
+        y = self.buf[0]
+        mean = self.mean + (x - y) / n
+        return n, mean, self.m2 + (x - y) * (x - mean + y - self.mean)
+
+    def push(self, x: float):
+        n, self.mean, self.m2 = self._next(x)
+        self.buf.append(x)
+        if len(self.buf) > self.window:
+            self.buf.popleft()
+
+    def peek(self, x: float) -> Tuple[float, float]:
+        """加入 x 後的 (平均, 標準差)，視窗未滿為 NaN，與 pandas rolling 預設 min_periods 相同"""
+        n, mean, m2 = self._next(x)
+        if n < self.window:
+            return NAN, NAN
+        return mean, math.sqrt(max(m2, 0.0) / (n - 1)) if n > 1 else NAN
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'buf': list(self.buf), 'mean': self.mean, 'm2': self.m2}
+
+    def load(self, data: Dict[str, Any]):
+        self.buf = deque(data['buf'])
+        self.mean = data['mean']
+        self.m2 = data['m2']
+
+class RollingExtreme:
+    """固定視窗最大 / 最小值（單調佇列，攤銷 O(1)）"""
+
+    def __init__(self, window: int, is_max: bool = True, partial: bool = False):
+        self.window = window
+        self.is_max = is_max
+        self.partial = partial      # True 時視窗未滿也回傳（對應 Series.max()）
+        self.dq: deque = deque()    # (序號, 值)
+        self.seq = 0
+
+    def _better(self, a: float, b: float) -> bool:
+        return a >= b if self.is_max else a <= b
+
+    def push(self, x: float):
+        self.seq += 1
+        while self.dq and self._better(x, self.dq[-1][1]):
+            self.dq.pop()
+        self.dq.append((self.seq, x))
+        while self.dq[0][0] <= self.seq - self.window:
+            self.dq.popleft()
+
+    def peek(self, x: float) -> float:
+        # 每次 push 後佇列都在視窗內，下一根最多只會擠掉最前面一個
+        oldest = self.seq + 1 - self.window
+        best = x
+        for i in range(min(2, len(self.dq))):
+            seq, value = self.dq[i]
+            if seq > oldest:
+                if self._better(value, best):
+                    best = value
+                break
+        if not self.partial and self.seq + 1 < self.window:
+            return NAN
+        return best
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'dq': [list(item) for item in self.dq], 'seq': self.seq}
+
+    def load(self, data: Dict[str, Any]):
+        self.dq = deque((seq, value) for seq, value in data['dq'])
+        self.seq = data['seq']
+
+class EMA:
+    """pandas ewm(span, adjust=True).mean() 的遞迴形式"""
+
+    def __init__(self, span: int):
+        self.beta = 1 - 2 / (span + 1)
+        self.num = 0.0
+        self.den = 0.0
+
+    def push(self, x: float):
+        self.num = x + self.beta * self.num
+        self.den = 1 + self.beta * self.den
+
+    def peek(self, x: float) -> float:
+        return (x + self.beta * self.num) / (1 + self.beta * self.den)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'num': self.num, 'den': self.den}
+
+    def load(self, data: Dict[str, Any]):
+        self.num = data['num']
+        self.den = data['den']
+
+class IndicatorState:
+    """單一股票的指標狀態（只包含已收盤的K線）"""
+
+    def __init__(self):
+        self.last_date: Optional[str] = None
+        self.last_close: Optional[float] = None
+        self.base: Dict[str, Any] = {}    # 最後一根收盤K線的指標結果
+        self.gains = RollingStats(14)
+        self.losses = RollingStats(14)
+        self.close20 = RollingStats(20)
+        self.close50 = RollingStats(50)
+        self.volume20 = RollingStats(20)
+        self.ema12 = EMA(12)
+        self.ema26 = EMA(26)
+        self.signal = EMA(9)
+        self.high20 = RollingExtreme(20, is_max=True)
+        self.low20 = RollingExtreme(20, is_max=False)
+        self.high_all = RollingExtreme(HISTORY_BARS, is_max=True, partial=True)
+        self.low_all = RollingExtreme(HISTORY_BARS, is_max=False, partial=True)
+
+    _PARTS = ('gains', 'losses', 'close20', 'close50', 'volume20', 'ema12', 'ema26', 'signal',
+              'high20', 'low20', 'high_all', 'low_all')
+
+    def push(self, date: str, high: float, low: float, close: float, volume: float):
+        """收盤K線併入狀態"""
+        # 第一根的 diff 為 NaN，delta.where(delta > 0, 0) 會把它當成 0
+        delta = close - self.last_close if self.last_close is not None else 0.0
+        self.gains.push(max(delta, 0.0))
+        self.losses.push(max(-delta, 0.0))
+        self.close20.push(close)
+        self.close50.push(close)
+        self.volume20.push(volume)
+        macd = self.ema12.peek(close) - self.ema26.peek(close)
+        self.ema12.push(close)
+        self.ema26.push(close)
+        self.signal.push(macd)
+        self.high20.push(high)
+        self.low20.push(low)
+        self.high_all.push(high)
+        self.low_all.push(low)
+        self.last_close = close
+        self.last_date = date
+
+    def values(self, high: float, low: float, close: float, volume: float) -> Dict[str, Any]:
+        """
+        以最新一根K線（可為盤中未收盤）計算全部指標，不改動狀態
+
+        回傳欄位與 calculate_technical_indicators 相同
+        """
+        delta = close - self.last_close if self.last_close is not None else 0.0
+        gain, _ = self.gains.peek(max(delta, 0.0))
+        loss, _ = self.losses.peek(max(-delta, 0.0))
+        if loss != loss or gain != gain or (gain == 0 and loss == 0):
+            rsi = NAN
+        elif loss == 0:
+            rsi = 100.0
+        else:
+            rsi = 100 - 100 / (1 + gain / loss)
+
+        ma20, std20 = self.close20.peek(close)
+        ma50, _ = self.close50.peek(close)
+        volume_ma, _ = self.volume20.peek(volume)
+        macd = self.ema12.peek(close) - self.ema26.peek(close)
+        macd_signal = self.signal.peek(macd)
+        bb_upper = ma20 + std20 * 2
+        bb_lower = ma20 - std20 * 2
+        volume_ratio = volume / volume_ma if volume_ma else NAN
+
+        return {
+            'rsi': float(rsi),
+            'ma20': float(ma20),
+            'ma50': float(ma50),
+            'high_52w': float(self.high_all.peek(high)),
+            'low_52w': float(self.low_all.peek(low)),
+
+            # MACD indicators
+            'macd': float(macd),
+            'macd_signal': float(macd_signal),
+            'macd_histogram': float(macd - macd_signal),
+
+            # Bollinger Bands
+            'bb_upper': float(bb_upper),
+            'bb_lower': float(bb_lower),
+            'bb_middle': float(ma20),
+            'bb_squeeze': float(bb_upper - bb_lower),
+
+            # Volume indicators
+            'volume_ma': float(volume_ma),
+            'volume_ratio': float(volume_ratio) if volume_ratio else 1,
+            'volume_trend': 'High' if volume_ratio > 1.5 else 'Normal' if volume_ratio > 0.5 else 'Low',
+
+            # Support/Resistance
+            'resistance_level': float(self.high20.peek(high)),
+            'support_level': float(self.low20.peek(low)),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {name: getattr(self, name).to_dict() for name in self._PARTS}
+        data.update(last_date=self.last_date, last_close=self.last_close,
+                    base=self.base, version=INDICATOR_SET_VERSION)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'IndicatorState':
+        if data.get('version') != INDICATOR_SET_VERSION:
+            raise ValueError(f"版本不符: {data.get('version')}")
+        state = cls()
+        for name in cls._PARTS:
+            getattr(state, name).load(data[name])
+        state.last_date = data.get('last_date')
+        state.last_close = data.get('last_close')
+        state.base = data.get('base') or {}
+        return state
+
+def _bars(hist) -> List[Tuple[str, float, float, float, float]]:
+    """DataFrame -> [(日期, 高, 低, 收, 量)]"""
+    return [
+        (idx.strftime('%Y-%m-%d'), float(h), float(l), float(c), float(v))
+        for idx, h, l, c, v in zip(hist.index, hist['High'], hist['Low'], hist['Close'], hist['Volume'])
+    ]
+
+def session_day() -> Optional[str]:
+    """美股今天已開盤時回傳今天（紐約時間）日期，否則 None"""
+    now = datetime.now(_NY)
+    if now.weekday() >= 5 or (now.hour, now.minute) < (9, 30):
+        return None
+    return now.strftime('%Y-%m-%d')
+
+class IndicatorEngine:
+    """
+    每個股票一份狀態，存在記憶體與快取（indicator_state_{symbol}）
+
+    狀態只包含已收盤的K線，並保存最後一根收盤K線的指標結果（base）；
+    以 (股票, 最後收盤日, INDICATOR_SET_VERSION) 判斷是否需要更新，兩根日K之間重複查詢不需重算。
+    今天未收盤的K線（歷史庫盤中同步的，或呼叫者傳入的即時報價）只覆蓋 LIVE_FIELDS，O(1)
+    """
+
+    def __init__(self):
+        self._states: Dict[str, IndicatorState] = {}
+        self.stats = {'rebuilds': 0, 'incremental': 0, 'memo_hits': 0, 'bars_applied': 0, 'overlays': 0}
+
+    def _state(self, symbol: str) -> Optional[IndicatorState]:
+        state = self._states.get(symbol)
+        if state is None:
+            data = cache_manager.get(f"indicator_state_{symbol}")
+            if data:
+                try:
+                    state = IndicatorState.from_dict(data)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.info(f"{symbol} 指標狀態無法沿用，重建: {e}")
+        return state
+
+    def _closed_state(self, symbol: str, hist, today: str) -> Optional[IndicatorState]:
+        """同步到最後一根收盤K線的狀態；最後收盤日沒變時直接沿用（不轉換K線）"""
+        dates = [idx.strftime('%Y-%m-%d') for idx in hist.index[-2:]]
+        closed_dates = [d for d in dates if d < today]
+        if not closed_dates:
+            return None
+
+        state = self._state(symbol)
+        if state is not None and state.last_date == closed_dates[-1]:
+            self._states[symbol] = state
+            self.stats['memo_hits'] += 1
+            return state
+
+        closed = [b for b in _bars(hist) if b[0] < today]
+        dates = [b[0] for b in closed]
+        if state is not None and state.last_date in dates:
+            new_bars = closed[dates.index(state.last_date) + 1:]
+            self.stats['incremental'] += 1
+        else:
+            # 沒有狀態，或狀態與現有K線接不上：由現有K線重建
+            state = IndicatorState()
+            new_bars = closed
+            self.stats['rebuilds'] += 1
+
+        for date, high, low, close, volume in new_bars:
+            state.base = state.values(high, low, close, volume)
+            state.push(date, high, low, close, volume)
+        self.stats['bars_applied'] += len(new_bars)
+
+        self._states[symbol] = state
+        cache_manager.set(f"indicator_state_{symbol}", state.to_dict(), cache_manager.default_ttl['indicator_state'])
+        return state
+
+    def compute(self, symbol: str, hist, live: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """
+        由日K線（與可選的即時報價）取得指標
+
+        Args:
+            hist: 日K線 DataFrame
+            live: 即時報價 {'price', 'high', 'low', 'volume'}，只在今天已開盤時套用
+        """
+        if hist.empty:
+            return {}
+        today = datetime.now(_NY).strftime('%Y-%m-%d')
+        state = self._closed_state(symbol, hist, today)
+
+        # 今天未收盤的K線：歷史庫裡的盤中K線，再以即時報價更新
+        forming = None
+        last = hist.index[-1].strftime('%Y-%m-%d')
+        if last >= today:
+            row = hist.iloc[-1]
+            forming = [float(row['High']), float(row['Low']), float(row['Close']), float(row['Volume'])]
+        if live and live.get('price') and session_day() == today:
+            price = float(live['price'])
+            if forming is None:
+                forming = [price, price, price, 0.0]
+            forming = [
+                max(forming[0], price, live.get('high') or price),
+                min(forming[1], price, live.get('low') or price),
+                price,
+                max(forming[3], float(live.get('volume') or 0)),
+            ]
+
+        if state is None:
+            # 只有一根未收盤K線（剛上市）
+            return IndicatorState().values(*forming) if forming else {}
+        if forming is None:
+            return dict(state.base)
+
+        self.stats['overlays'] += 1
+        current = state.values(*forming)
+        result = dict(state.base)
+        result.update((k, current[k]) for k in LIVE_FIELDS)
+        return result
+
+# 全局指標引擎實例
+indicator_engine = IndicatorEngine()
@@ -0,0 +1,172 @@
+# src/indicators_batch.py
+"""
+整個股票池的截面批次指標：股票 × K線 的 2D 陣列（依日期對齊、缺值補 NaN），
+沿時間軸一次向量化算出 RSI / MACD / 布林通道等，結果為欄式表格（每個指標一個陣列）
+
+公式與 calculate_technical_indicators / src/indicators.py 相同
+"""
+
+import time
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .cache import cache_manager
+from .history import history_store
+from .indicators import HISTORY_BARS
+
+logger = logging.getLogger(__name__)
+
+def _rolling(x: np.ndarray, window: int) -> np.ndarray:
+    """(N, T) -> (N, T, window) 的唯讀視窗；前 window-1 欄補 NaN 視窗，對應 pandas min_periods=window"""
+    pad = np.full((x.shape[0], window - 1), np.nan)
+    return sliding_window_view(np.concatenate([pad, x], axis=1), window, axis=1)
+
+def rolling_mean(x: np.ndarray, window: int) -> np.ndarray:
+    return _rolling(x, window).mean(axis=-1)
+
+def rolling_std(x: np.ndarray, window: int) -> np.ndarray:
+    return _rolling(x, window).std(axis=-1, ddof=1)
+
+def rolling_max(x: np.ndarray, window: int) -> np.ndarray:
+    return _rolling(x, window).max(axis=-1)
+
+def rolling_min(x: np.ndarray, window: int) -> np.ndarray:
+    return _rolling(x, window).min(axis=-1)
+
+def ewm_mean(x: np.ndarray, span: int) -> np.ndarray:
+    """
+    pandas ewm(span, adjust=True).mean()（ignore_na=False）
+
+    權重矩陣 W[t, j] = (1-α)^(t-j)，分子 / 分母各一次矩陣乘法
+    """
+    beta = 1 - 2 / (span + 1)
+    steps = x.shape[1]
+    lag = np.arange(steps)[:, None] - np.arange(steps)[None, :]
+    weights = np.where(lag >= 0, beta ** np.clip(lag, 0, None), 0.0)
+    valid = ~np.isnan(x)
+    num = np.where(valid, x, 0.0) @ weights.T
+    den = valid.astype(float) @ weights.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = num / den
+    # 尚未有任何有效值時為 NaN；當根為 NaN 時比值與前一根相同，正好是 pandas 沿用前值的行為
+    out[den == 0] = np.nan
+    return out
+
+def compute(symbols: List[str], high: np.ndarray, low: np.ndarray,
+            close: np.ndarray, volume: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    批次計算最後一根K線的指標
+
+    Args:
+        symbols: 股票代碼（N）
+        high, low, close, volume: (N, T) 陣列，依日期對齊，較短的歷史在左側補 NaN
+
+    Returns:
+        欄式表格 {欄位: 長度 N 的陣列}，欄位與 calculate_technical_indicators 相同，另含 symbol
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # RSI：第一根 diff 為 NaN 時 delta.where(delta > 0, 0) 會變成 0；補值的位置維持 NaN
+        delta = np.diff(close, axis=1, prepend=np.nan)
+        missing = np.isnan(close)
+        gain = np.where(missing, np.nan, np.where(delta > 0, delta, 0.0))
+        loss = np.where(missing, np.nan, np.where(delta < 0, -delta, 0.0))
+        gain_avg = rolling_mean(gain, 14)[:, -1]
+        loss_avg = rolling_mean(loss, 14)[:, -1]
+        rsi = 100 - 100 / (1 + gain_avg / loss_avg)
+
+        ma20 = rolling_mean(close, 20)[:, -1]
+        ma50 = rolling_mean(close, 50)[:, -1]
+
+        macd_line = ewm_mean(close, 12) - ewm_mean(close, 26)
+        signal_line = ewm_mean(macd_line, 9)
+        macd = macd_line[:, -1]
+        macd_signal = signal_line[:, -1]
+
+        std20 = rolling_std(close, 20)[:, -1]
+        bb_upper = ma20 + std20 * 2
+        bb_lower = ma20 - std20 * 2
+
+        volume_ma = rolling_mean(volume, 20)[:, -1]
+        volume_ratio = volume[:, -1] / volume_ma
+
+        any_high = ~np.isnan(high).all(axis=1)
+        high_all = np.full(len(symbols), np.nan)
+        low_all = np.full(len(symbols), np.nan)
+        high_all[any_high] = np.nanmax(high[any_high], axis=1)
+        low_all[any_high] = np.nanmin(low[any_high], axis=1)
+
+    return {
+        'symbol': np.asarray(symbols),
+        'rsi': rsi,
+        'ma20': ma20,
+        'ma50': ma50,
+        'high_52w': high_all,
+        'low_52w': low_all,
+        'macd': macd,
+        'macd_signal': macd_signal,
+        'macd_histogram': macd - macd_signal,
+        'bb_upper': bb_upper,
+        'bb_lower': bb_lower,
+        'bb_middle': ma20,
+        'bb_squeeze': bb_upper - bb_lower,
+        'volume_ma': volume_ma,
+        'volume_ratio': volume_ratio,
+        'resistance_level': rolling_max(high, 20)[:, -1],
+        'support_level': rolling_min(low, 20)[:, -1],
+    }
+
+def load_matrix(symbols: Iterable[str], days: int = HISTORY_BARS) -> Dict[str, object]:
+    """由本地歷史庫組成依日期對齊的 (N, days) 陣列；沒有數據的股票整列為 NaN"""
+    symbols = list(symbols)
+    frames = {}
+    for symbol in symbols:
+        try:
+            frames[symbol] = history_store.get_history(symbol, days)
+        except Exception as e:
+            logger.warning(f"讀取 {symbol} 歷史數據失敗: {e}")
+
+    dates = sorted(set().union(*(f.index for f in frames.values()))) if frames else []
+    dates = dates[-days:]
+    position = {d: i for i, d in enumerate(dates)}
+    shape = (len(symbols), len(dates))
+    arrays = {col: np.full(shape, np.nan) for col in ('High', 'Low', 'Close', 'Volume')}
+
+    for row, symbol in enumerate(symbols):
+        frame = frames.get(symbol)
+        if frame is None or frame.empty:
+            continue
+        frame = frame[frame.index.isin(position)]
+        cols = np.fromiter((position[d] for d in frame.index), dtype=int, count=len(frame))
+        for col, arr in arrays.items():
+            arr[row, cols] = frame[col].to_numpy(dtype=float)
+
+    return {'symbols': symbols, 'dates': dates, **arrays}
+
+def compute_universe(symbols: Iterable[str], days: int = HISTORY_BARS) -> Dict[str, np.ndarray]:
+    """整個股票池：讀取本地歷史 -> 批次計算 -> 寫入快取（batch_indicators）"""
+    start = time.perf_counter()
+    m = load_matrix(symbols, days)
+    if not m['dates']:
+        return {}
+    table = compute(m['symbols'], m['High'], m['Low'], m['Close'], m['Volume'])
+    cache_manager.set('batch_indicators', {
+        'as_of': m['dates'][-1].strftime('%Y-%m-%d'),
+        'columns': {k: v.tolist() for k, v in table.items()},
+    }, 86400)
+    logger.info(f"批次指標完成: {len(m['symbols'])} 支 × {len(m['dates'])} 根，耗時 {time.perf_counter() - start:.2f}s")
+    return table
+
+def get_cached(symbol: Optional[str] = None) -> Optional[Dict]:
+    """讀取最近一次批次結果；指定 symbol 時回傳該股票的一列"""
+    data = cache_manager.get('batch_indicators')
+    if not data or symbol is None:
+        return data
+    columns = data['columns']
+    try:
+        row = columns['symbol'].index(symbol.upper())
+    except ValueError:
+        return None
+    return {k: v[row] for k, v in columns.items()}
@@ -0,0 +1,150 @@
+# src/options_math.py
+"""
+期權計算：Max Pain、GEX（Black-Scholes gamma）、Gamma 支撐阻力位與磁吸強度；
+只依賴標準函式庫，可直接送進排程器的 CPU 行程池（子行程不需載入 yfinance / httpx）
+"""
+
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+CONTRACT_MULTIPLIER = 100
+RISK_FREE_RATE = 0.045
+DIVIDEND_YIELD = 0.0
+
+@dataclass
+class OptionRow:
+    strike: float
+    type: str              # 'call' / 'put'
+    open_interest: float
+
+@dataclass
+class OptionGreeksRow:
+    strike: float
+    type: str
+    open_interest: float
+    iv: float              # 年化隱含波動率（0.25 = 25%）
+    T: float               # 距到期年數
+
+@dataclass
+class MaxPainResult:
+    max_pain: float
+    min_total_pain: float
+    curve: List[Tuple[float, float]]   # [(履約價, 總痛苦值)]
+    contract_multiplier: int
+
+@dataclass
+class GEXResult:
+    share_gamma: float          # 每漲 $1 造市商需調整的股數
+    dollar_gamma_1pct: float    # 每漲 1% 的美元 gamma 曝險
+
+def compute_max_pain(rows: Iterable[OptionRow], contract_multiplier: int = CONTRACT_MULTIPLIER) -> MaxPainResult:
+    """所有履約價中，讓期權買方總價值（賣方痛苦）最小的結算價"""
+    rows = [r for r in rows if r.open_interest]
+    if not rows:
+        raise ValueError("沒有未平倉量")
+    strikes = sorted({r.strike for r in rows})
+    curve = []
+    for settle in strikes:
+        pain = 0.0
+        for r in rows:
+            if r.type == 'call' and settle > r.strike:
+                pain += (settle - r.strike) * r.open_interest
+            elif r.type == 'put' and settle < r.strike:
+                pain += (r.strike - settle) * r.open_interest
+        curve.append((settle, pain * contract_multiplier))
+    max_pain, min_total_pain = min(curve, key=lambda point: point[1])
+    return MaxPainResult(max_pain, min_total_pain, curve, contract_multiplier)
+
+def bs_gamma(spot: float, strike: float, T: float, r: float, q: float, iv: float) -> float:
+    """Black-Scholes gamma（calls / puts 相同）"""
+    if spot <= 0 or strike <= 0 or T <= 0 or iv <= 0:
+        return 0.0
+    sqrt_t = math.sqrt(T)
+    d1 = (math.log(spot / strike) + (r - q + iv * iv / 2) * T) / (iv * sqrt_t)
+    return math.exp(-q * T) * math.exp(-d1 * d1 / 2) / (math.sqrt(2 * math.pi) * spot * iv * sqrt_t)
+
+def _strike_gamma(rows: Iterable[OptionGreeksRow], spot: float, r: float, q: float,
+                  contract_multiplier: int) -> Dict[float, float]:
+    """每個履約價的淨 share gamma（假設造市商做多 call、做空 put）"""
+    by_strike: Dict[float, float] = {}
+    for row in rows:
+        gamma = bs_gamma(spot, row.strike, row.T, r, q, row.iv) * row.open_interest * contract_multiplier
+        by_strike[row.strike] = by_strike.get(row.strike, 0.0) + (gamma if row.type == 'call' else -gamma)
+    return by_strike
+
+def compute_gex(rows: Iterable[OptionGreeksRow], spot: float, r: float = RISK_FREE_RATE,
+                q: float = DIVIDEND_YIELD, contract_multiplier: int = CONTRACT_MULTIPLIER) -> GEXResult:
+    share_gamma = sum(_strike_gamma(rows, spot, r, q, contract_multiplier).values())
+    return GEXResult(share_gamma, share_gamma * spot * spot * 0.01)
+
+def compute_gamma_levels(rows: Iterable[OptionGreeksRow], spot: float, r: float = RISK_FREE_RATE,
+                         q: float = DIVIDEND_YIELD, contract_multiplier: int = CONTRACT_MULTIPLIER
+                         ) -> Tuple[Optional[float], Optional[float]]:
+    """現價下方 / 上方 gamma 曝險絕對值最大的履約價，作為支撐 / 阻力"""
+    by_strike = _strike_gamma(rows, spot, r, q, contract_multiplier)
+    below = [(abs(g), k) for k, g in by_strike.items() if k <= spot and g]
+    above = [(abs(g), k) for k, g in by_strike.items() if k > spot and g]
+    support = max(below)[1] if below else None
+    resistance = max(above)[1] if above else None
+    return support, resistance
+
+def magnet_strength(spot: float, max_pain: float) -> str:
+    """現價與 Max Pain 的距離換成磁吸強度（門檻同 app_sp500 的造市商分析）"""
+    if not spot or not max_pain:
+        return "⚪ 無數據"
+    distance = abs(spot - max_pain) / spot
+    if distance < 0.02:
+        return "🔴 極強磁吸"
+    if distance < 0.04:
+        return "🟡 中等磁吸"
+    return "🟢 弱磁吸"
+
+def rows_from_chain(chain: Dict[str, List[Dict[str, Any]]]) -> Tuple[List[OptionRow], List[OptionGreeksRow]]:
+    """get_options_chain 的結果轉成 Max Pain / GEX 的輸入"""
+    option_rows, greeks_rows = [], []
+    for kind in ('call', 'put'):
+        for c in chain.get(f'{kind}s') or []:
+            option_rows.append(OptionRow(c['strike'], kind, c['openInterest']))
+            if c.get('impliedVolatility') and c.get('T'):
+                greeks_rows.append(OptionGreeksRow(c['strike'], kind, c['openInterest'], c['impliedVolatility'], c['T']))
+    return option_rows, greeks_rows
+
+def max_pain_summary(symbol: str, expiry: str, chain: Dict[str, List[Dict[str, Any]]],
+                     contract_multiplier: int = CONTRACT_MULTIPLIER) -> Dict[str, Any]:
+    """maxpain_handler 的純計算部分（格式相同）"""
+    option_rows, _ = rows_from_chain(chain)
+    if not option_rows:
+        raise ValueError(f"沒有找到 {symbol} 的期權數據")
+    result = compute_max_pain(option_rows, contract_multiplier)
+    return {
+        'symbol': symbol.upper(),
+        'expiry': expiry,
+        'max_pain': result.max_pain,
+        'min_total_pain': result.min_total_pain,
+        'pain_curve': result.curve,
+        'total_strikes': len(result.curve),
+        'total_call_oi': sum(row.open_interest for row in option_rows if row.type == 'call'),
+        'total_put_oi': sum(row.open_interest for row in option_rows if row.type == 'put'),
+        'contract_multiplier': result.contract_multiplier,
+    }
+
+def gex_summary(symbol: str, expiry: str, spot: float, chain: Dict[str, List[Dict[str, Any]]],
+                r: float = RISK_FREE_RATE, q: float = DIVIDEND_YIELD,
+                contract_multiplier: int = CONTRACT_MULTIPLIER
+                ) -> Tuple[Dict[str, Any], Optional[float], Optional[float]]:
+    """gex_handler 的純計算部分（格式相同）：(GEX 結果, 支撐位, 阻力位)"""
+    _, greeks_rows = rows_from_chain(chain)
+    if greeks_rows:
+        gex = compute_gex(greeks_rows, spot, r, q, contract_multiplier)
+        support, resistance = compute_gamma_levels(greeks_rows, spot, r, q, contract_multiplier)
+    else:
+        gex, support, resistance = GEXResult(0.0, 0.0), None, None
+    return {
+        'symbol': symbol.upper(),
+        'expiry': expiry,
+        'spot_price': spot,
+        'share_gamma': gex.share_gamma,
+        'dollar_gamma_1pct': gex.dollar_gamma_1pct,
+        'total_options': len(greeks_rows),
+    }, support, resistance
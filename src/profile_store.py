@@ -0,0 +1,112 @@
+# src/profile_store.py
+"""
+公司基本資料庫：sector / industry / marketCap / PE / beta 等欄位每天只向 yfinance ticker.info 取一次，
+報價路徑不再載入龐大的 info；報價路徑遇到沒有資料的股票時在背景補抓，下次查詢即有完整欄位
+"""
+
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Any, Set
+
+import yfinance as yf
+
+from .cache import cache_manager
+from .ratelimit import rate_limiter
+from .replay import replay
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TTL = 86400  # 每日更新
+PROFILE_THREADS = int(os.getenv('PROFILE_THREADS', '2'))  # 背景補抓專用，不佔 yfinance 報價執行緒池
+FAILED_RETRY = 600   # 補抓失敗的股票多久後才再試（秒）
+
+_PROFILE_FIELDS = {
+    'name': ('shortName', 'longName'),
+    'sector': ('sector',),
+    'industry': ('industry',),
+    'market_cap': ('marketCap',),
+    'pe_ratio': ('trailingPE',),
+    'beta': ('beta',),
+    'fifty_two_week_high': ('fiftyTwoWeekHigh',),
+    'fifty_two_week_low': ('fiftyTwoWeekLow',),
+}
+
+class ProfileStore:
+    """記憶體 + 快取（Redis / 文件）兩層的公司資料"""
+
+    def __init__(self, ttl: int = PROFILE_TTL):
+        self.ttl = ttl
+        self._memory: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=PROFILE_THREADS, thread_name_prefix='profile')
+        self._inflight: Set[str] = set()
+        self._failed_at: Dict[str, float] = {}
+
+    def _fresh(self, profile: Optional[Dict[str, Any]]) -> bool:
+        return bool(profile) and time.time() - profile.get('fetched_at', 0) < self.ttl
+
+    def _fetch(self, symbol: str) -> Dict[str, Any]:
+        """唯一會呼叫 ticker.info 的地方"""
+        rate_limiter.acquire('yahoo', 5)
+        info = replay.call(f"yf:info:{symbol}", lambda: yf.Ticker(symbol).info) or {}
+        profile = {'symbol': symbol, 'fetched_at': time.time()}
+        for field, keys in _PROFILE_FIELDS.items():
+            profile[field] = next((info[k] for k in keys if info.get(k) is not None), None)
+        return profile
+
+    def get_profile(self, symbol: str, fetch: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        取得公司資料
+
+        Args:
+            symbol: 股票代碼
+            fetch: 快取過期時是否向上游更新；False 時只回傳已有資料（報價熱路徑使用），
+                並在背景補抓，不等待結果
+        """
+        symbol = symbol.upper().strip()
+        profile = self._memory.get(symbol)
+        if self._fresh(profile):
+            return profile
+
+        cached = cache_manager.get(f"company_profile_{symbol}")
+        if self._fresh(cached):
+            self._memory[symbol] = cached
+            return cached
+
+        stale = profile or cached
+        if not fetch:
+            self._refresh_in_background(symbol)
+            return stale
+
+        try:
+            profile = self._fetch(symbol)
+        except Exception as e:
+            self._failed_at[symbol] = time.time()
+            logger.warning(f"獲取 {symbol} 公司資料失敗: {e}")
+            return stale
+
+        with self._lock:
+            self._memory[symbol] = profile
+        cache_manager.set(f"company_profile_{symbol}", profile, self.ttl)
+        return profile
+
+    def _refresh_in_background(self, symbol: str):
+        """在專用執行緒補抓一次（同一股票不重複排入，失敗後 FAILED_RETRY 秒內不再試）"""
+        with self._lock:
+            if symbol in self._inflight or time.time() - self._failed_at.get(symbol, 0) < FAILED_RETRY:
+                return
+            self._inflight.add(symbol)
+        self._pool.submit(self._refresh, symbol)
+
+    def _refresh(self, symbol: str):
+        try:
+            self.get_profile(symbol)
+        finally:
+            with self._lock:
+                self._inflight.discard(symbol)
+
+# 全局公司資料庫實例
+profile_store = ProfileStore()
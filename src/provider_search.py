@@ -1,24 +1,56 @@
 # src/provider_search.py
+import os, time
 import httpx
-from typing import List, Dict
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+from .ratelimit import RequestCoalescer
+from .replay import replay
 
 YF_SEARCH = "https://query2.finance.yahoo.com/v1/finance/search"
 
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))  # 秒
+SEARCH_CACHE_SIZE = 512
+
 # 常見美股交易所縮寫（Yahoo 的 exchDisp / exchange）
 _US_EXCH = {"NYSE", "NASDAQ", "AMEX"}
 _US_EXCH_CODES = {"NYQ", "NMS", "NCM", "NGM", "ASE", "PCX"}  # 有些資料用代碼
 
+try:
+    import h2  # noqa: F401  有安裝 h2 才啟用 HTTP/2
+    _HTTP2 = True
+except Exception:
+    _HTTP2 = False
+
+_client: Optional[httpx.AsyncClient] = None
+_cache: "OrderedDict[Tuple[str, int, bool], Tuple[float, List[Dict]]]" = OrderedDict()
+_inflight = RequestCoalescer()
+
+def _get_client() -> httpx.AsyncClient:
+    """模組共用的連線池（keep-alive），第一次使用時建立"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=12,
+            http2=_HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
+        )
+    return _client
+
+async def aclose_client():
+    """關閉共用連線池（服務關閉時呼叫）"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 def _is_us_equity(hit: dict) -> bool:
     qt = (hit.get("quoteType") or "").upper()
     exch = (hit.get("exchDisp") or hit.get("exchange") or "").upper()
     return (qt in {"EQUITY", "ETF", "MUTUALFUND"} and
             (exch in _US_EXCH or exch in _US_EXCH_CODES))
 
-async def yf_search(query: str, limit: int = 10, us_only: bool = True) -> List[Dict]:
-    """
-    用 Yahoo Finance 搜尋字串（模糊），回傳精簡清單：
-    [{symbol, name, exchDisp, type}]
-    """
+async def _fetch(query: str, limit: int, us_only: bool) -> List[Dict]:
     params = {
         "q": query,
         "quotesCount": limit,
@@ -27,10 +59,10 @@ async def yf_search(query: str, limit: int = 10, us_only: bool = True) -> List[D
         "lang": "zh-TW",
         "region": "US",
     }
-    async with httpx.AsyncClient(timeout=12) as client:
-        r = await client.get(YF_SEARCH, params=params)
-        r.raise_for_status()
-        data = r.json()
+    r = await _get_client().get(replay.url(YF_SEARCH), params=params)
+    replay.record(f"{YF_SEARCH}?{r.url.query.decode()}", r.status_code, r.text)
+    r.raise_for_status()
+    data = r.json()
 
     results = []
     for q in (data.get("quotes") or []):
@@ -45,3 +77,23 @@ async def yf_search(query: str, limit: int = 10, us_only: bool = True) -> List[D
         if len(results) >= limit:
             break
     return results
+
+async def yf_search(query: str, limit: int = 10, us_only: bool = True) -> List[Dict]:
+    """
+    用 Yahoo Finance 搜尋字串（模糊），回傳精簡清單：
+    [{symbol, name, exchDisp, type}]
+    結果依 (query, limit, us_only) 快取 SEARCH_CACHE_TTL 秒，並發的相同搜尋只發一次請求
+    """
+    key = (" ".join(query.lower().split()), limit, us_only)
+    hit = _cache.get(key)
+    if hit and hit[0] > time.time():
+        _cache.move_to_end(key)
+        return list(hit[1])
+
+    results = await _inflight.run(repr(key), lambda: _fetch(query, limit, us_only))
+
+    _cache[key] = (time.time() + SEARCH_CACHE_TTL, results)
+    _cache.move_to_end(key)
+    while len(_cache) > SEARCH_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return list(results)
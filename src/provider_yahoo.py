@@ -1,11 +1,26 @@
+import os
+import asyncio
+import functools
 import yfinance as yf
 import requests
+import httpx
 import logging
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import time
-from typing import Dict, Optional, List
+from typing import Callable, Dict, FrozenSet, Optional, List
 import pandas as pd
 
+from .ratelimit import rate_limiter, request_coalescer
+from .profile_store import profile_store
+from .universe import sp500_universe
+from .replay import replay
+from .stream import quote_stream
+from .scheduler import scheduler
+
+# 同步呼叫配額不足時最多排隊等待的秒數
+YAHOO_MAX_WAIT = 5
+
 logger = logging.getLogger(__name__)
 
 class YahooProvider:
@@ -23,10 +38,15 @@ class YahooProvider:
         if not self._validate_symbol_format(symbol):
             raise ValueError(f"無效的股票代碼格式: {symbol}")
         
-        # 嘗試多種方法獲取數據
+        # 已訂閱推播的股票直接使用串流報價
+        streamed = self._streamed_quote(symbol)
+        if streamed:
+            return streamed
+        
+        # 嘗試多種方法獲取數據（輕量的 chart 端點優先）
         methods = [
-            self._get_data_yfinance,
             self._get_data_direct_api,
+            self._get_data_yfinance,
             self._get_data_fallback
         ]
         
@@ -46,13 +66,30 @@ class YahooProvider:
         # 所有方法都失敗
         raise Exception(f"無法獲取股票 {symbol} 的數據。最後錯誤: {last_error}")
     
+    def _streamed_quote(self, symbol: str) -> Optional[Dict]:
+        streamed = quote_stream.get_quote(symbol)
+        if streamed:
+            profile = profile_store.get_profile(symbol, fetch=False) or {}
+            streamed.update(
+                name=profile.get('name') or symbol,
+                market_cap=profile.get('market_cap'),
+                pe_ratio=profile.get('pe_ratio'),
+                fifty_two_week_high=profile.get('fifty_two_week_high'),
+                fifty_two_week_low=profile.get('fifty_two_week_low'),
+            )
+        return streamed
+    
     def nearest_expiry(self, symbol: str) -> Optional[str]:
         """
         獲取最近的期權到期日
         """
         try:
-            ticker = yf.Ticker(symbol)
-            options = ticker.options
+            def fetch():
+                # 只有真正發出請求的呼叫者扣令牌，合併進來的跟隨者不扣
+                rate_limiter.acquire('yahoo', YAHOO_MAX_WAIT)
+                return replay.call(f"yf:options:{symbol}", lambda: tuple(yf.Ticker(symbol).options))
+            
+            options = request_coalescer.do(f"yf:options:{symbol}", fetch)
             if options and len(options) > 0:
                 return options[0]  # 返回最近的到期日
             return None
@@ -74,10 +111,13 @@ class YahooProvider:
                     return {"error": "無可用的期權數據"}
             
             # 獲取期權鏈
-            option_chain = ticker.option_chain(expiry_date)
+            key = f"yf:option_chain:{symbol}:{expiry_date}"
+            
+            def fetch():
+                rate_limiter.acquire('yahoo', YAHOO_MAX_WAIT)
+                return replay.call(key, lambda: tuple(ticker.option_chain(expiry_date)[:2]))
             
-            calls = option_chain.calls
-            puts = option_chain.puts
+            calls, puts = request_coalescer.do(key, fetch)
             
             return {
                 "symbol": symbol,
@@ -91,14 +131,56 @@ class YahooProvider:
         except Exception as e:
             logger.error(f"獲取 {symbol} 期權數據失敗: {e}")
             return {"error": str(e)}
-    
+
+    def get_options_chain(self, symbol: str, expiry_date: str = None) -> Dict:
+        """
+        獲取整理過的期權鏈（同步；Max Pain / GEX 計算的輸入）
+
+        Returns:
+            {'expiry', 'calls': [...], 'puts': [...]}，每筆含 strike、openInterest、
+            impliedVolatility（缺值為 None）與 T（距到期年數）；取不到時拋出例外
+        """
+        # 明確呼叫同步版本：AsyncYahooProvider 把這兩個方法覆寫成協程
+        if not expiry_date:
+            expiry_date = YahooProvider.nearest_expiry(self, symbol)
+            if not expiry_date:
+                raise ValueError(f"{symbol} 無可用的期權到期日")
+        data = YahooProvider.get_options_data(self, symbol, expiry_date)
+        if "error" in data:
+            raise ValueError(f"{symbol} 期權鏈取得失敗: {data['error']}")
+
+        # 到期日當天美東 16:00 收盤（以 20:00 UTC 近似），時間以年計，避免當天到期的 T 變成 0
+        close = datetime.strptime(expiry_date, "%Y-%m-%d").replace(hour=20, tzinfo=timezone.utc)
+        T = max((close - datetime.now(timezone.utc)).total_seconds() / (365 * 24 * 3600), 1 / (365 * 24))
+
+        def rows(records):
+            out = []
+            for c in records:
+                oi, iv = c.get('openInterest'), c.get('impliedVolatility')
+                out.append({
+                    'strike': float(c['strike']),
+                    'openInterest': 0 if pd.isna(oi) else int(oi),
+                    'impliedVolatility': None if iv is None or pd.isna(iv) else float(iv),
+                    'T': T,
+                })
+            return out
+
+        return {"expiry": expiry_date, "calls": rows(data["calls"]), "puts": rows(data["puts"])}
+
     def calculate_max_pain(self, symbol: str, expiry_date: str = None) -> Dict:
         """
         計算 Max Pain 點
         """
         try:
-            options_data = self.get_options_data(symbol, expiry_date)
-            
+            return self._max_pain_from(self.get_options_data(symbol, expiry_date))
+        except Exception as e:
+            logger.error(f"計算 {symbol} Max Pain 失敗: {e}")
+            return {"error": str(e)}
+    
+    def _max_pain_from(self, options_data: Dict) -> Dict:
+        """由期權數據計算 Max Pain（同步、純計算）"""
+        symbol = options_data.get("symbol")
+        try:
             if "error" in options_data:
                 return options_data
             
@@ -159,37 +241,36 @@ class YahooProvider:
         return True
     
     def _get_data_yfinance(self, symbol: str) -> Dict:
-        """使用 yfinance 獲取數據"""
-        ticker = yf.Ticker(symbol)
+        """使用 yfinance fast_info 獲取數據（不載入 ticker.info）"""
+        rate_limiter.acquire('yahoo', YAHOO_MAX_WAIT)
+        fields = ('lastPrice', 'previousClose', 'regularMarketPreviousClose',
+                  'lastVolume', 'marketCap', 'yearHigh', 'yearLow')
         
-        # 獲取基本信息
-        info = ticker.info
+        def fetch():
+            info = yf.Ticker(symbol).fast_info
+            return {k: info.get(k) for k in fields}
         
-        # 檢查是否為有效股票
-        if not info or 'symbol' not in info:
-            raise ValueError(f"yfinance 找不到股票: {symbol}")
+        fast = replay.call(f"yf:fast_info:{symbol}", fetch)
         
-        # 獲取歷史數據
-        hist = ticker.history(period="5d")
-        if hist.empty:
-            raise ValueError(f"無法獲取 {symbol} 歷史數據")
+        current_price = fast.get('lastPrice')
+        previous_close = fast.get('previousClose') or fast.get('regularMarketPreviousClose')
+        if not current_price or not previous_close:
+            raise ValueError(f"yfinance 找不到股票: {symbol}")
         
-        # 獲取當前價格
-        current_price = self._extract_current_price(info, hist)
-        previous_close = info.get('previousClose', hist['Close'][-2] if len(hist) > 1 else current_price)
+        profile = profile_store.get_profile(symbol, fetch=False) or {}
         
         return {
-            'symbol': info.get('symbol', symbol),
-            'name': info.get('shortName') or info.get('longName', symbol),
+            'symbol': symbol,
+            'name': profile.get('name') or symbol,
             'current_price': float(current_price),
             'previous_close': float(previous_close),
             'change': float(current_price - previous_close),
             'change_percent': float((current_price - previous_close) / previous_close * 100),
-            'volume': int(info.get('volume', 0)),
-            'market_cap': info.get('marketCap'),
-            'pe_ratio': info.get('trailingPE'),
-            'fifty_two_week_high': info.get('fiftyTwoWeekHigh'),
-            'fifty_two_week_low': info.get('fiftyTwoWeekLow'),
+            'volume': int(fast.get('lastVolume') or 0),
+            'market_cap': fast.get('marketCap') or profile.get('market_cap'),
+            'pe_ratio': profile.get('pe_ratio'),
+            'fifty_two_week_high': fast.get('yearHigh'),
+            'fifty_two_week_low': fast.get('yearLow'),
             'data_source': 'Yahoo Finance (yfinance)',
             'timestamp': datetime.now().isoformat()
         }
@@ -202,33 +283,50 @@ class YahooProvider:
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
-        try:
-            response = requests.get(url, headers=headers, timeout=10)
+        def fetch():
+            rate_limiter.acquire('yahoo', YAHOO_MAX_WAIT)
+            response = requests.get(replay.url(url), headers=headers, timeout=10)
+            replay.record(url, response.status_code, response.text)
+            if response.status_code == 429:
+                rate_limiter.drain('yahoo')
             response.raise_for_status()
-            
-            data = response.json()
+            return response.json()
+        
+        try:
+            return self._parse_chart(symbol, request_coalescer.do(url, fetch))
+        except requests.RequestException as e:
+            raise Exception(f"API請求失敗: {e}")
+    
+    def _parse_chart(self, symbol: str, data: Dict) -> Dict:
+        """解析 chart 端點回應"""
+        try:
             result = data['chart']['result'][0]
             
             # 提取數據
             meta = result['meta']
             current_price = meta['regularMarketPrice']
-            previous_close = meta['previousClose']
+            previous_close = meta.get('previousClose') or meta['chartPreviousClose']
+            
+            # 基本面欄位來自每日更新的公司資料庫，不在報價路徑上抓取
+            profile = profile_store.get_profile(symbol, fetch=False) or {}
             
             return {
                 'symbol': meta['symbol'],
-                'name': meta.get('shortName', symbol),
+                'name': meta.get('shortName') or profile.get('name') or symbol,
                 'current_price': float(current_price),
                 'previous_close': float(previous_close),
                 'change': float(current_price - previous_close),
                 'change_percent': float((current_price - previous_close) / previous_close * 100),
                 'volume': int(meta.get('regularMarketVolume', 0)),
+                'market_cap': profile.get('market_cap'),
+                'pe_ratio': profile.get('pe_ratio'),
+                'fifty_two_week_high': meta.get('fiftyTwoWeekHigh') or profile.get('fifty_two_week_high'),
+                'fifty_two_week_low': meta.get('fiftyTwoWeekLow') or profile.get('fifty_two_week_low'),
                 'data_source': 'Yahoo Finance (Direct API)',
                 'timestamp': datetime.now().isoformat()
             }
             
-        except requests.RequestException as e:
-            raise Exception(f"API請求失敗: {e}")
-        except (KeyError, IndexError) as e:
+        except (KeyError, IndexError, TypeError) as e:
             raise Exception(f"數據解析失敗: {e}")
     
     def _get_data_fallback(self, symbol: str) -> Dict:
@@ -265,24 +363,6 @@ class YahooProvider:
         
         raise Exception(f"備用方法也無法獲取 {symbol} 數據")
     
-    def _extract_current_price(self, info: Dict, hist) -> float:
-        """提取當前價格"""
-        price_fields = [
-            'currentPrice',
-            'regularMarketPrice', 
-            'previousClose'
-        ]
-        
-        for field in price_fields:
-            if field in info and info[field]:
-                return float(info[field])
-        
-        # 使用歷史數據的最新價格
-        if not hist.empty:
-            return float(hist['Close'][-1])
-        
-        raise ValueError("無法獲取當前價格")
-    
     def search_symbol(self, query: str) -> List[Dict]:
         """搜索股票代碼"""
         try:
@@ -310,37 +390,162 @@ class YahooProvider:
             logger.error(f"搜索股票失敗: {e}")
             return []
     
-    def get_sp500_list(self) -> List[str]:
+    def get_sp500_list(self) -> FrozenSet[str]:
+        """
+        獲取標普500股票清單（本地快照，每日條件式更新；不可變集合，成員查詢 O(1)）
+        """
+        sp500_universe.refresh()
+        return sp500_universe.symbols
+
+# yfinance 只有同步介面，非同步路徑上仍需呼叫時丟到有界執行緒池，避免阻塞事件迴圈
+YF_THREADS = int(os.getenv('YF_THREADS', '4'))
+MAX_PAIN_DEADLINE = float(os.getenv('MAX_PAIN_DEADLINE', '5'))
+_yf_pool = ThreadPoolExecutor(max_workers=YF_THREADS, thread_name_prefix='yfinance')
+
+def ensure_blocking_threads(n: int):
+    """批次工具（例如每日報告）的並發高於預設時，把 yfinance 執行緒池擴大到至少 n 個"""
+    global _yf_pool
+    if n > _yf_pool._max_workers:
+        old, _yf_pool = _yf_pool, ThreadPoolExecutor(max_workers=n, thread_name_prefix='yfinance')
+        old.shutdown(wait=False)
+
+async def run_blocking(fn: Callable, *args):
+    """在 yfinance 執行緒池執行同步呼叫"""
+    return await asyncio.get_running_loop().run_in_executor(_yf_pool, functools.partial(fn, *args))
+
+class AsyncYahooProvider(YahooProvider):
+    """
+    YahooProvider 的協程版本：chart / options 端點走共用的 httpx 連線池，
+    只有 yfinance 才有的呼叫（fast_info、需要 crumb 的期權鏈）才進執行緒池
+    """
+    
+    options_url = "https://query2.finance.yahoo.com/v7/finance/options/"
+    OPTIONS_API_RETRY = 3600   # options 端點因缺 crumb 被拒後，多久內直接走 yfinance（秒）
+    
+    _client: Optional[httpx.AsyncClient] = None
+    _options_blocked_until = 0.0
+    
+    @classmethod
+    def _get_client(cls) -> httpx.AsyncClient:
+        if cls._client is None or cls._client.is_closed:
+            cls._client = httpx.AsyncClient(
+                timeout=10,
+                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+            )
+        return cls._client
+    
+    @classmethod
+    async def aclose(cls):
+        """關閉共用連線池（服務關閉時呼叫）"""
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+    
+    async def _get_json(self, url: str) -> Dict:
+        async def fetch():
+            await rate_limiter.acquire_async('yahoo', YAHOO_MAX_WAIT)
+            response = await self._get_client().get(replay.url(url))
+            replay.record(url, response.status_code, response.text)
+            if response.status_code == 429:
+                rate_limiter.drain('yahoo')
+            response.raise_for_status()
+            return response.json()
+        
+        return await request_coalescer.run(url, fetch)
+    
+    async def get_stock_data(self, symbol: str) -> Dict:
         """
-        獲取標普500股票清單
+        獲取股票數據（協程版本）
         """
+        symbol = symbol.upper().strip()
+        if not self._validate_symbol_format(symbol):
+            raise ValueError(f"無效的股票代碼格式: {symbol}")
+        
+        streamed = self._streamed_quote(symbol)
+        if streamed:
+            return streamed
+        
+        last_error = None
         try:
-            # 從 Wikipedia 獲取標普500清單
-            url = "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies"
-            tables = pd.read_html(url)
-            sp500_table = tables[0]
-            
-            # 提取股票代碼
-            symbols = sp500_table['Symbol'].tolist()
-            
-            # 清理符號（移除特殊字符）
-            clean_symbols = []
-            for symbol in symbols:
-                if isinstance(symbol, str):
-                    # 替換常見的特殊字符
-                    clean_symbol = symbol.replace('.', '-')
-                    clean_symbols.append(clean_symbol)
-            
-            return clean_symbols
-            
+            return self._parse_chart(symbol, await self._get_json(f"{self.base_url}{symbol}"))
+        except Exception as e:
+            logger.warning(f"chart 端點失敗: {e}")
+            last_error = e
+        try:
+            return await run_blocking(self._get_data_yfinance, symbol)
+        except Exception as e:
+            logger.warning(f"_get_data_yfinance 失敗: {e}")
+            last_error = e
+        try:
+            return self._get_data_fallback(symbol)
+        except Exception:
+            raise Exception(f"無法獲取股票 {symbol} 的數據。最後錯誤: {last_error}")
+    
+    async def _option_chain(self, symbol: str, expiry_date: Optional[str] = None) -> Dict:
+        # 被拒過就先不打 v7，避免每次都白花一個 yahoo 令牌再退回 yfinance
+        if time.time() < AsyncYahooProvider._options_blocked_until:
+            raise RuntimeError("options 端點需要 crumb，暫停使用")
+        url = f"{self.options_url}{symbol}"
+        if expiry_date:
+            epoch = int(datetime.strptime(expiry_date, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+            url += f"?date={epoch}"
+        try:
+            return (await self._get_json(url))['optionChain']['result'][0]
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (401, 403):
+                AsyncYahooProvider._options_blocked_until = time.time() + self.OPTIONS_API_RETRY
+            raise
+    
+    async def nearest_expiry(self, symbol: str) -> Optional[str]:
+        """
+        獲取最近的期權到期日（協程版本）
+        """
+        try:
+            dates = (await self._option_chain(symbol)).get('expirationDates') or []
+            if dates:
+                return datetime.fromtimestamp(dates[0], timezone.utc).strftime('%Y-%m-%d')
+            return None
+        except Exception as e:
+            # options 端點需要 crumb，被拒時改用 yfinance
+            logger.info(f"options 端點失敗，改用 yfinance: {e}")
+            return await run_blocking(super().nearest_expiry, symbol)
+    
+    async def get_options_data(self, symbol: str, expiry_date: str = None) -> Dict:
+        """
+        獲取期權數據（協程版本）
+        """
+        if not expiry_date:
+            expiry_date = await self.nearest_expiry(symbol)
+            if not expiry_date:
+                return {"error": "無可用的期權數據"}
+        try:
+            chain = (await self._option_chain(symbol, expiry_date))['options'][0]
+            calls = [dict(c, openInterest=c.get('openInterest', 0)) for c in chain.get('calls', [])]
+            puts = [dict(p, openInterest=p.get('openInterest', 0)) for p in chain.get('puts', [])]
+            return {
+                "symbol": symbol,
+                "expiry_date": expiry_date,
+                "calls": calls,
+                "puts": puts,
+                "call_count": len(calls),
+                "put_count": len(puts)
+            }
+        except Exception as e:
+            logger.info(f"options 端點失敗，改用 yfinance: {e}")
+            return await run_blocking(super().get_options_data, symbol, expiry_date)
+    
+    async def calculate_max_pain(self, symbol: str, expiry_date: str = None) -> Dict:
+        """
+        計算 Max Pain 點（協程版本；逐履約價的計算交給排程器的行程池）
+        """
+        options_data = await self.get_options_data(symbol, expiry_date)
+        try:
+            return await scheduler.run('cpu', self._max_pain_from, options_data,
+                                       deadline=MAX_PAIN_DEADLINE, key=symbol)
         except Exception as e:
-            logger.error(f"獲取標普500清單失敗: {e}")
-            # 返回主要的股票作為備用
-            return [
-                'AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA', 'META', 'NVDA', 'BRK-B',
-                'UNH', 'JNJ', 'V', 'PG', 'JPM', 'HD', 'MA', 'BAC', 'ABBV', 'PFE',
-                'KO', 'AVGO', 'PEP', 'TMO', 'COST', 'DIS', 'ABT', 'MRK', 'VZ', 'ADBE'
-            ]
+            logger.error(f"計算 {symbol} Max Pain 失敗: {type(e).__name__} {e}")
+            return {"error": f"Max Pain 計算逾時或被拒: {type(e).__name__}"}
 
 # 測試函數
 def test_provider():
@@ -0,0 +1,162 @@
+# src/quota.py
+"""
+每日查詢配額：以 Redis INCR + EXPIREAT（台北時間午夜重置）原子計數，
+檢查與扣減同一次往返完成，多個 worker 共用同一份額度；
+沒有 Redis 時使用行程內的本地計數器（單一 worker 與測試用）
+"""
+
+import os
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from .cache import _r
+
+logger = logging.getLogger(__name__)
+
+FREE_DAILY_LIMIT = int(os.getenv('FREE_DAILY_LIMIT', '3'))
+
+_TAIPEI = ZoneInfo('Asia/Taipei')
+
+def quota_day(now: Optional[datetime] = None) -> str:
+    """配額所屬的台北日期"""
+    return (now or datetime.now(_TAIPEI)).astimezone(_TAIPEI).strftime('%Y-%m-%d')
+
+def next_reset(now: Optional[datetime] = None) -> datetime:
+    """下一次重置時間（台北午夜）"""
+    now = (now or datetime.now(_TAIPEI)).astimezone(_TAIPEI)
+    return now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+class RedisQuotaBackend:
+    """Redis：MULTI { INCR; EXPIREAT } 一次往返"""
+
+    name = 'Redis'
+
+    def incr(self, key: str, expire_at: int) -> int:
+        pipe = _r().pipeline(transaction=True)
+        pipe.incr(key)
+        pipe.expireat(key, expire_at)
+        count, _ = pipe.execute()
+        return int(count)
+
+    def decr(self, key: str) -> int:
+        count = int(_r().decr(key))
+        if count < 0:
+            count = int(_r().incr(key))   # 沒有可退的次數，補回 0（INCR 保留原本的 TTL）
+        return count
+
+    def get(self, key: str) -> int:
+        return int(_r().get(key) or 0)
+
+    def seed(self, key: str, count: int, expire_at: int):
+        pass  # Redis 本身就是共用狀態
+
+class LocalQuotaBackend:
+    """行程內計數器，語意與 Redis 版相同（到期後歸零）"""
+
+    name = 'Local'
+
+    def __init__(self):
+        self._counts: Dict[str, Tuple[int, int]] = {}   # key -> (次數, 到期時間)
+        self._lock = threading.Lock()
+
+    def _current(self, key: str) -> int:
+        count, expire_at = self._counts.get(key, (0, 0))
+        if expire_at and time.time() >= expire_at:
+            del self._counts[key]
+            return 0
+        return count
+
+    def incr(self, key: str, expire_at: int) -> int:
+        with self._lock:
+            count = self._current(key) + 1
+            self._counts[key] = (count, expire_at)
+            return count
+
+    def decr(self, key: str) -> int:
+        with self._lock:
+            count = max(self._current(key) - 1, 0)
+            if key in self._counts:
+                self._counts[key] = (count, self._counts[key][1])
+            return count
+
+    def get(self, key: str) -> int:
+        with self._lock:
+            return self._current(key)
+
+    def seed(self, key: str, count: int, expire_at: int):
+        with self._lock:
+            self._counts[key] = (max(count, self._current(key)), expire_at)
+
+class QuotaCounter:
+    """每位用戶每日查詢次數"""
+
+    def __init__(self, limit: int = FREE_DAILY_LIMIT, backend=None):
+        self.limit = limit
+        self.backend = backend or (RedisQuotaBackend() if _r() else LocalQuotaBackend())
+        self.stats = {'allowed': 0, 'denied': 0, 'refunded': 0, 'errors': 0}
+
+    @property
+    def shared(self) -> bool:
+        """計數是否跨 worker 共用（否則呼叫端需自行持久化）"""
+        return isinstance(self.backend, RedisQuotaBackend)
+
+    @staticmethod
+    def _key(user_id: int, day: str) -> str:
+        return f'quota:{day}:{user_id}'
+
+    def try_consume(self, user_id: int) -> Tuple[bool, int]:
+        """
+        原子地扣一次額度
+
+        Returns:
+            (是否允許, 扣減後的次數)；超過額度的嘗試也會計數，但不會被允許
+        """
+        now = datetime.now(_TAIPEI)
+        try:
+            count = self.backend.incr(self._key(user_id, quota_day(now)), int(next_reset(now).timestamp()))
+        except Exception as e:
+            # 配額服務故障時不擋用戶
+            self.stats['errors'] += 1
+            logger.warning(f"配額計數失敗 {user_id}: {e}")
+            return True, 0
+        allowed = count <= self.limit
+        self.stats['allowed' if allowed else 'denied'] += 1
+        return allowed, min(count, self.limit)
+
+    def refund(self, user_id: int) -> int:
+        """退回一次額度（查詢最終沒有執行時），回傳退回後的次數"""
+        try:
+            count = self.backend.decr(self._key(user_id, quota_day()))
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning(f"配額退回失敗 {user_id}: {e}")
+            return self.used(user_id)
+        self.stats['refunded'] += 1
+        return min(count, self.limit)
+
+    def used(self, user_id: int) -> int:
+        """今日已用次數（不扣減）"""
+        try:
+            return min(self.backend.get(self._key(user_id, quota_day())), self.limit)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning(f"配額讀取失敗 {user_id}: {e}")
+            return 0
+
+    def seed(self, day: str, counts: Dict[int, int]):
+        """啟動時以持久化的當日次數初始化本地計數器（Redis 版忽略）"""
+        if day != quota_day():
+            return
+        expire_at = int(next_reset().timestamp())
+        for user_id, count in counts.items():
+            self.backend.seed(self._key(user_id, day), count, expire_at)
+
+    def get_stats(self):
+        return dict(self.stats, backend=self.backend.name, limit=self.limit)
+
+# 全局查詢配額實例
+query_quota = QuotaCounter()
@@ -0,0 +1,256 @@
+# src/ratelimit.py
+"""
+上游 API 配額控制：每個數據源一個令牌桶（進程內共用，可選 Redis 跨 worker 共用），
+以及相同請求的合併（single-flight），避免突發流量把配額燒光
+"""
+
+import os
+import time
+import asyncio
+import threading
+import logging
+from typing import Dict, Optional, Any, Callable, Awaitable, Tuple
+
+from .cache import _r
+
+logger = logging.getLogger(__name__)
+
+# 各數據源預設配額：(每分鐘請求數, 桶容量)
+DEFAULT_LIMITS = {
+    'alpha_vantage': (5, 5),      # 免費版 5 次/分鐘
+    'finnhub': (60, 10),          # 免費版 60 次/分鐘
+    'polygon': (5, 5),            # 免費版 5 次/分鐘
+    'yahoo': (100, 20),           # 非官方端點，保守估計
+    'telegram': (1800, 30),       # Bot API 推播約 30 則/秒
+}
+
+# 配額不足時最多排隊等待的秒數（超過則直接改走下一個數據源）
+MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '0'))
+
+_REDIS_BUCKET_SCRIPT = """
+local tokens_key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local data = redis.call('HMGET', tokens_key, 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', tokens_key, 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', tokens_key, math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+class RateLimitExceeded(Exception):
+    """數據源配額已用完，呼叫者應改走其他來源而不是送出必定 429 的請求"""
+
+    def __init__(self, provider: str, wait: float):
+        super().__init__(f"{provider} 配額已用完，需等待 {wait:.1f} 秒")
+        self.provider = provider
+        self.wait = wait
+
+class TokenBucket:
+    """進程內令牌桶"""
+
+    def __init__(self, per_minute: float, capacity: float):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """嘗試取得一個令牌；成功回傳 0，否則回傳需要等待的秒數（不扣令牌）"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def drain(self):
+        """收到上游 429 時清空令牌，讓其他呼叫者不再浪費請求"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = 0.0
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+class RedisTokenBucket:
+    """以 Redis Lua 腳本實作的令牌桶，多個 worker 共用同一份配額"""
+
+    def __init__(self, name: str, per_minute: float, capacity: float):
+        self.key = f'ratelimit:{name}'
+        self.rate = per_minute / 60.0
+        self.capacity = capacity
+
+    def take(self) -> float:
+        r = _r()
+        return float(r.eval(_REDIS_BUCKET_SCRIPT, 1, self.key, self.rate, self.capacity, time.time()))
+
+    def drain(self):
+        _r().hset(self.key, mapping={'tokens': 0, 'ts': time.time()})
+
+    def available(self) -> float:
+        r = _r()
+        tokens, ts = r.hmget(self.key, 'tokens', 'ts')
+        if tokens is None:
+            return float(self.capacity)
+        return min(self.capacity, float(tokens) + max(0.0, time.time() - float(ts)) * self.rate)
+
+class RateLimiter:
+    """各數據源令牌桶的註冊表"""
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.limits = dict(limits or DEFAULT_LIMITS)
+        self._buckets: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self.denied: Dict[str, int] = {}
+
+    def _bucket(self, provider: str):
+        with self._lock:
+            bucket = self._buckets.get(provider)
+            if bucket is None:
+                per_minute, capacity = self.limits.get(provider, (60, 10))
+                if _r():
+                    bucket = RedisTokenBucket(provider, per_minute, capacity)
+                else:
+                    bucket = TokenBucket(per_minute, capacity)
+                self._buckets[provider] = bucket
+            return bucket
+
+    def _take(self, provider: str) -> float:
+        try:
+            return self._bucket(provider).take()
+        except Exception as e:
+            # Redis 不可用時不阻擋請求
+            logger.warning(f"限流器讀取失敗 {provider}: {e}")
+            return 0.0
+
+    def _deny(self, provider: str, wait: float):
+        self.denied[provider] = self.denied.get(provider, 0) + 1
+        raise RateLimitExceeded(provider, wait)
+
+    def acquire(self, provider: str, max_wait: Optional[float] = None):
+        """同步取得配額；需等待超過 max_wait 秒時拋出 RateLimitExceeded"""
+        max_wait = MAX_WAIT if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._take(provider)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                self._deny(provider, wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, provider: str, max_wait: Optional[float] = None):
+        """非同步取得配額；需等待超過 max_wait 秒時拋出 RateLimitExceeded"""
+        max_wait = MAX_WAIT if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._take(provider)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                self._deny(provider, wait)
+            await asyncio.sleep(wait)
+
+    def drain(self, provider: str):
+        """上游回傳 429 時呼叫"""
+        try:
+            self._bucket(provider).drain()
+            logger.warning(f"{provider} 回傳 429，清空本地令牌")
+        except Exception as e:
+            logger.warning(f"限流器清空失敗 {provider}: {e}")
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for provider in self.limits:
+            try:
+                available = round(self._bucket(provider).available(), 2)
+            except Exception:
+                available = None
+            stats[provider] = {
+                'per_minute': self.limits[provider][0],
+                'available': available,
+                'denied': self.denied.get(provider, 0),
+            }
+        return stats
+
+class RequestCoalescer:
+    """相同 key（通常為 URL）的並發請求只發出一次上游呼叫，結果共享給所有等待者"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._sync_inflight: Dict[str, Dict[str, Any]] = {}
+        self._sync_lock = threading.Lock()
+        self.coalesced = 0
+
+    async def run(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """非同步版本：同一事件循環內共用進行中的 Future"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fetch()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 沒有其他等待者時避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def do(self, key: str, fetch: Callable[[], Any]) -> Any:
+        """同步版本：多執行緒共用進行中的呼叫"""
+        with self._sync_lock:
+            call = self._sync_inflight.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._sync_inflight[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fetch()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._sync_lock:
+                self._sync_inflight.pop(key, None)
+            call['event'].set()
+
+# 全局實例（同一進程內所有呼叫者共用）
+rate_limiter = RateLimiter()
+request_coalescer = RequestCoalescer()
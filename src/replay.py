@@ -0,0 +1,175 @@
+# src/replay.py
+"""
+上游數據錄製 / 重播層，用於離線、可重現的效能測試
+
+REPLAY_MODE=record  正常呼叫上游，並把回應寫入本地 fixture 目錄
+REPLAY_MODE=replay  HTTP 請求改寫到本機替身伺服器，yfinance 呼叫直接讀 fixture；
+                    可用 REPLAY_LATENCY_MS / REPLAY_ERROR_RATE 注入延遲與錯誤
+未設定時完全不介入
+"""
+
+import os
+import json
+import time
+import random
+import pickle
+import hashlib
+import pathlib
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+REPLAY_MODE = os.getenv('REPLAY_MODE', '').lower()
+REPLAY_DIR = os.path.abspath(os.getenv('REPLAY_DIR', 'data/replay'))
+REPLAY_LATENCY_MS = float(os.getenv('REPLAY_LATENCY_MS', '0'))
+REPLAY_ERROR_RATE = float(os.getenv('REPLAY_ERROR_RATE', '0'))
+
+# 不寫入 fixture、也不參與比對的查詢參數（API 金鑰）
+_SECRET_PARAMS = {'token', 'apikey', 'apiKey', 'api_key'}
+
+class ReplayMiss(Exception):
+    """重播模式下找不到對應的 fixture"""
+
+class InjectedError(Exception):
+    """重播模式注入的上游錯誤"""
+
+def _canonical(url: str) -> str:
+    """去除金鑰並排序查詢參數，作為 fixture 的比對鍵"""
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in _SECRET_PARAMS)
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+def _fixture_path(kind: str, key: str) -> pathlib.Path:
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+    return pathlib.Path(REPLAY_DIR) / kind / f"{digest}.{'json' if kind == 'http' else 'pkl'}"
+
+def _inject():
+    """依設定注入延遲與錯誤；回傳 True 表示這次應該失敗"""
+    if REPLAY_LATENCY_MS:
+        # ±50% 抖動，避免每次延遲完全相同
+        time.sleep(REPLAY_LATENCY_MS * random.uniform(0.5, 1.5) / 1000)
+    return random.random() < REPLAY_ERROR_RATE
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """把 /<host>/<path>?<query> 對應回原始 URL，從 fixture 回應"""
+
+    def do_GET(self):
+        host, _, rest = self.path.lstrip('/').partition('/')
+        upstream = _canonical(f"https://{host}/{rest}")
+        if _inject():
+            replay.stats['injected_errors'] += 1
+            return self._send(503, 'application/json', '{"error": "injected"}')
+        path = _fixture_path('http', upstream)
+        if not path.exists():
+            replay.stats['misses'] += 1
+            logger.warning(f"重播缺少 fixture: {upstream}")
+            return self._send(404, 'application/json', '{"error": "no fixture"}')
+        replay.stats['replayed'] += 1
+        fixture = json.loads(path.read_text('utf-8'))
+        self._send(fixture['status'], fixture.get('content_type') or 'application/json', fixture['body'])
+
+    def _send(self, status: int, content_type: str, body: str):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("replay stand-in: " + format % args)
+
+class ReplayLayer:
+    """錄製 / 重播控制器"""
+
+    def __init__(self, mode: str = REPLAY_MODE):
+        self.mode = mode
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._lock = threading.Lock()
+        self.stats = {'recorded': 0, 'replayed': 0, 'misses': 0, 'injected_errors': 0}
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == 'record'
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    def start_server(self, port: int = 0) -> int:
+        """啟動本機替身伺服器（背景執行緒），回傳埠號"""
+        with self._lock:
+            if self._server is None:
+                self._server = ThreadingHTTPServer(('127.0.0.1', port), _StandInHandler)
+                threading.Thread(target=self._server.serve_forever, name='replay-stand-in', daemon=True).start()
+                logger.info(f"重播替身伺服器啟動於 127.0.0.1:{self._server.server_address[1]}")
+            return self._server.server_address[1]
+
+    def stop_server(self):
+        with self._lock:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server = None
+
+    def url(self, url: str) -> str:
+        """重播模式下把上游 URL 改寫到替身伺服器，其他模式原樣回傳"""
+        if not self.replaying:
+            return url
+        port = self.start_server()
+        parts = urlsplit(url)
+        path = f"/{parts.netloc}{parts.path}"
+        return f"http://127.0.0.1:{port}{path}" + (f"?{parts.query}" if parts.query else '')
+
+    def record(self, url: str, status: int, body: str, content_type: str = 'application/json'):
+        """錄製模式下保存一筆 HTTP 回應"""
+        if not self.recording:
+            return
+        try:
+            key = _canonical(url)
+            path = _fixture_path('http', key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps({
+                'url': key, 'status': status, 'content_type': content_type,
+                'body': body, 'recorded_at': time.time(),
+            }, ensure_ascii=False), 'utf-8')
+            self.stats['recorded'] += 1
+        except Exception as e:
+            logger.warning(f"錄製 {url} 失敗: {e}")
+
+    def call(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        包裝無法改寫 URL 的呼叫（yfinance）：錄製時保存回傳值，重播時直接讀回
+
+        key 需能唯一描述這次呼叫，例如 "yf:info:AAPL"
+        """
+        if not (self.recording or self.replaying):
+            return fn()
+
+        path = _fixture_path('call', key)
+        if self.replaying:
+            if _inject():
+                self.stats['injected_errors'] += 1
+                raise InjectedError(f"注入錯誤: {key}")
+            if not path.exists():
+                self.stats['misses'] += 1
+                raise ReplayMiss(f"重播缺少 fixture: {key}")
+            self.stats['replayed'] += 1
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+        result = fn()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as f:
+                pickle.dump(result, f)
+            self.stats['recorded'] += 1
+        except Exception as e:
+            logger.warning(f"錄製 {key} 失敗: {e}")
+        return result
+
+# 全局錄製 / 重播實例
+replay = ReplayLayer()
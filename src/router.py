@@ -0,0 +1,141 @@
+# src/router.py
+"""
+數據源路由器：依各來源的延遲 EWMA 與錯誤率排序，並以熔斷器暫時跳過持續失敗的來源
+"""
+
+import time
+import threading
+import logging
+from typing import Dict, List, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class SourceStats:
+    """單一數據源的延遲 / 成功率統計與熔斷狀態"""
+
+    def __init__(self, name: str, priority: int):
+        self.name = name
+        self.priority = priority          # 註冊順序，統計相同時作為排序依據
+        self.ewma_latency: Optional[float] = None
+        self.error_rate = 0.0             # 錯誤率的 EWMA (0~1)
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.last_error: Optional[str] = None
+
+class ProviderRouter:
+    """依預期成本排序數據源，失敗過多時熔斷一段冷卻時間"""
+
+    def __init__(self, alpha: float = 0.3, failure_threshold: int = 3,
+                 cooldown: float = 300, failure_penalty: float = 10.0):
+        self.alpha = alpha                          # EWMA 平滑係數
+        self.failure_threshold = failure_threshold  # 連續失敗幾次後熔斷
+        self.cooldown = cooldown                    # 熔斷冷卻秒數
+        self.failure_penalty = failure_penalty      # 一次失敗折算的秒數成本
+        self._stats: Dict[str, SourceStats] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str) -> SourceStats:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = SourceStats(name, len(self._stats))
+            self._stats[name] = stats
+        return stats
+
+    def register(self, *names: str):
+        """註冊數據源（註冊順序即為無統計時的預設順序）"""
+        with self._lock:
+            for name in names:
+                self._get(name)
+
+    def expected_cost(self, name: str) -> float:
+        """預期成本 = 平均延遲 + 錯誤率 × 失敗懲罰；未曾呼叫的來源視為零成本以便探測"""
+        with self._lock:
+            return self._cost(self._get(name))
+
+    def _cost(self, stats: SourceStats) -> float:
+        latency = stats.ewma_latency or 0.0
+        return latency + stats.error_rate * self.failure_penalty
+
+    def _available(self, stats: SourceStats, now: float) -> bool:
+        if stats.state == OPEN and now >= stats.open_until:
+            # 冷卻結束，放行一次試探請求
+            stats.state = HALF_OPEN
+            logger.info(f"數據源 {stats.name} 熔斷冷卻結束，進入半開狀態")
+        return stats.state != OPEN
+
+    def order(self, names: Optional[List[str]] = None) -> List[str]:
+        """
+        回傳本次應嘗試的數據源順序
+
+        熔斷中的來源會被跳過；若全部來源都在熔斷中，只回傳最早解除熔斷的那一個作為最後手段
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [self._get(n) for n in (names or list(self._stats))]
+            available = [s for s in candidates if self._available(s, now)]
+            if not available and candidates:
+                available = [min(candidates, key=lambda s: s.open_until)]
+            available.sort(key=lambda s: (self._cost(s), s.priority))
+            return [s.name for s in available]
+
+    def record_success(self, name: str, latency: float):
+        """記錄成功呼叫"""
+        with self._lock:
+            stats = self._get(name)
+            stats.calls += 1
+            stats.consecutive_failures = 0
+            stats.ewma_latency = self._ewma(stats.ewma_latency, latency)
+            stats.error_rate = (1 - self.alpha) * stats.error_rate
+            if stats.state != CLOSED:
+                logger.info(f"數據源 {name} 恢復正常，關閉熔斷")
+            stats.state = CLOSED
+
+    def record_failure(self, name: str, latency: float, error: Any = None):
+        """記錄失敗呼叫，必要時觸發熔斷"""
+        with self._lock:
+            stats = self._get(name)
+            stats.calls += 1
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            stats.ewma_latency = self._ewma(stats.ewma_latency, latency)
+            stats.error_rate = (1 - self.alpha) * stats.error_rate + self.alpha
+            stats.last_error = str(error) if error is not None else None
+
+            if stats.state == HALF_OPEN or stats.consecutive_failures >= self.failure_threshold:
+                stats.state = OPEN
+                stats.open_until = time.time() + self.cooldown
+                logger.warning(f"數據源 {name} 熔斷 {self.cooldown:.0f} 秒 (連續失敗 {stats.consecutive_failures} 次)")
+
+    def _ewma(self, current: Optional[float], value: float) -> float:
+        if current is None:
+            return value
+        return (1 - self.alpha) * current + self.alpha * value
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """路由器當前狀態（依預期成本排序），供管理介面顯示"""
+        now = time.time()
+        with self._lock:
+            rows = []
+            for stats in sorted(self._stats.values(), key=lambda s: (self._cost(s), s.priority)):
+                rows.append({
+                    'name': stats.name,
+                    'state': stats.state,
+                    'ewma_latency_ms': round(stats.ewma_latency * 1000) if stats.ewma_latency is not None else None,
+                    'error_rate': round(stats.error_rate, 3),
+                    'expected_cost': round(self._cost(stats), 3),
+                    'calls': stats.calls,
+                    'failures': stats.failures,
+                    'cooldown_remaining': max(0, round(stats.open_until - now)) if stats.state == OPEN else 0,
+                    'last_error': stats.last_error,
+                })
+            return rows
+
+# 全局路由器實例（同一進程內所有呼叫者共用）
+provider_router = ProviderRouter()
@@ -0,0 +1,166 @@
+# src/scheduler.py
+"""
+阻塞工作排程：I/O（yfinance 抓取）走有界執行緒池，CPU 計算走行程池，
+每個工作都有截止時間，逾時回傳上次成功的結果；附佇列深度等統計
+"""
+
+import os
+import time
+import asyncio
+import threading
+import functools
+import multiprocessing
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+IO_WORKERS = int(os.getenv('SCHED_IO_WORKERS', '8'))
+CPU_WORKERS = int(os.getenv('SCHED_CPU_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+MAX_QUEUE = int(os.getenv('SCHED_MAX_QUEUE', '64'))        # 每個池排隊超過此數直接拒絕
+PER_KEY_LIMIT = int(os.getenv('SCHED_PER_KEY_LIMIT', '4'))  # 同一個 key（股票）同時佔用的工作數上限
+LAST_GOOD_SIZE = 512
+
+class TaskRejected(Exception):
+    """佇列已滿或同一 key 佔用過多工作"""
+
+class _Pool:
+    def __init__(self, name: str, workers: int, factory: Callable[[], Executor]):
+        self.name = name
+        self.workers = workers
+        self._factory = factory
+        self._executor: Optional[Executor] = None
+        self.inflight = 0           # 已送出未結束（含逾時後仍在跑的）
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'timed_out': 0, 'rejected': 0}
+        self.latencies: deque = deque(maxlen=200)
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = self._factory()
+        return self._executor
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.inflight - self.workers)
+
+    def snapshot(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        p = lambda q: round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000) if ordered else None
+        return dict(self.stats, workers=self.workers, inflight=self.inflight, queued=self.queued,
+                    p50_ms=p(0.5), p95_ms=p(0.95))
+
+class Scheduler:
+    """執行緒池 / 行程池排程器"""
+
+    def __init__(self, io_workers: int = IO_WORKERS, cpu_workers: int = CPU_WORKERS,
+                 max_queue: int = MAX_QUEUE, per_key_limit: int = PER_KEY_LIMIT):
+        self.max_queue = max_queue
+        self.per_key_limit = per_key_limit
+        self.pools = {
+            'io': _Pool('io', io_workers,
+                        lambda: ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='sched-io')),
+            # spawn：避免在有背景執行緒的行程裡 fork
+            'cpu': _Pool('cpu', cpu_workers,
+                         lambda: ProcessPoolExecutor(max_workers=cpu_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))),
+        }
+        self._keys: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._last_good: "OrderedDict[str, Any]" = OrderedDict()
+
+    def _admit(self, pool: _Pool, key: Optional[str]):
+        with self._lock:
+            if pool.queued >= self.max_queue:
+                pool.stats['rejected'] += 1
+                raise TaskRejected(f"{pool.name} 佇列已滿 ({pool.queued})")
+            if key and self._keys.get(key, 0) >= self.per_key_limit:
+                pool.stats['rejected'] += 1
+                raise TaskRejected(f"{key} 已有 {self._keys[key]} 個工作進行中")
+            pool.inflight += 1
+            pool.stats['submitted'] += 1
+            if key:
+                self._keys[key] = self._keys.get(key, 0) + 1
+
+    def _release(self, pool: _Pool, key: Optional[str], started: float, future):
+        # 在工作執行緒 / 行程池管理執行緒中呼叫；逾時被放棄的工作也會在真正結束時才釋放
+        with self._lock:
+            pool.inflight -= 1
+            if key:
+                self._keys[key] -= 1
+                if not self._keys[key]:
+                    del self._keys[key]
+            if not future.cancelled():
+                pool.latencies.append(time.perf_counter() - started)
+                pool.stats['completed' if future.exception() is None else 'failed'] += 1
+
+    async def run(self, kind: str, fn: Callable, *args, deadline: float, key: Optional[str] = None) -> Any:
+        """
+        在 kind（'io' / 'cpu'）池執行 fn(*args)
+
+        Raises:
+            TaskRejected: 佇列已滿或 key 佔用過多
+            asyncio.TimeoutError: 超過 deadline 秒（尚未開始的工作會被取消）
+        """
+        pool = self.pools[kind]
+        self._admit(pool, key)
+        started = time.perf_counter()
+        try:
+            future = pool.executor.submit(fn, *args)
+        except Exception:
+            self._release(pool, key, started, _Cancelled())
+            raise
+        future.add_done_callback(functools.partial(self._release, pool, key, started))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), deadline)
+        except asyncio.TimeoutError:
+            pool.stats['timed_out'] += 1
+            raise
+        except BrokenExecutor:
+            # 子行程異常結束後整個池不可再用，下次呼叫重建
+            logger.error(f"{pool.name} 工作池已損壞，重建")
+            pool._executor = None
+            raise
+
+    async def run_cached(self, kind: str, fn: Callable, *args, deadline: float,
+                         key: Optional[str] = None, cache_key: str) -> Tuple[Any, bool]:
+        """
+        同 run，但失敗 / 逾時 / 被拒時回傳 cache_key 上次成功的結果
+
+        Returns:
+            (結果, 是否為本次新算的)；沒有舊結果時結果為 None
+        """
+        try:
+            result = await self.run(kind, fn, *args, deadline=deadline, key=key)
+        except Exception as e:
+            logger.warning(f"{getattr(fn, '__name__', fn)} 未在期限內完成，使用上次結果: {type(e).__name__} {e}")
+            return self._last_good.get(cache_key), False
+        self._last_good[cache_key] = result
+        self._last_good.move_to_end(cache_key)
+        while len(self._last_good) > LAST_GOOD_SIZE:
+            self._last_good.popitem(last=False)
+        return result, True
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'pools': {name: pool.snapshot() for name, pool in self.pools.items()},
+                'busy_keys': dict(self._keys),
+            }
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            if pool._executor is not None:
+                pool._executor.shutdown(wait=False, cancel_futures=True)
+                pool._executor = None
+
+class _Cancelled:
+    """submit 失敗時給 _release 用的替身"""
+
+    def cancelled(self) -> bool:
+        return True
+
+# 全局排程器實例
+scheduler = Scheduler()
@@ -8,12 +8,9 @@ import logging
 from typing import Dict, Any, Optional, Tuple
 from datetime import datetime
 
-from .provider_yahoo import YahooProvider
-from .analyzers import (
-    OptionRow, OptionGreeksRow, 
-    compute_max_pain, compute_gex, compute_gamma_levels,
-    magnet_strength
-)
+from .provider_yahoo import YahooProvider, AsyncYahooProvider, run_blocking
+from .analyzers import magnet_strength
+from .options_math import RISK_FREE_RATE, DIVIDEND_YIELD, max_pain_summary, gex_summary
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +18,7 @@ class StockService:
     """股票分析服務類"""
     
     def __init__(self):
-        self.yahoo_provider = YahooProvider()
+        self.yahoo_provider = AsyncYahooProvider()
         self.risk_free_rate = 0.045  # 4.5% 無風險利率
         self.dividend_yield = 0.0    # 預設無股息
     
@@ -37,13 +34,13 @@ class StockService:
             
             # 獲取期權數據
             if not expiry:
-                expiry = self.yahoo_provider.nearest_expiry(symbol)
+                expiry = await self.yahoo_provider.nearest_expiry(symbol)
             
             # Max Pain 分析
-            max_pain_result = maxpain_handler(symbol, expiry)
+            max_pain_result = await run_blocking(maxpain_handler, symbol, expiry)
             
             # GEX 分析
-            gex_result, support, resistance = gex_handler(symbol, expiry, spot=spot_price)
+            gex_result, support, resistance = await run_blocking(gex_handler, symbol, expiry, spot_price)
             
             return {
                 'symbol': symbol.upper(),
@@ -63,13 +60,14 @@ class StockService:
             logger.error(f"完整分析失敗 ({symbol}): {str(e)}")
             raise
 
-def maxpain_handler(symbol: str, expiry: str) -> Dict[str, Any]:
+def maxpain_handler(symbol: str, expiry: str, options_chain: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Max Pain 分析處理器
     
     Args:
         symbol: 股票代碼
         expiry: 到期日 (YYYY-MM-DD)
+        options_chain: 已抓取的期權鏈（與 gex_handler 共用），不提供時自行抓取
         
     Returns:
         Max Pain 分析結果
@@ -78,55 +76,21 @@ def maxpain_handler(symbol: str, expiry: str) -> Dict[str, Any]:
         logger.info(f"計算 {symbol} Max Pain，到期日: {expiry}")
         
         # 獲取期權鏈數據
-        yahoo_provider = YahooProvider()
-        options_chain = yahoo_provider.get_options_chain(symbol, expiry)
-        
-        # 準備期權數據
-        option_rows = []
-        
-        # 處理 calls
-        for call in options_chain['calls']:
-            option_rows.append(OptionRow(
-                strike=call['strike'],
-                type='call',
-                open_interest=call['openInterest']
-            ))
-        
-        # 處理 puts
-        for put in options_chain['puts']:
-            option_rows.append(OptionRow(
-                strike=put['strike'],
-                type='put',
-                open_interest=put['openInterest']
-            ))
-        
-        if not option_rows:
-            raise ValueError(f"沒有找到 {symbol} 的期權數據")
+        if options_chain is None:
+            options_chain = YahooProvider().get_options_chain(symbol, expiry)
         
-        # 計算 Max Pain
-        max_pain_result = compute_max_pain(option_rows, contract_multiplier=100)
+        # 計算交給 options_math（排程器的行程池直接呼叫同一個函數）
+        result = max_pain_summary(symbol, expiry, options_chain, contract_multiplier=100)
         
-        # 格式化結果
-        result = {
-            'symbol': symbol.upper(),
-            'expiry': expiry,
-            'max_pain': max_pain_result.max_pain,
-            'min_total_pain': max_pain_result.min_total_pain,
-            'pain_curve': max_pain_result.curve,
-            'total_strikes': len(max_pain_result.curve),
-            'total_call_oi': sum(row.open_interest for row in option_rows if row.type == 'call'),
-            'total_put_oi': sum(row.open_interest for row in option_rows if row.type == 'put'),
-            'contract_multiplier': max_pain_result.contract_multiplier
-        }
-        
-        logger.info(f"Max Pain 計算完成: {symbol} = ${max_pain_result.max_pain}")
+        logger.info(f"Max Pain 計算完成: {symbol} = ${result['max_pain']}")
         return result
         
     except Exception as e:
         logger.error(f"Max Pain 計算失敗 ({symbol}, {expiry}): {str(e)}")
         raise
 
-def gex_handler(symbol: str, expiry: str, spot: Optional[float] = None) -> Tuple[Dict[str, Any], Optional[float], Optional[float]]:
+def gex_handler(symbol: str, expiry: str, spot: Optional[float] = None,
+                options_chain: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], Optional[float], Optional[float]]:
     """
     GEX (Gamma Exposure) 分析處理器
     
@@ -134,6 +98,7 @@ def gex_handler(symbol: str, expiry: str, spot: Optional[float] = None) -> Tuple
         symbol: 股票代碼
         expiry: 到期日 (YYYY-MM-DD)
         spot: 現貨價格，如果不提供會自動獲取
+        options_chain: 已抓取的期權鏈（與 maxpain_handler 共用），不提供時自行抓取
         
     Returns:
         (GEX結果, 支撐位, 阻力位)
@@ -144,65 +109,18 @@ def gex_handler(symbol: str, expiry: str, spot: Optional[float] = None) -> Tuple
         # 獲取現貨價格
         yahoo_provider = YahooProvider()
         if spot is None:
-            spot_data = yahoo_provider.get_spot(symbol)
-            spot = spot_data['price']
+            spot = yahoo_provider.get_stock_data(symbol)['current_price']
         
         # 獲取期權鏈數據
-        options_chain = yahoo_provider.get_options_chain(symbol, expiry)
+        if options_chain is None:
+            options_chain = yahoo_provider.get_options_chain(symbol, expiry)
         
-        # 準備希臘字母數據
-        greeks_rows = []
-        
-        # 處理 calls
-        for call in options_chain['calls']:
-            if call['impliedVolatility'] is not None and call['impliedVolatility'] > 0:
-                greeks_rows.append(OptionGreeksRow(
-                    strike=call['strike'],
-                    type='call',
-                    open_interest=call['openInterest'],
-                    iv=call['impliedVolatility'],
-                    T=call['T']
-                ))
-        
-        # 處理 puts
-        for put in options_chain['puts']:
-            if put['impliedVolatility'] is not None and put['impliedVolatility'] > 0:
-                greeks_rows.append(OptionGreeksRow(
-                    strike=put['strike'],
-                    type='put',
-                    open_interest=put['openInterest'],
-                    iv=put['impliedVolatility'],
-                    T=put['T']
-                ))
-        
-        if not greeks_rows:
+        gex_dict, support, resistance = gex_summary(symbol, expiry, spot, options_chain,
+                                                    RISK_FREE_RATE, DIVIDEND_YIELD, contract_multiplier=100)
+        if not gex_dict['total_options']:
             logger.warning(f"沒有找到 {symbol} 的有效 IV 數據，使用零值")
-            gex_result = type('GEXResult', (), {
-                'share_gamma': 0.0,
-                'dollar_gamma_1pct': 0.0
-            })()
-            support, resistance = None, None
-        else:
-            # 計算 GEX
-            risk_free_rate = 0.045
-            dividend_yield = 0.0
-            
-            gex_result = compute_gex(greeks_rows, spot, risk_free_rate, dividend_yield, contract_multiplier=100)
-            
-            # 計算 Gamma 支撐/阻力位
-            support, resistance = compute_gamma_levels(greeks_rows, spot, risk_free_rate, dividend_yield, contract_multiplier=100)
-        
-        # 格式化 GEX 結果
-        gex_dict = {
-            'symbol': symbol.upper(),
-            'expiry': expiry,
-            'spot_price': spot,
-            'share_gamma': gex_result.share_gamma,
-            'dollar_gamma_1pct': gex_result.dollar_gamma_1pct,
-            'total_options': len(greeks_rows)
-        }
         
-        logger.info(f"GEX 計算完成: {symbol} ShareGamma={gex_result.share_gamma:.2f}")
+        logger.info(f"GEX 計算完成: {symbol} ShareGamma={gex_dict['share_gamma']:.2f}")
         return gex_dict, support, resistance
         
     except Exception as e:
@@ -228,8 +146,7 @@ def options_summary(symbol: str, expiry: Optional[str] = None) -> Dict[str, Any]
             expiry = yahoo_provider.nearest_expiry(symbol)
         
         # 獲取現貨價格
-        spot_data = yahoo_provider.get_spot(symbol)
-        spot_price = spot_data['price']
+        spot_price = yahoo_provider.get_stock_data(symbol)['current_price']
         
         # 獲取期權鏈
         options_chain = yahoo_provider.get_options_chain(symbol, expiry)
@@ -0,0 +1,268 @@
+# src/stream.py
+"""
+推播式報價：訂閱 websocket 成交流（Finnhub trade stream 格式），每筆成交即時更新報價快取，
+已訂閱的股票查詢時不需再打 REST
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, date
+from typing import Dict, Optional, Any, Iterable, Set
+from zoneinfo import ZoneInfo
+
+import aiohttp
+
+from .cache import cache_manager
+from .history import history_store
+
+logger = logging.getLogger(__name__)
+
+STREAM_WS_URL = os.getenv('STREAM_WS_URL', 'wss://ws.finnhub.io')
+STREAM_TOKEN = os.getenv('FINNHUB_API_KEY', '')
+STREAM_SYMBOLS = os.getenv('STREAM_SYMBOLS', 'AAPL,MSFT,GOOGL,AMZN,TSLA,META,NVDA')
+STREAM_MAX_SYMBOLS = int(os.getenv('STREAM_MAX_SYMBOLS', '50'))   # Finnhub 免費方案單一連線上限
+STREAM_MAX_AGE = int(os.getenv('STREAM_MAX_AGE', '120'))           # 超過幾秒沒成交就改走 REST
+
+# 寫入共享快取（Redis / 文件）的間隔：成交只更新記憶體並標記，背景批次寫入，不在 websocket 讀取迴圈裡做 I/O
+CACHE_WRITE_INTERVAL = 1.0
+SEED_RETRY_INTERVAL = 30   # 取不到前收盤價時的重試間隔（秒）
+
+_NY = ZoneInfo('America/New_York')
+
+def _trade_day(ts: float) -> date:
+    return datetime.fromtimestamp(ts, _NY).date()
+
+class QuoteStream:
+    """websocket 成交流消費者"""
+
+    def __init__(self, url: str = STREAM_WS_URL, token: str = STREAM_TOKEN,
+                 max_symbols: int = STREAM_MAX_SYMBOLS, max_age: int = STREAM_MAX_AGE):
+        self.url = url
+        self.token = token
+        self.max_symbols = max_symbols
+        self.max_age = max_age
+        self.quotes: Dict[str, Dict[str, Any]] = {}
+        self.subscribed: Set[str] = set()
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._dirty: Set[str] = set()
+        self._seed_retry_at: Dict[str, float] = {}
+        self.stats = {'messages': 0, 'trades': 0, 'reconnects': 0, 'hits': 0, 'misses': 0}
+        self.last_message_at = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    # ---- 訂閱 ----
+
+    def subscribe(self, symbols: Iterable[str]) -> int:
+        """加入訂閱（超過上限的忽略），回傳新增數量；需在事件迴圈內呼叫"""
+        added = 0
+        for symbol in symbols:
+            symbol = symbol.upper().strip()
+            if not symbol or symbol in self.subscribed or len(self.subscribed) >= self.max_symbols:
+                continue
+            self.subscribed.add(symbol)
+            added += 1
+            if self.connected:
+                asyncio.ensure_future(self._subscribe(symbol))
+        return added
+
+    async def _subscribe(self, symbol: str):
+        await self._seed(symbol)
+        try:
+            await self._ws.send_str(json.dumps({'type': 'subscribe', 'symbol': symbol}))
+        except Exception as e:
+            logger.warning(f"訂閱 {symbol} 失敗: {e}")
+
+    async def _seed(self, symbol: str):
+        """以本地日K線取得前收盤價，漲跌幅才有基準；失敗時由背景迴圈定期重試"""
+        quote = self.quotes.get(symbol)
+        if quote and quote.get('previous_close'):
+            return
+        try:
+            frame = await asyncio.to_thread(history_store.get_history, symbol, 2)
+            today = _trade_day(time.time())
+            closed = frame[frame.index.date < today]
+            if closed.empty:
+                return
+            previous_close = float(closed['Close'].iloc[-1])
+        except Exception as e:
+            logger.warning(f"取得 {symbol} 前收盤價失敗，{SEED_RETRY_INTERVAL}s 後重試: {e}")
+            return
+        quote = self.quotes.get(symbol)
+        if quote is None:
+            self.quotes[symbol] = {
+                'symbol': symbol,
+                'previous_close': previous_close,
+                'day': today.isoformat(),
+                'volume': 0,
+                'updated_at': 0.0,
+            }
+        elif not quote.get('previous_close'):
+            # 成交已先到：補上前收盤並回算漲跌
+            quote['previous_close'] = previous_close
+            price = quote.get('current_price')
+            if price:
+                quote['change'] = price - previous_close
+                quote['change_percent'] = (price - previous_close) / previous_close * 100
+                self._dirty.add(symbol)
+
+    # ---- 成交事件 ----
+
+    def on_trade(self, symbol: str, price: float, volume: float, ts: float):
+        """套用一筆成交（ts 為秒）"""
+        day = _trade_day(ts).isoformat()
+        quote = self.quotes.get(symbol)
+        if quote is None:
+            quote = self.quotes[symbol] = {'symbol': symbol, 'previous_close': None, 'day': day, 'volume': 0}
+        elif quote.get('day') != day:
+            # 換日：昨天最後一筆成交即為前收盤
+            quote.update(previous_close=quote.get('current_price', quote.get('previous_close')),
+                         day=day, volume=0, open=None, high=None, low=None)
+
+        if quote.get('open') is None:
+            quote['open'] = price
+        quote['high'] = max(price, quote.get('high') or price)
+        quote['low'] = min(price, quote.get('low') or price)
+        quote['volume'] = int(quote.get('volume', 0) + volume)
+        quote['current_price'] = price
+        prev = quote.get('previous_close')
+        if prev:
+            quote['change'] = price - prev
+            quote['change_percent'] = (price - prev) / prev * 100
+        quote['updated_at'] = time.time()
+        self.stats['trades'] += 1
+        self._dirty.add(symbol)
+
+    def _write_cache(self, batch: Dict[str, Dict[str, Any]]):
+        for symbol, quote in batch.items():
+            cache_manager.set(f"stream_quote_{symbol}", quote, self.max_age)
+
+    async def _maintain(self):
+        """背景迴圈：批次把有變動的報價寫入共享快取，並重試缺少前收盤價的股票"""
+        while True:
+            await asyncio.sleep(CACHE_WRITE_INTERVAL)
+            if self._dirty:
+                batch = {symbol: dict(self.quotes[symbol]) for symbol in self._dirty if symbol in self.quotes}
+                self._dirty.clear()
+                try:
+                    await asyncio.to_thread(self._write_cache, batch)
+                except Exception as e:
+                    logger.warning(f"寫入推播報價快取失敗: {e}")
+            now = time.monotonic()
+            for symbol in self.subscribed | set(self.quotes):
+                quote = self.quotes.get(symbol)
+                if (quote and quote.get('previous_close')) or now < self._seed_retry_at.get(symbol, 0):
+                    continue
+                self._seed_retry_at[symbol] = now + SEED_RETRY_INTERVAL
+                asyncio.ensure_future(self._seed(symbol))
+
+    def _handle(self, raw: str):
+        self.stats['messages'] += 1
+        self.last_message_at = time.time()
+        msg = json.loads(raw)
+        if msg.get('type') != 'trade':
+            return  # ping 等其他訊息
+        for t in msg.get('data') or []:
+            try:
+                self.on_trade(t['s'].upper(), float(t['p']), float(t.get('v') or 0), t['t'] / 1000)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.debug(f"略過格式不符的成交: {t} ({e})")
+
+    # ---- 讀取 ----
+
+    def get_quote(self, symbol: str) -> Optional[Dict[str, Any]]:
+        """
+        回傳最近的推播報價（欄位同 REST 報價），沒有或已過期回傳 None
+
+        先看本行程記憶體，再看共享快取（其他行程的消費者寫入的）
+        """
+        symbol = symbol.upper().strip()
+        quote = self.quotes.get(symbol)
+        if not quote or not quote.get('current_price'):
+            quote = cache_manager.get(f"stream_quote_{symbol}")
+        if (not quote or quote.get('change') is None
+                or time.time() - quote.get('updated_at', 0) > self.max_age):
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return {
+            'symbol': symbol,
+            'source': 'Stream',
+            'data_source': 'Finnhub (stream)',
+            'current_price': quote['current_price'],
+            'previous_close': quote['previous_close'],
+            'change': quote['change'],
+            'change_percent': quote['change_percent'],
+            'open': quote.get('open'),
+            'high': quote.get('high'),
+            'low': quote.get('low'),
+            'volume': quote.get('volume', 0),
+            'timestamp': datetime.fromtimestamp(quote['updated_at']).isoformat(),
+        }
+
+    # ---- 連線 ----
+
+    def _connect_url(self) -> str:
+        if not self.token:
+            return self.url
+        return f"{self.url}{'&' if '?' in self.url else '?'}token={self.token}"
+
+    async def run(self):
+        """連線並持續消費，斷線後指數退避重連"""
+        backoff = 1
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self._connect_url(), heartbeat=30) as ws:
+                        self._ws = ws
+                        backoff = 1
+                        logger.info(f"報價串流已連線，訂閱 {len(self.subscribed)} 支")
+                        for symbol in list(self.subscribed):
+                            await self._subscribe(symbol)
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.TEXT:
+                                self._handle(msg.data)
+                            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"報價串流中斷: {e}")
+            finally:
+                self._ws = None
+            self.stats['reconnects'] += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def start(self, symbols: Optional[Iterable[str]] = None):
+        """在目前的事件迴圈背景啟動"""
+        self.subscribe(symbols if symbols is not None else STREAM_SYMBOLS.split(','))
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self.run())
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._maintain())
+
+    async def stop(self):
+        for task in (self._task, self._flusher):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._flusher = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self.stats, connected=self.connected, subscribed=len(self.subscribed),
+                    last_message_age=round(time.time() - self.last_message_at, 1) if self.last_message_at else None)
+
+# 全局報價串流實例
+quote_stream = QuoteStream()
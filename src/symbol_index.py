@@ -0,0 +1,206 @@
+# src/symbol_index.py
+"""
+離線股票代號搜尋索引：代號 / 公司名稱的前綴 Trie + 三字母組（trigram）模糊比對，
+啟動時由本地成分股清單建立；找不到可信結果時才走網路搜尋，並把網路結果併回索引
+"""
+
+import os
+import re
+import json
+import pathlib
+import threading
+import logging
+from typing import Dict, List, Set, Tuple, Iterable
+
+from .universe import sp500_universe
+
+logger = logging.getLogger(__name__)
+
+# 網路搜尋學到的代號，重啟後仍保留
+LEARNED_PATH = os.path.abspath(os.getenv('SYMBOL_INDEX_PATH', 'data/universe/learned_symbols.json'))
+
+CONFIDENT_SCORE = 0.75
+
+# 不參與索引的公司名稱字尾
+_STOPWORDS = {'inc', 'corp', 'corporation', 'co', 'company', 'ltd', 'plc', 'the', 'class', 'holdings', 'group'}
+
+# 常見俗名 / 中文名（Yahoo 的搜尋也支援，離線索引補上最常被查的幾個）
+_ALIASES = {
+    'GOOGL': ['google', '谷歌'],
+    'META': ['facebook', '臉書'],
+    'TSLA': ['特斯拉'],
+    'AAPL': ['蘋果'],
+    'NVDA': ['輝達', '英偉達'],
+    'MSFT': ['微軟'],
+    'AMZN': ['亞馬遜'],
+}
+
+def _normalize(text: str) -> str:
+    return re.sub(r'[^\w\s]', ' ', (text or '').lower()).strip()
+
+def _tokens(text: str) -> List[str]:
+    return [t for t in _normalize(text).split() if t]
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {_normalize(text)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class _TrieNode:
+    __slots__ = ('children', 'ids')
+
+    def __init__(self):
+        self.children: Dict[str, '_TrieNode'] = {}
+        self.ids: Set[int] = set()   # 此前綴底下所有條目，查詢時不需再走子樹
+
+class SymbolIndex:
+    """代號 / 名稱搜尋索引"""
+
+    def __init__(self):
+        self.entries: List[Dict] = []
+        self._by_symbol: Dict[str, int] = {}
+        self._trie = _TrieNode()
+        self._trigrams: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    def _insert_key(self, key: str, entry_id: int):
+        node = self._trie
+        for ch in key:
+            node = node.children.setdefault(ch, _TrieNode())
+            node.ids.add(entry_id)
+
+    def add(self, hits: Iterable[Dict]) -> int:
+        """加入條目（格式同 yf_search 結果：symbol, name, exchDisp, type），回傳新增數量"""
+        added = 0
+        with self._lock:
+            for hit in hits:
+                symbol = (hit.get('symbol') or '').upper()
+                if not symbol:
+                    continue
+                entry = {
+                    'symbol': symbol,
+                    'name': hit.get('name') or '',
+                    'exchDisp': hit.get('exchDisp') or '',
+                    'type': hit.get('type') or 'EQUITY',
+                }
+                entry_id = self._by_symbol.get(symbol)
+                if entry_id is not None:
+                    # 已存在：只補上缺少的欄位
+                    current = self.entries[entry_id]
+                    for k, v in entry.items():
+                        if v and not current.get(k):
+                            current[k] = v
+                else:
+                    entry_id = len(self.entries)
+                    self.entries.append(entry)
+                    self._by_symbol[symbol] = entry_id
+                    added += 1
+
+                keys = {symbol.lower(), _normalize(entry['name'])}
+                keys.update(t for t in _tokens(entry['name']) if t not in _STOPWORDS)
+                keys.update(_ALIASES.get(symbol, []))
+                for key in keys:
+                    if key:
+                        self._insert_key(key, entry_id)
+                for gram in _trigrams(f"{symbol} {entry['name']}"):
+                    self._trigrams.setdefault(gram, set()).add(entry_id)
+        return added
+
+    def _prefix(self, key: str) -> Set[int]:
+        node = self._trie
+        for ch in key:
+            node = node.children.get(ch)
+            if node is None:
+                return set()
+        return node.ids
+
+    def search(self, query: str, limit: int = 10) -> List[Dict]:
+        """回傳依分數排序的條目（含 score 欄位）"""
+        q = _normalize(query)
+        if not q:
+            return []
+        # learn / build 會在其他執行緒改動 trie 與 trigram 集合，查詢期間持鎖
+        with self._lock:
+            return self._search(q, limit)
+
+    def _search(self, q: str, limit: int) -> List[Dict]:
+        scores: Dict[int, float] = {}
+
+        def bump(entry_id: int, score: float):
+            if score > scores.get(entry_id, 0.0):
+                scores[entry_id] = score
+
+        # 1) 代號完全相同
+        exact = self._by_symbol.get(q.upper().replace(' ', ''))
+        if exact is not None:
+            bump(exact, 1.0)
+
+        # 2) 前綴比對：整句前綴，或每個字都是某個名稱字詞的前綴
+        for entry_id in self._prefix(q):
+            bump(entry_id, 0.9)
+        words = q.split()
+        if len(words) > 1:
+            matched = set.intersection(*(self._prefix(w) for w in words))
+            for entry_id in matched:
+                bump(entry_id, 0.85)
+
+        # 3) trigram 模糊比對（拼錯字）
+        grams = _trigrams(q)
+        counts: Dict[int, int] = {}
+        for gram in grams:
+            for entry_id in self._trigrams.get(gram, ()):
+                counts[entry_id] = counts.get(entry_id, 0) + 1
+        for entry_id, n in counts.items():
+            coverage = n / len(grams)
+            if coverage >= 0.5:
+                bump(entry_id, 0.8 * coverage)
+
+        ranked = sorted(scores.items(),
+                        key=lambda kv: (-kv[1], len(self.entries[kv[0]]['symbol']), self.entries[kv[0]]['symbol']))
+        return [dict(self.entries[i], score=round(s, 3)) for i, s in ranked[:limit]]
+
+    def lookup(self, query: str, limit: int = 10) -> Tuple[List[Dict], bool]:
+        """回傳 (結果, 是否可信)"""
+        hits = self.search(query, limit)
+        return hits, bool(hits) and hits[0]['score'] >= CONFIDENT_SCORE
+
+    def learn(self, hits: List[Dict]):
+        """把網路搜尋結果併入索引並持久化"""
+        if not self.add(hits):
+            return
+        try:
+            path = pathlib.Path(LEARNED_PATH)
+            learned = json.loads(path.read_text('utf-8')) if path.exists() else []
+            have = {e['symbol'] for e in learned}
+            for h in hits:
+                if h.get('symbol') and h['symbol'] not in have:
+                    learned.append({k: h.get(k) for k in ('symbol', 'name', 'exchDisp', 'type')})
+                    have.add(h['symbol'])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(learned, ensure_ascii=False), 'utf-8')
+        except Exception as e:
+            logger.warning(f"保存搜尋索引失敗: {e}")
+
+    def build(self):
+        """
+        由成分股清單與已學到的代號重建索引；可重複呼叫，
+        已移出成分股（且不是學到的）代號會一併移除
+        """
+        fresh = SymbolIndex()
+        # 整個重建期間持鎖：查詢稍等即可，並發的 learn 不會寫進即將被換掉的舊索引
+        with self._lock:
+            fresh.add({'symbol': s, 'name': sp500_universe.names.get(s, ''), 'type': 'EQUITY'}
+                      for s in sorted(sp500_universe.symbols))
+            try:
+                path = pathlib.Path(LEARNED_PATH)
+                if path.exists():
+                    fresh.add(json.loads(path.read_text('utf-8')))
+            except Exception as e:
+                logger.warning(f"讀取已學代號失敗: {e}")
+            self.entries, self._by_symbol = fresh.entries, fresh._by_symbol
+            self._trie, self._trigrams = fresh._trie, fresh._trigrams
+        logger.info(f"搜尋索引建立完成: {len(self.entries)} 個代號")
+
+# 全局搜尋索引實例（啟動時建立，成分股清單更新後併入新代號）
+symbol_index = SymbolIndex()
+symbol_index.build()
+sp500_universe.on_change(symbol_index.build)
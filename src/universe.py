@@ -0,0 +1,185 @@
+# src/universe.py
+"""
+標普500成分股清單：本地快照啟動即載入，每日最多一次以條件式 HTTP 請求（ETag / Last-Modified）更新
+"""
+
+import os
+import csv
+import io
+import json
+import time
+import pathlib
+import threading
+import logging
+from typing import Callable, Dict, FrozenSet, List, Optional
+
+import requests
+
+from .replay import replay
+
+logger = logging.getLogger(__name__)
+
+# 成分股 CSV（欄位: Symbol, Security, GICS Sector, ...），比爬 Wikipedia 表格輕量得多
+SP500_SOURCE_URL = os.getenv(
+    'SP500_SOURCE_URL',
+    'https://raw.githubusercontent.com/datasets/s-and-p-500-companies/main/data/constituents.csv'
+)
+UNIVERSE_PATH = os.path.abspath(os.getenv('UNIVERSE_PATH', 'data/universe/sp500.json'))
+REFRESH_INTERVAL = 86400  # 每日最多更新一次
+RETRY_BACKOFF = 300       # 更新失敗後的首次重試間隔（秒），之後每次加倍，最長到 REFRESH_INTERVAL
+
+# 沒有本地快照也無法連網時的備用清單
+_FALLBACK_SYMBOLS = [
+    'AAPL', 'MSFT', 'GOOGL', 'AMZN', 'TSLA', 'META', 'NVDA', 'BRK-B',
+    'UNH', 'JNJ', 'V', 'PG', 'JPM', 'HD', 'MA', 'BAC', 'ABBV', 'PFE',
+    'KO', 'AVGO', 'PEP', 'TMO', 'COST', 'DIS', 'ABT', 'MRK', 'VZ', 'ADBE'
+]
+
+class Universe:
+    """成分股清單，以不可變集合提供 O(1) 成員查詢"""
+
+    def __init__(self, path: str = UNIVERSE_PATH, source_url: str = SP500_SOURCE_URL):
+        self.path = pathlib.Path(path)
+        self.source_url = source_url
+        self.symbols: FrozenSet[str] = frozenset(_FALLBACK_SYMBOLS)
+        self.names: Dict[str, str] = {}
+        self.sectors: Dict[str, str] = {}
+        self.fetched_at = 0.0
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.version = 0          # 清單內容每次變動 +1，呼叫者可據此失效衍生快取
+        self._retry_at = 0.0      # 上次更新失敗後，在此時間之前不再連網
+        self._backoff = RETRY_BACKOFF
+        self._listeners: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self) -> bool:
+        """從本地快照載入（不連網）"""
+        try:
+            if not self.path.exists():
+                return False
+            data = json.loads(self.path.read_text('utf-8'))
+            self._apply(data)
+            logger.info(f"載入標普500快照: {len(self.symbols)} 支 (抓取於 {time.ctime(self.fetched_at)})")
+            return True
+        except Exception as e:
+            logger.error(f"讀取標普500快照失敗: {e}")
+            return False
+
+    def _apply(self, data: Dict):
+        companies = data.get('companies') or []
+        self.symbols = frozenset(c['symbol'] for c in companies) or frozenset(_FALLBACK_SYMBOLS)
+        self.names = {c['symbol']: c.get('name', '') for c in companies}
+        self.sectors = {c['symbol']: c.get('sector', '') for c in companies}
+        self.fetched_at = data.get('fetched_at', 0.0)
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.version += 1
+
+    def _save(self, data: Dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(data, ensure_ascii=False), 'utf-8')
+        tmp.replace(self.path)
+
+    def _parse(self, text: str):
+        companies = []
+        for row in csv.DictReader(io.StringIO(text)):
+            symbol = (row.get('Symbol') or '').strip().upper()
+            if not symbol:
+                continue
+            companies.append({
+                'symbol': symbol.replace('.', '-'),  # Yahoo 格式: BRK.B -> BRK-B
+                'name': (row.get('Security') or row.get('Name') or '').strip(),
+                'sector': (row.get('GICS Sector') or row.get('Sector') or '').strip(),
+            })
+        return companies
+
+    def on_change(self, callback: Callable[[], None]):
+        """註冊清單內容變動後的回呼（例如重建搜尋索引）"""
+        self._listeners.append(callback)
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        必要時更新清單，有變動時通知 on_change 註冊的回呼
+
+        Returns:
+            清單內容是否有變動
+        """
+        changed = self._refresh(force)
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"標普500清單變動回呼失敗: {e}")
+        return changed
+
+    def _refresh(self, force: bool) -> bool:
+        with self._lock:
+            if not force and (time.time() - self.fetched_at < REFRESH_INTERVAL or time.time() < self._retry_at):
+                return False
+
+            headers = {}
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+            try:
+                response = requests.get(replay.url(self.source_url), headers=headers, timeout=10)
+                replay.record(self.source_url, response.status_code, response.text, 'text/csv')
+                data = {
+                    'fetched_at': time.time(),
+                    'etag': response.headers.get('ETag', self.etag),
+                    'last_modified': response.headers.get('Last-Modified', self.last_modified),
+                }
+
+                if response.status_code == 304:
+                    # 內容未變，只更新抓取時間
+                    data['companies'] = self._companies()
+                    self._save(data)
+                    self.fetched_at = data['fetched_at']
+                    self._backoff = RETRY_BACKOFF
+                    logger.info("標普500清單未變動 (304)")
+                    return False
+
+                response.raise_for_status()
+                companies = self._parse(response.text)
+                if len(companies) < 400:
+                    raise ValueError(f"成分股數量異常: {len(companies)}")
+
+                data['companies'] = companies
+                self._save(data)
+                changed = frozenset(c['symbol'] for c in companies) != self.symbols
+                self._apply(data)
+                self._backoff = RETRY_BACKOFF
+                logger.info(f"更新標普500清單: {len(self.symbols)} 支")
+                return changed
+
+            except Exception as e:
+                # 記下失敗時間並退避，避免每次查詢都卡在一個 10 秒逾時的請求上
+                self._retry_at = time.time() + self._backoff
+                logger.error(f"更新標普500清單失敗，{self._backoff:.0f}s 內不再重試: {e}")
+                self._backoff = min(self._backoff * 2, REFRESH_INTERVAL)
+                return False
+
+    def refresh_in_background(self):
+        """啟動時在背景執行緒更新，不阻塞載入"""
+        threading.Thread(target=self.refresh, name='universe-refresh', daemon=True).start()
+
+    def _companies(self):
+        return [
+            {'symbol': s, 'name': self.names.get(s, ''), 'sector': self.sectors.get(s, '')}
+            for s in sorted(self.symbols)
+        ]
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self.symbols
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+# 全局標普500清單實例
+sp500_universe = Universe()
@@ -0,0 +1,247 @@
+# src/user_store.py
+"""
+用戶資料持久化（會員等級、語言、VIC 信箱、每日查詢次數）：
+SQLite 本地儲存，設定 REDIS_URL 時改用 Redis 讓多個 worker 共用；
+讀取一律走呼叫端的記憶體結構，寫入先進待寫佇列，背景批次寫回（write-behind）；
+Redis 版以共用版本號通知其他 worker 重新載入等級 / 語言 / 信箱
+"""
+
+import os
+import time
+import atexit
+import sqlite3
+import pathlib
+import threading
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from .cache import _r
+
+logger = logging.getLogger(__name__)
+
+USER_DB = os.path.abspath(os.getenv('USER_DB', 'data/users.db'))
+FLUSH_INTERVAL = float(os.getenv('USER_STORE_FLUSH_SECONDS', '2'))
+SYNC_INTERVAL = float(os.getenv('USER_STORE_SYNC_SECONDS', '5'))  # 多久檢查一次其他 worker 的寫入
+FLUSH_BATCH = 200            # 待寫入筆數達到此數時提早寫回
+QUERY_RETENTION_DAYS = 2     # 每日查詢次數保留天數（台北日期）
+
+FIELDS = ('tier', 'language', 'email')
+
+class SQLiteUserBackend:
+    """本地 SQLite"""
+
+    name = 'SQLite'
+
+    def __init__(self, db_path: str = USER_DB):
+        self.db_path = db_path
+        pathlib.Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id INTEGER PRIMARY KEY, tier TEXT, language TEXT, email TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "day TEXT, user_id INTEGER, count INTEGER, PRIMARY KEY (day, user_id))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def load(self, day: str) -> Dict[str, Dict[int, Any]]:
+        with self._connect() as conn:
+            users = conn.execute("SELECT user_id, tier, language, email FROM users").fetchall()
+            queries = conn.execute("SELECT user_id, count FROM queries WHERE day = ?", (day,)).fetchall()
+        snapshot = {field: {} for field in FIELDS}
+        for user_id, *values in users:
+            for field, value in zip(FIELDS, values):
+                if value is not None:
+                    snapshot[field][user_id] = value
+        snapshot['queries'] = dict(queries)
+        return snapshot
+
+    def write(self, batch: Dict[Tuple[str, Any], Any]):
+        with self._connect() as conn:
+            for (field, key), value in batch.items():
+                if field == 'queries':
+                    day, user_id = key
+                    conn.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)", (day, user_id, value))
+                else:
+                    conn.execute(
+                        f"INSERT INTO users (user_id, {field}) VALUES (?, ?) "
+                        f"ON CONFLICT(user_id) DO UPDATE SET {field} = excluded.{field}",
+                        (key, value)
+                    )
+
+    def prune_queries(self, oldest_day: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM queries WHERE day < ?", (oldest_day,))
+
+    def version(self) -> Optional[int]:
+        return None  # 單一 worker，本地記憶體就是最新狀態
+
+class RedisUserBackend:
+    """Redis：每個欄位一個 hash（users:tier 等），查詢次數 queries:{day} 自動過期"""
+
+    name = 'Redis'
+
+    def load(self, day: str) -> Dict[str, Dict[int, Any]]:
+        pipe = _r().pipeline()
+        for field in FIELDS:
+            pipe.hgetall(f'users:{field}')
+        pipe.hgetall(f'queries:{day}')
+        *fields, queries = pipe.execute()
+        snapshot = {field: {int(k): v for k, v in values.items()} for field, values in zip(FIELDS, fields)}
+        snapshot['queries'] = {int(k): int(v) for k, v in queries.items()}
+        return snapshot
+
+    def load_users(self) -> Dict[str, Dict[int, Any]]:
+        pipe = _r().pipeline()
+        for field in FIELDS:
+            pipe.hgetall(f'users:{field}')
+        return {field: {int(k): v for k, v in values.items()} for field, values in zip(FIELDS, pipe.execute())}
+
+    def version(self) -> Optional[int]:
+        return int(_r().get('users:version') or 0)
+
+    def write(self, batch: Dict[Tuple[str, Any], Any]):
+        pipe = _r().pipeline(transaction=False)
+        if any(field != 'queries' for field, _ in batch):
+            pipe.incr('users:version')   # 其他 worker 看到版本變動後重新載入
+        for (field, key), value in batch.items():
+            if field == 'queries':
+                day, user_id = key
+                pipe.hset(f'queries:{day}', user_id, value)
+                pipe.expire(f'queries:{day}', QUERY_RETENTION_DAYS * 86400)
+            elif value is None:
+                pipe.hdel(f'users:{field}', key)
+            else:
+                pipe.hset(f'users:{field}', key, value)
+        pipe.execute()
+
+    def prune_queries(self, oldest_day: str):
+        pass  # 由 EXPIRE 處理
+
+class UserStore:
+    """write-behind 用戶儲存"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or (RedisUserBackend() if _r() else SQLiteUserBackend())
+        self._pending: Dict[Tuple[str, Any], Any] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self.stats = {'writes': 0, 'flushes': 0, 'flushed_rows': 0, 'reloads': 0, 'errors': 0,
+                      'last_flush_ms': None}
+
+    def load(self, day: str, oldest_day: Optional[str] = None) -> Dict[str, Dict[int, Any]]:
+        """
+        啟動時讀回全部用戶資料
+
+        Returns:
+            {'tier': {user_id: 'vip'|'vic'}, 'language': {...}, 'email': {...}, 'queries': {user_id: 當日次數}}
+        """
+        try:
+            if oldest_day:
+                self.backend.prune_queries(oldest_day)
+            self._version = self.backend.version()   # 先記版本，載入期間的寫入會在下次同步時補上
+            self._checked_at = time.monotonic()
+            snapshot = self.backend.load(day)
+            logger.info(f"用戶資料載入完成（{self.backend.name}）: {len(snapshot['tier'])} 位付費用戶，"
+                        f"{len(snapshot['language'])} 位語言設定")
+            return snapshot
+        except Exception as e:
+            logger.error(f"載入用戶資料失敗，以空白狀態啟動: {e}")
+            return {field: {} for field in FIELDS + ('queries',)}
+
+    def changes(self) -> Optional[Dict[str, Dict[int, Any]]]:
+        """
+        其他 worker 寫入後回傳最新的等級 / 語言 / 信箱（疊上本行程尚未寫回的資料），
+        沒有變動、距上次檢查不到 SYNC_INTERVAL 或後端不共用時回傳 None
+        """
+        if self._version is None or time.monotonic() - self._checked_at < SYNC_INTERVAL:
+            return None
+        self._checked_at = time.monotonic()
+        try:
+            version = self.backend.version()
+            if version == self._version:
+                return None
+            snapshot = self.backend.load_users()
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning(f"同步用戶資料失敗: {e}")
+            return None
+        self._version = version
+        with self._lock:
+            for (field, key), value in self._pending.items():
+                if field in snapshot:
+                    if value is None:
+                        snapshot[field].pop(key, None)
+                    else:
+                        snapshot[field][key] = value
+        self.stats['reloads'] += 1
+        return snapshot
+
+    def _put(self, field: str, key: Any, value: Any):
+        with self._lock:
+            self._pending[(field, key)] = value   # 同一欄位只保留最後一次寫入
+            self.stats['writes'] += 1
+            size = len(self._pending)
+        self._ensure_thread()
+        if size >= FLUSH_BATCH:
+            self._wake.set()
+
+    def set_tier(self, user_id: int, tier: Optional[str]):
+        self._put('tier', user_id, tier)
+
+    def set_language(self, user_id: int, language: str):
+        self._put('language', user_id, language)
+
+    def set_email(self, user_id: int, email: Optional[str]):
+        self._put('email', user_id, email)
+
+    def set_query_count(self, day: str, user_id: int, count: int):
+        self._put('queries', (day, user_id), count)
+
+    def flush(self):
+        """把待寫入資料一次寫回；失敗時放回佇列（較新的寫入優先）"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            start = time.perf_counter()
+            try:
+                self.backend.write(batch)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"用戶資料寫回失敗（{len(batch)} 筆），稍後重試: {e}")
+                with self._lock:
+                    self._pending = {**batch, **self._pending}
+                return
+            self.stats['flushes'] += 1
+            self.stats['flushed_rows'] += len(batch)
+            self.stats['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='user-store-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._pending)
+        return dict(self.stats, backend=self.backend.name, pending=pending)
+
+# 全局用戶儲存實例
+user_store = UserStore()
+atexit.register(user_store.flush)
@@ -0,0 +1,64 @@
+# tools/bench_quote.py
+"""
+報價路徑基準測試：比較 ticker.info 舊路徑與 chart 端點 / fast_info 輕量路徑的耗時
+
+用法: python -m tools.bench_quote [AAPL,MSFT,TSLA] [--rounds 3]
+"""
+import argparse, statistics, time
+import yfinance as yf
+
+from src.provider_yahoo import YahooProvider
+from src.ratelimit import rate_limiter
+
+def _info_path(symbol: str):
+    """舊路徑：ticker.info + 5 日歷史"""
+    ticker = yf.Ticker(symbol)
+    info = ticker.info
+    ticker.history(period="5d")
+    return info.get('currentPrice') or info.get('regularMarketPrice')
+
+def _timed(fn, symbol: str):
+    start = time.perf_counter()
+    try:
+        fn(symbol)
+        ok = True
+    except Exception as e:
+        print(f"  {fn.__name__} {symbol} 失敗: {e}")
+        ok = False
+    return time.perf_counter() - start, ok
+
+def main():
+    ap = argparse.ArgumentParser(description="報價路徑基準測試")
+    ap.add_argument('symbols', nargs='?', default="AAPL,MSFT,TSLA,NVDA,GOOGL")
+    ap.add_argument('--rounds', type=int, default=3)
+    args = ap.parse_args()
+
+    symbols = [s.strip().upper() for s in args.symbols.split(',') if s.strip()]
+    # 基準測試不應把限流等待算進耗時
+    rate_limiter.limits['yahoo'] = (6000, 1000)
+    yp = YahooProvider()
+    paths = [
+        ("ticker.info", _info_path),
+        ("chart 端點", yp._get_data_direct_api),
+        ("fast_info", yp._get_data_yfinance),
+    ]
+
+    print(f"股票: {', '.join(symbols)} | 回合: {args.rounds}")
+    for name, fn in paths:
+        samples, failures = [], 0
+        for _ in range(args.rounds):
+            for symbol in symbols:
+                elapsed, ok = _timed(fn, symbol)
+                if ok:
+                    samples.append(elapsed)
+                else:
+                    failures += 1
+        if samples:
+            p95 = sorted(samples)[max(0, int(len(samples) * 0.95) - 1)]
+            print(f"{name:<12} 中位數 {statistics.median(samples) * 1000:8.1f}ms | "
+                  f"p95 {p95 * 1000:8.1f}ms | 成功 {len(samples)} | 失敗 {failures}")
+        else:
+            print(f"{name:<12} 全部失敗 ({failures})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# tools/bench_stock.py
+"""
+/stock 管線基準測試：完整的 VIPStockBot.analyze_stock + 報告渲染（依會員等級，每回合清空分析 / 渲染快取，
+量測冷啟動），以及上游逐階段計時（報價、公司資料、歷史K線、期權到期日、Max Pain），輸出 JSON 摘要
+
+搭配 src/replay.py 可離線重現：
+  1. 錄製: REPLAY_MODE=record python -m tools.bench_stock AAPL,MSFT
+  2. 重播: REPLAY_MODE=replay HISTORY_DB=/tmp/bench.db python -m tools.bench_stock AAPL,MSFT --out after.json
+  3. 比較: python -m tools.bench_stock AAPL,MSFT --out after.json --compare before.json
+重播時可用 REPLAY_LATENCY_MS / REPLAY_ERROR_RATE 模擬上游延遲與錯誤
+"""
+import argparse, asyncio, json, os, statistics, time
+
+from src.provider_yahoo import YahooProvider
+from src.profile_store import profile_store
+from src.history import history_store
+from src.ratelimit import rate_limiter
+from src.replay import replay
+
+# 基準測試用的虛擬用戶（負數 id 不會和真實 Telegram 用戶衝突）
+BENCH_USERS = {"free": -1, "vic": -2}
+
+def _stages(yp: YahooProvider):
+    return [
+        ("quote", yp.get_stock_data),
+        ("profile", lambda s: profile_store._fetch(s)),
+        ("history", lambda s: history_store.get_history(s, days=50, max_age=0)),
+        ("expiry", yp.nearest_expiry),
+        ("max_pain", yp.calculate_max_pain),
+    ]
+
+def _summary(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "median_ms": round(statistics.median(ordered) * 1000, 1),
+        "p95_ms": round(ordered[max(0, int(len(ordered) * 0.95) - 1)] * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+async def _pipeline_once(bot, symbol, user_id):
+    """一次 /stock：分析 + 渲染，回傳 (分析秒數, 渲染秒數, 是否成功)"""
+    # 清掉合併 / 重用的結果，每次都量到完整的分析
+    bot._recent_analyses.clear()
+    bot._render_cache.clear()
+    start = time.perf_counter()
+    analysis = await bot.analyze_stock(symbol, user_id)
+    analyzed = time.perf_counter()
+    report = bot.format_analysis_report(analysis, user_id)
+    rendered = time.perf_counter()
+    ok = bool(analysis) and bool((analysis.get('stock_data') or {}).get('current_price')) and bool(report)
+    return analyzed - start, rendered - analyzed, ok
+
+async def run_pipeline(symbols, rounds):
+    """各等級的 /stock 管線（VIPStockBot.analyze_stock + format_analysis_report），全部在同一個事件迴圈內"""
+    try:
+        import app_sp500  # 匯入時會建立 bot 並載入用戶資料，只在量測管線時才載入
+    except Exception as e:
+        # 含 SyntaxError；main() 輸出其餘結果後以非零狀態結束，不當成量測成功
+        print(f"  無法載入 app_sp500，/stock 管線無法量測: {type(e).__name__}: {e}")
+        return {"error": f"{type(e).__name__}: {e}"}
+    bot = app_sp500.bot
+    bot.vic_users.add(BENCH_USERS["vic"])
+    results = {}
+    for tier, user_id in BENCH_USERS.items():
+        samples = {"analyze": [], "render": [], "total": []}
+        failures = 0
+        for _ in range(rounds):
+            for symbol in symbols:
+                try:
+                    analyze, render, ok = await _pipeline_once(bot, symbol, user_id)
+                except Exception as e:
+                    print(f"  pipeline[{tier}] {symbol} 失敗: {e}")
+                    failures += 1
+                    continue
+                samples["analyze"].append(analyze)
+                samples["render"].append(render)
+                samples["total"].append(analyze + render)
+                if not ok:
+                    failures += 1
+        results[tier] = {name: _summary(v) for name, v in samples.items()}
+        results[tier]["failures"] = failures
+    bot.vic_users.discard(BENCH_USERS["vic"])
+    return results
+
+def run(symbols, rounds):
+    yp = YahooProvider()
+    stages = {name: {"samples": [], "failures": 0} for name, _ in _stages(yp)}
+    totals = []
+    for _ in range(rounds):
+        for symbol in symbols:
+            t0 = time.perf_counter()
+            for name, fn in _stages(yp):
+                start = time.perf_counter()
+                try:
+                    result = fn(symbol)
+                    ok = result is not None and not (isinstance(result, dict) and result.get("error"))
+                except Exception as e:
+                    print(f"  {name} {symbol} 失敗: {e}")
+                    ok = False
+                stages[name]["samples"].append(time.perf_counter() - start)
+                if not ok:
+                    stages[name]["failures"] += 1
+            totals.append(time.perf_counter() - t0)
+
+    return {
+        "symbols": symbols,
+        "rounds": rounds,
+        "mode": replay.mode or "live",
+        "latency_ms": float(os.getenv("REPLAY_LATENCY_MS", "0")),
+        "error_rate": float(os.getenv("REPLAY_ERROR_RATE", "0")),
+        "total": _summary(totals),
+        "stages": {n: dict(_summary(s["samples"]) or {}, failures=s["failures"]) for n, s in stages.items()},
+        "pipeline": asyncio.run(run_pipeline(symbols, rounds)),
+        "replay": dict(replay.stats),
+        "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+def _print(result, baseline=None):
+    def delta(cur, base):
+        if not base or not base.get("median_ms"):
+            return ""
+        return f" ({(cur - base['median_ms']) / base['median_ms'] * 100:+.1f}%)"
+
+    total = result["total"] or {}
+    base_stages = (baseline or {}).get("stages", {})
+    print(f"模式: {result['mode']} | 股票: {', '.join(result['symbols'])} | 回合: {result['rounds']}")
+    if total:
+        print(f"{'total':<10} 中位數 {total['median_ms']:8.1f}ms{delta(total['median_ms'], (baseline or {}).get('total'))} | "
+              f"p95 {total['p95_ms']:8.1f}ms")
+    base_pipeline = (baseline or {}).get("pipeline", {})
+    pipeline = result.get("pipeline") or {}
+    if "error" in pipeline:
+        print(f"/stock 管線: 未量測（{pipeline['error']}）")
+        pipeline = {}
+    for tier, p in pipeline.items():
+        for name in ("analyze", "render", "total"):
+            s = p.get(name)
+            if not s:
+                print(f"/stock[{tier}] {name:<8} 無樣本")
+                continue
+            print(f"/stock[{tier}] {name:<8} 中位數 {s['median_ms']:8.1f}ms"
+                  f"{delta(s['median_ms'], base_pipeline.get(tier, {}).get(name))} | p95 {s['p95_ms']:8.1f}ms")
+        print(f"/stock[{tier}] 失敗 {p['failures']}")
+    for name, s in result["stages"].items():
+        if "median_ms" not in s:
+            print(f"{name:<10} 無樣本")
+            continue
+        print(f"{name:<10} 中位數 {s['median_ms']:8.1f}ms{delta(s['median_ms'], base_stages.get(name))} | "
+              f"p95 {s['p95_ms']:8.1f}ms | 失敗 {s['failures']}")
+    print(f"重播統計: {result['replay']}")
+
+def main():
+    ap = argparse.ArgumentParser(description="/stock 管線基準測試")
+    ap.add_argument('symbols', nargs='?', default="AAPL,MSFT,TSLA,NVDA,GOOGL")
+    ap.add_argument('--rounds', type=int, default=3)
+    ap.add_argument('--out', default="bench_stock.json", help="JSON 摘要輸出路徑")
+    ap.add_argument('--compare', help="與先前的 JSON 摘要比較")
+    args = ap.parse_args()
+
+    symbols = [s.strip().upper() for s in args.symbols.split(',') if s.strip()]
+    # 基準測試不應把限流等待算進耗時
+    rate_limiter.limits['yahoo'] = (6000, 1000)
+
+    result = run(symbols, args.rounds)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    _print(result, baseline)
+    replay.stop_server()
+    if "error" in result["pipeline"]:
+        raise SystemExit(f"/stock 管線未量測: {result['pipeline']['error']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,48 @@
 # tools/send_report.py
-import os, asyncio, datetime as dt
+import os, asyncio, time, logging, datetime as dt
 import httpx
 
-from src.provider_yahoo import YahooProvider
-from src.service import maxpain_handler, gex_handler
-from src.analyzers import magnet_strength
+from src.provider_yahoo import AsyncYahooProvider, run_blocking, ensure_blocking_threads
+from src.options_math import max_pain_summary, gex_summary, magnet_strength
 from src.strategy import gen_strategy
+from src.replay import replay
+from src.delivery import telegram_delivery
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")  # e.g., 123456789
+CHAT_IDS = [c.strip() for c in os.getenv("TELEGRAM_CHAT_ID", "").split(",") if c.strip()]  # e.g., 123456789,-100987654
 WATCHLIST = [s.strip().upper() for s in os.getenv("WATCHLIST", "AAPL,MSFT,TSLA,NVDA").split(",") if s.strip()]
 BRAND_NAME = os.getenv("BRAND_NAME", "Maggie's Stock AI")
 POLYGON_API_KEY = os.getenv("POLYGON_API_KEY")
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "8"))
+REPORT_MAX_SYMBOLS = int(os.getenv("REPORT_MAX_SYMBOLS", "100"))
+SYMBOL_TIMEOUT = float(os.getenv("SYMBOL_TIMEOUT", "20"))  # 單一股票區塊的時間上限（秒）
+
+logger = logging.getLogger("send_report")
 
 def _m(v): return "—" if v is None else f"${v:,.2f}"
 def _p(v): return "—" if v is None else f"{v:.2f}%"
 
-async def _send_text(text: str):
-    if not (BOT_TOKEN and CHAT_ID):
+BLOCK_SEPARATOR = "\n" + "-" * 20 + "\n"
+
+DELIVERY_RETRY_DELAY = 30  # 有聊天室投遞失敗時，等待後以同一個帳本再補送一次（秒）
+
+async def _send_text(text: str, report_id: str):
+    if not (BOT_TOKEN and CHAT_IDS):
         raise SystemExit("Need TELEGRAM_BOT_TOKEN & TELEGRAM_CHAT_ID for send_report.py")
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    async with httpx.AsyncClient(timeout=20) as c:
-        r = await c.post(url, data={"chat_id": CHAT_ID, "text": text})
-        r.raise_for_status()
+    # 超過 4096 字元時依股票區塊切段，各聊天室並行、段落依序送出；
+    # 帳本以 report_id 存檔，失敗的聊天室（或之後重跑同一天的報告）只補送未確認的段落
+    try:
+        results = await telegram_delivery.deliver(report_id, text, CHAT_IDS, separator=BLOCK_SEPARATOR)
+        failed = [c for c, r in results.items() if r["error"]]
+        if failed:
+            logger.warning(f"{len(failed)} 個聊天室投遞失敗，{DELIVERY_RETRY_DELAY}s 後補送: {failed}")
+            await asyncio.sleep(DELIVERY_RETRY_DELAY)
+            results.update(await telegram_delivery.deliver(report_id, text, failed, separator=BLOCK_SEPARATOR))
+    finally:
+        await telegram_delivery.aclose()
+    failed = {c: r["error"] for c, r in results.items() if r["error"]}
+    if failed:
+        raise SystemExit(f"Report delivery failed (re-run to resume {report_id}): {failed}")
 
 def _week_range_utc(today=None):
     """回傳本週(一)~(日)的UTC日期字串 (YYYY-MM-DD)。"""
@@ -44,7 +64,8 @@ async def _fetch_weekly_ipo_polygon():
         f"&from={start}&to={end}&limit=50"
     )
     async with httpx.AsyncClient(timeout=20) as c:
-        r = await c.get(url)
+        r = await c.get(replay.url(url))
+        replay.record(url, r.status_code, r.text)
         r.raise_for_status()
         data = r.json().get("results", [])
     # 精簡欄位
@@ -60,18 +81,39 @@ async def _fetch_weekly_ipo_polygon():
         })
     return out, None
 
-async def _build_symbol_block(symbol: str) -> str:
-    yp = YahooProvider()
-    q = yp.get_quote(symbol)
-    spot = q.get("price")
+# 降級說明裡顯示的步驟名稱
+STEP_LABELS = {"quote": "報價", "expiry": "期權到期日", "options": "期權鏈"}
+
+def _options_metrics(yp: AsyncYahooProvider, symbol: str, expiry: str, spot):
+    """期權鏈只抓一次，Max Pain / GEX 在同一個執行緒算完（每個區塊同時最多佔用一個池執行緒）"""
+    chain = yp.get_options_chain(symbol, expiry)
+    # 沒有現價時 GEX 無從計算，不能用 0.0 代替
+    gex = gex_summary(symbol, expiry, spot, chain) if spot is not None else None
+    return max_pain_summary(symbol, expiry, chain), gex
+
+async def _collect_symbol(symbol: str, yp: AsyncYahooProvider, out: dict):
+    """依序填入 out：quote → expiry → 期權鏈 + Max Pain / GEX；out["step"] 記錄進行中的步驟"""
+    out["step"] = "quote"
+    q = await yp.get_stock_data(symbol)
+    if "error" in q:
+        raise RuntimeError(q["error"])
+    out["quote"] = q
+    out["step"] = "expiry"
+    out["expiry"] = expiry = await yp.nearest_expiry(symbol)
+    if not expiry:
+        raise LookupError(f"{symbol} 無可用的期權到期日")
+    out["step"] = "options"
+    out["mp"], out["gex"] = await run_blocking(_options_metrics, yp, symbol, expiry, q.get("current_price"))
+    del out["step"]
+
+def _render_symbol_block(symbol: str, data: dict) -> str:
+    q = data.get("quote") or {}
+    spot = q.get("current_price")
     prev_close = q.get("previous_close")
     chg = q.get("change")
-    chg_pct = q.get("change_pct")
-
-    expiry = yp.nearest_expiry(symbol)
-    mp = maxpain_handler(symbol, expiry)
-    gex, support, resistance = gex_handler(symbol, expiry, spot=spot or 0.0)
-    magnet = magnet_strength(spot or mp['max_pain'], mp['max_pain'])
+    chg_pct = q.get("change_percent")
+    max_pain = data["mp"]["max_pain"] if data.get("mp") else None
+    gex, support, resistance = data.get("gex") or (None, None, None)
 
     # 市場情緒
     mood = "📊 震盪整理"
@@ -80,42 +122,71 @@ async def _build_symbol_block(symbol: str) -> str:
         elif chg_pct >= 0.3:   mood = "📈 上行偏多"
         else:                  mood = "📉 下行偏空"
 
-    # GPT/規則 產生策略（無 OPENAI_API_KEY 會自動走規則版）
-    strategy_text = gen_strategy(
-        symbol=symbol, spot=spot or mp['max_pain'],
-        max_pain=mp['max_pain'], support=support, resistance=resistance
-    )
-
     lines = []
     lines.append(f"📉 {symbol}")
     lines.append(f"💰 即時 {_m(spot)} | 昨收 {_m(prev_close)} | 變動 {_m(chg)} ({_p(chg_pct)})")
     lines.append(mood)
     lines.append("")
-    lines.append(f"📍 {symbol}: {_m(spot)} {magnet} (距離: {_m(abs((spot or 0) - mp['max_pain']))})")
+    if max_pain is not None:
+        magnet = magnet_strength(spot or max_pain, max_pain)
+        lines.append(f"📍 {symbol}: {_m(spot)} {magnet} (距離: {_m(abs((spot or 0) - max_pain))})")
+    else:
+        lines.append(f"📍 {symbol}: {_m(spot)} (Max Pain: —)")
     lines.append("")
     lines.append("⚡ Gamma 支撐阻力位")
     lines.append(f"🛡️ {symbol}: 支撐 {_m(support)} | 阻力 {_m(resistance)}")
-    lines.append(f"💵 Dollar Gamma (1%): {gex.dollar_gamma_1pct:,.0f}")
-    lines.append("")
-    lines.append(strategy_text)
+    lines.append(f"💵 Dollar Gamma (1%): {'—' if gex is None else format(gex['dollar_gamma_1pct'], ',.0f')}")
+    if max_pain is not None and support is not None and resistance is not None:
+        # GPT/規則 產生策略（無 OPENAI_API_KEY 會自動走規則版）
+        lines.append("")
+        lines.append(gen_strategy(
+            symbol=symbol, spot=spot or max_pain,
+            max_pain=max_pain, support=support, resistance=resistance
+        ))
+    if data.get("note"):
+        lines.append("")
+        lines.append(data["note"])
     return "\n".join(lines)
 
+async def _build_symbol_block(symbol: str, yp: AsyncYahooProvider, sem: asyncio.Semaphore) -> str:
+    """單一股票區塊；逾時或失敗時用已取得的部分產生降級區塊，不拖住整份報告"""
+    data = {}
+    async with sem:
+        try:
+            await asyncio.wait_for(_collect_symbol(symbol, yp, data), SYMBOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            step = STEP_LABELS[data["step"]]
+            data["note"] = f"⏱️ {step}逾時（>{SYMBOL_TIMEOUT:.0f}s），以已取得的數據顯示"
+        except Exception as e:
+            # 原始例外只寫進日誌，報告裡只說明是哪一步失敗
+            step = STEP_LABELS[data["step"]]
+            logger.warning(f"{symbol} {step}讀取失敗: {type(e).__name__} {e}")
+            data["note"] = f"⚠️ {step}讀取失敗，以已取得的數據顯示"
+    return _render_symbol_block(symbol, data)
+
 async def build_report():
     header = f"📣 Daily US Market Report — {BRAND_NAME}\n"
     date_str = dt.datetime.utcnow().strftime("%Y-%m-%d %H:%M UTC")
     parts = [header + f"⌚ {date_str}\n"]
 
-    for s in WATCHLIST[:12]:
-        try:
-            block = await _build_symbol_block(s)
-        except Exception as e:
-            block = f"📉 {s}\n讀取失敗：{e}"
+    # 所有股票共用同一個 provider（httpx 連線池、限流與快取），以有界並發同時建立
+    yp = AsyncYahooProvider()
+    sem = asyncio.Semaphore(REPORT_CONCURRENCY)
+    # 每個區塊同時最多佔用一個 yfinance 執行緒；逾時的區塊放棄等待但執行緒仍會跑完，
+    # 多留一倍的執行緒，避免前面逾時的股票把後面的股票也拖進逾時
+    ensure_blocking_threads(2 * REPORT_CONCURRENCY)
+    symbols = WATCHLIST[:REPORT_MAX_SYMBOLS]
+    start = time.perf_counter()
+    ipo_task = asyncio.create_task(_fetch_weekly_ipo_polygon())
+    blocks = await asyncio.gather(*(_build_symbol_block(s, yp, sem) for s in symbols))
+    logger.info(f"{len(symbols)} 支股票區塊完成，耗時 {time.perf_counter() - start:.1f}s")
+    for block in blocks:
         parts.append(block)
         parts.append("-" * 20)
 
     # 本週 IPO 段落
     try:
-        ipos, err = await _fetch_weekly_ipo_polygon()
+        ipos, err = await ipo_task
         parts.append("🆕 本週 IPO")
         if ipos:
             for x in ipos:
@@ -129,8 +200,12 @@ async def build_report():
     return "\n".join(parts)
 
 async def main():
-    text = await build_report()
-    await _send_text(text)
+    try:
+        text = await build_report()
+    finally:
+        await AsyncYahooProvider.aclose()
+    # 同一天的報告共用一個投遞 id，重跑時接續上次未送完的部分
+    await _send_text(text, f"report-{dt.datetime.utcnow():%Y%m%d}")
 
 if __name__ == "__main__":
     asyncio.run(main())
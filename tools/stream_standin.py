@@ -0,0 +1,63 @@
+# tools/stream_standin.py
+"""
+本機 websocket 報價替身：以 Finnhub trade stream 格式推送隨機漫步成交，供測試 src/stream.py
+
+用法:
+  python -m tools.stream_standin --port 8765 --rate 20
+  STREAM_WS_URL=ws://127.0.0.1:8765/ python app_sp500.py
+"""
+import argparse, asyncio, json, random, time
+from aiohttp import web
+
+def _make_app(rate: float, start_price: float):
+    prices = {}
+
+    async def handler(request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        subscribed = set()
+
+        async def reader():
+            async for msg in ws:
+                try:
+                    data = json.loads(msg.data)
+                except Exception:
+                    continue
+                symbol = (data.get('symbol') or '').upper()
+                if data.get('type') == 'subscribe' and symbol:
+                    subscribed.add(symbol)
+                elif data.get('type') == 'unsubscribe':
+                    subscribed.discard(symbol)
+
+        read_task = asyncio.create_task(reader())
+        try:
+            while not ws.closed:
+                await asyncio.sleep(1 / rate)
+                if not subscribed:
+                    continue
+                symbol = random.choice(sorted(subscribed))
+                price = prices.get(symbol, start_price) * (1 + random.gauss(0, 0.0005))
+                prices[symbol] = price
+                await ws.send_str(json.dumps({
+                    'type': 'trade',
+                    'data': [{'s': symbol, 'p': round(price, 2), 'v': random.randint(1, 500),
+                              't': int(time.time() * 1000)}],
+                }))
+        finally:
+            read_task.cancel()
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    return app
+
+def main():
+    ap = argparse.ArgumentParser(description="本機 websocket 報價替身")
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--rate', type=float, default=20, help="每秒推送的成交筆數")
+    ap.add_argument('--price', type=float, default=100.0, help="起始價格")
+    args = ap.parse_args()
+    web.run_app(_make_app(args.rate, args.price), host='127.0.0.1', port=args.port)
+
+if __name__ == "__main__":
+    main()